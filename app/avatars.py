@@ -0,0 +1,363 @@
+import asyncio
+import io
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from fastapi import HTTPException
+from fastapi.responses import ORJSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+import services
+from app.utilities import make_etag, on_invalidation, publish_invalidation
+from services import AVATAR_PATH
+
+# pillow is only imported (in the avatar pool) when an avatar is uploaded.
+if TYPE_CHECKING:
+    from PIL import Image
+
+# the largest avatar upload accepted, in bytes.
+MAX_AVATAR_BYTES = 4 * 1024 * 1024
+# the largest avatar accepted, after decoding.
+MAX_AVATAR_PIXELS = 4096 * 4096
+MAX_AVATAR_FRAMES = 300
+# the most pixels decoded for an avatar, over all of its frames.
+MAX_AVATAR_TOTAL_PIXELS = 64 * 1024 * 1024
+
+FILE_TYPES = ("png", "jpeg", "gif", "webp")
+
+# every avatar is saved in each of these sizes, the first one being
+# the "main" avatar (`<id>.<type>`), the rest are `<id>_<size>.<type>`.
+# a webp version of every size is saved as well.
+AVATAR_SIZES = (256, 128, 64)
+
+# the file type of every users avatar, so the current
+# avatar can be found without looking through the directory.
+AVATAR_INDEX_KEY = "ragnarok:api:avatars"
+# set once the avatar directory has been indexed, uploads fills
+# in the index before that, so it can't tell by itself.
+AVATAR_INDEX_BUILT_KEY = f"{AVATAR_INDEX_KEY}:built"
+AVATAR_INDEX_RETRY_INTERVAL = 60
+AVATAR_FILENAME = re.compile(rf"^(\d+)\.({"|".join(FILE_TYPES)})$")
+
+# decoding, resizing and encoding images is cpu heavy, pillow
+# releases the gil while doing so, so a thread pool is enough.
+_avatar_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="avatar")
+
+
+class UploadLimitMiddleware:
+    """Rejects request bodies larger than `limit` bytes on `paths`, while they're
+    being streamed, so the oversized upload is never read in its entirety."""
+
+    def __init__(self, app: ASGIApp, paths: tuple[str, ...], limit: int) -> None:
+        self.app = app
+        self.paths = paths
+        self.limit = limit
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+
+        for name, value in scope["headers"]:
+            if name == b"content-length" and int(value) > self.limit:
+                response = ORJSONResponse({"error": "file too large"}, status_code=413)
+                return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive() -> Message:
+            nonlocal received
+
+            message = await receive()
+            received += len(message.get("body", b""))
+
+            if received > self.limit:
+                raise HTTPException(413, {"error": "file too large"})
+
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+def avatar_filename(user_id: int, file_type: str, size: int = AVATAR_SIZES[0]) -> str:
+    if size == AVATAR_SIZES[0]:
+        return f"{user_id}.{file_type}"
+
+    return f"{user_id}_{size}.{file_type}"
+
+
+def _encode(frames: list["Image.Image"], durations: list[int], file_type: str) -> bytes:
+    output = io.BytesIO()
+
+    if len(frames) > 1:
+        frames[0].save(
+            output,
+            file_type.upper(),
+            save_all=True,
+            append_images=frames[1:],
+            duration=durations,
+            loop=0,
+            disposal=2,
+        )
+    elif file_type == "jpeg":
+        frames[0].convert("RGB").save(output, "JPEG", quality=90)
+    else:
+        frames[0].save(output, file_type.upper())
+
+    return output.getvalue()
+
+
+def _write_atomically(filename: str, data: bytes) -> None:
+    # write to a temporary file first, so a half written avatar is never served.
+    path = AVATAR_PATH / filename
+    temporary_path = path.with_name(f".{filename}.tmp")
+
+    with temporary_path.open("wb") as file:
+        file.write(data)
+
+    os.replace(temporary_path, path)
+
+
+def remove_avatar(user_id: int, keep: set[str] | None = None) -> None:
+    """Removes every saved avatar file of the user, except the ones in `keep`."""
+    # not only the current file types, older avatars could've been saved as anything.
+    for pattern in (f"{user_id}.*", f"{user_id}_*.*"):
+        for path in AVATAR_PATH.glob(pattern):
+            if keep and path.name in keep:
+                continue
+
+            path.unlink(missing_ok=True)
+
+
+def _process_avatar(user_id: int, raw: bytes, file_type: str) -> list[str]:
+    from PIL import Image
+
+    try:
+        return _resize_avatar(user_id, raw, file_type)
+    except (OSError, Image.DecompressionBombError) as exc:
+        raise ValueError("invalid image") from exc
+
+
+def _resize_avatar(user_id: int, raw: bytes, file_type: str) -> list[str]:
+    from PIL import Image, ImageSequence
+
+    image = Image.open(io.BytesIO(raw))
+    n_frames = getattr(image, "n_frames", 1) if file_type == "gif" else 1
+
+    if image.width * image.height > MAX_AVATAR_PIXELS:
+        raise ValueError("image too large")
+
+    if n_frames > MAX_AVATAR_FRAMES:
+        raise ValueError("too many frames")
+
+    if image.width * image.height * n_frames > MAX_AVATAR_TOTAL_PIXELS:
+        raise ValueError("image too large")
+
+    resized: dict[int, list[Image.Image]] = {size: [] for size in AVATAR_SIZES}
+    durations = []
+
+    if n_frames > 1:
+        # every frame is resized as soon as it's decoded, so only
+        # a single frame is ever kept around in its full size.
+        for frame in ImageSequence.Iterator(image):
+            durations.append(frame.info.get("duration", 100))
+            frame = frame.convert("RGBA")
+
+            for size in AVATAR_SIZES:
+                resized[size].append(frame.resize((size, size)))
+    else:
+        if image.mode not in ("RGB", "RGBA", "L"):
+            image = image.convert("RGBA")
+
+        for size in AVATAR_SIZES:
+            resized[size].append(image.resize((size, size)))
+
+    written: set[str] = set()
+
+    for size, frames in resized.items():
+        for output_type in dict.fromkeys((file_type, "webp")):
+            filename = avatar_filename(user_id, output_type, size)
+            _write_atomically(filename, _encode(frames, durations, output_type))
+            written.add(filename)
+
+    # the new avatar is in place, get rid of the files left by older avatars.
+    remove_avatar(user_id, keep=written)
+
+    return sorted(written)
+
+
+async def save_avatar(user_id: int, raw: bytes, file_type: str) -> list[str]:
+    """Saves the avatar in every size (and as webp), in the avatar pool.
+
+    Raises `ValueError` if the image can't be used as an avatar."""
+    written = await asyncio.get_running_loop().run_in_executor(
+        _avatar_pool, _process_avatar, user_id, raw, file_type
+    )
+
+    await services.redis.hset(AVATAR_INDEX_KEY, str(user_id), file_type)  # type: ignore
+    await invalidate_avatar(user_id)
+
+    return written
+
+
+async def delete_avatar(user_id: int) -> None:
+    await asyncio.get_running_loop().run_in_executor(
+        _avatar_pool, remove_avatar, user_id
+    )
+
+    await services.redis.hdel(AVATAR_INDEX_KEY, str(user_id))  # type: ignore
+    await invalidate_avatar(user_id)
+
+
+def _scan_avatars() -> dict[str, str]:
+    avatars: dict[str, str] = {}
+
+    with os.scandir(AVATAR_PATH) as entries:
+        for entry in entries:
+            if not (match := AVATAR_FILENAME.match(entry.name)):
+                continue
+
+            user_id, file_type = match.groups()
+
+            # every avatar has a webp version, so only use
+            # it if there's nothing else (webp uploads).
+            if file_type != "webp" or user_id not in avatars:
+                avatars[user_id] = file_type
+
+    return avatars
+
+
+async def build_avatar_index() -> None:
+    """Indexes the avatar directory, if it hasn't been already."""
+    if await services.redis.exists(AVATAR_INDEX_BUILT_KEY):
+        return
+
+    if not await services.redis.set(f"{AVATAR_INDEX_KEY}:lock", 1, nx=True, ex=600):
+        return
+
+    try:
+        avatars = await asyncio.get_running_loop().run_in_executor(
+            _avatar_pool, _scan_avatars
+        )
+
+        async with services.redis.pipeline(transaction=False) as pipe:
+            # avatars uploaded while scanning are already in the index, and newer.
+            for user_id, file_type in avatars.items():
+                pipe.hsetnx(AVATAR_INDEX_KEY, user_id, file_type)
+
+            pipe.set(AVATAR_INDEX_BUILT_KEY, 1)
+            await pipe.execute()
+
+        services.logger.info(f"Indexed {len(avatars)} avatars.")
+    finally:
+        await services.redis.delete(f"{AVATAR_INDEX_KEY}:lock")
+
+
+async def avatar_index_loop() -> None:
+    """Builds the avatar index, retrying until it's been built (by any worker)."""
+    while not await services.redis.exists(AVATAR_INDEX_BUILT_KEY):
+        try:
+            await build_avatar_index()
+        except Exception:
+            services.logger.exception("Failed to build the avatar index.")
+
+        await asyncio.sleep(AVATAR_INDEX_RETRY_INTERVAL)
+
+
+@dataclass(slots=True)
+class CachedAvatar:
+    data: bytes
+    etag: str
+    media_type: str
+
+
+class AvatarCache:
+    """LRU cache of the most requested avatars, bounded by their total size."""
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.avatars: OrderedDict[tuple[int, int, bool], CachedAvatar] = OrderedDict()
+
+    def get(self, key: tuple[int, int, bool]) -> CachedAvatar | None:
+        if (avatar := self.avatars.get(key)) is not None:
+            self.avatars.move_to_end(key)
+
+        return avatar
+
+    def set(self, key: tuple[int, int, bool], avatar: CachedAvatar) -> None:
+        self.pop(key)
+
+        self.avatars[key] = avatar
+        self.size += len(avatar.data)
+
+        while self.size > self.max_bytes and self.avatars:
+            _, evicted = self.avatars.popitem(last=False)
+            self.size -= len(evicted.data)
+
+    def pop(self, key: tuple[int, int, bool]) -> None:
+        if (avatar := self.avatars.pop(key, None)) is not None:
+            self.size -= len(avatar.data)
+
+    def forget_user(self, user_id: int) -> None:
+        for key in [key for key in self.avatars if key[0] == user_id]:
+            self.pop(key)
+
+
+avatar_cache = AvatarCache(max_bytes=32 * 1024 * 1024)
+
+
+@on_invalidation("avatar")
+def _forget_avatar(user_id: str) -> None:
+    avatar_cache.forget_user(int(user_id))
+
+
+async def invalidate_avatar(user_id: int) -> None:
+    avatar_cache.forget_user(user_id)
+    await publish_invalidation("avatar", user_id)
+
+
+def _read_avatar(filenames: list[str]) -> tuple[str, bytes] | None:
+    for filename in filenames:
+        try:
+            return filename, (AVATAR_PATH / filename).read_bytes()
+        except FileNotFoundError:
+            continue
+
+
+async def get_avatar(user_id: int, size: int, webp: bool) -> CachedAvatar | None:
+    """Returns the users avatar in `size`, from the hot set if possible.
+    Avatars from before the different sizes existed, are always the main avatar."""
+    key = (user_id, size, webp)
+
+    if avatar := avatar_cache.get(key):
+        return avatar
+
+    if not (file_type := await services.redis.hget(AVATAR_INDEX_KEY, str(user_id))):  # type: ignore
+        return
+
+    file_type = file_type.decode()
+    filenames = [
+        avatar_filename(user_id, "webp" if webp else file_type, size),
+        avatar_filename(user_id, file_type),
+    ]
+
+    if not (
+        found := await asyncio.get_running_loop().run_in_executor(
+            _avatar_pool, _read_avatar, filenames
+        )
+    ):
+        return
+
+    filename, data = found
+    avatar = CachedAvatar(
+        data=data,
+        etag=make_etag(data),
+        media_type=f"image/{filename.rsplit(".", 1)[1]}",
+    )
+    avatar_cache.set(key, avatar)
+
+    return avatar
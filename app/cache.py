@@ -0,0 +1,203 @@
+import asyncio
+import time
+import zlib
+from dataclasses import dataclass
+from functools import wraps
+from hashlib import md5
+from typing import Any, Awaitable, Callable, ParamSpec
+
+import orjson
+from fastapi import Response
+
+import services
+from app.replicas import stick_to_primary
+from app.utilities import TTLCache, on_invalidation, publish_invalidation
+
+P = ParamSpec("P")
+
+CACHE_PREFIX = "ragnarok:api:cache"
+# tag sets has to outlive every entry in them, so no endpoint should be cached longer.
+MAX_CACHE_TTL = 3600
+
+# responses are kept in-process for a few seconds as well, so hot
+# endpoints doesn't even have to ask redis. purges still reach them.
+L1_TTL = 5
+_l1: TTLCache[str, "CachedResponse"] = TTLCache(ttl=L1_TTL, maxsize=2048)
+
+# requests for a response, which is already being generated on this worker.
+_inflight: dict[str, asyncio.Future["CachedResponse | None"]] = {}
+
+# how long other workers waits for the worker holding the fill lock.
+FILL_LOCK_TIMEOUT = 5
+FILL_POLL_INTERVAL = 0.05
+
+
+@dataclass(slots=True)
+class CachedResponse:
+    body: bytes
+    media_type: str
+    tags: tuple[str, ...]
+
+    def response(self) -> Response:
+        return Response(self.body, media_type=self.media_type)
+
+    def encode(self) -> bytes:
+        return self.media_type.encode() + b"\n" + zlib.compress(self.body)
+
+    @classmethod
+    def decode(cls, raw: bytes, tags: tuple[str, ...]) -> "CachedResponse":
+        media_type, _, body = raw.partition(b"\n")
+        return cls(zlib.decompress(body), media_type.decode(), tags)
+
+
+def tag_key(tag: str) -> str:
+    return f"{CACHE_PREFIX}:tag:{tag}"
+
+
+def _resolve(kwargs: dict[str, Any], name: str) -> Any:
+    # "info.mode" -> kwargs["info"].mode
+    first, *attributes = name.split(".")
+    value = kwargs.get(first)
+
+    for attribute in attributes:
+        value = getattr(value, attribute, None)
+
+    return value
+
+
+def cached(
+    ttl: int,
+    vary: tuple[str, ...] = (),
+    tags: tuple[str, ...] = (),
+    when: Callable[[dict[str, Any]], bool] | None = None,
+) -> Callable[[Callable[P, Awaitable[Any]]], Callable[P, Awaitable[Any]]]:
+    """Caches successful responses of the endpoint for `ttl` seconds.
+
+    `vary` are the names of the endpoints parameters the response depends on,
+    attributes of dependencies can be used as well ("info.mode", "current_user.user_id").
+    `tags` are formatted with the parameters ("user:{user_id}"), and can be purged
+    with `purge_tags`. The response is only cached if `when` (if given) returns true
+    for the parameters. Only `Response`s with status 200 are cached, with their body
+    and media type."""
+    assert ttl <= MAX_CACHE_TTL
+
+    def decorator(endpoint: Callable[P, Awaitable[Any]]) -> Callable[P, Awaitable[Any]]:
+        name = f"{endpoint.__module__}.{endpoint.__qualname__}"
+
+        @wraps(endpoint)
+        async def wrapper(*args: P.args, **kwargs: P.kwargs) -> Any:
+            if when is not None and not when(kwargs):
+                return await endpoint(*args, **kwargs)
+
+            values = [str(_resolve(kwargs, parameter)) for parameter in vary]
+            key = f"{CACHE_PREFIX}:{name}:{md5(orjson.dumps(values)).hexdigest()}"
+
+            if response := _l1.get(key):
+                return response.response()
+
+            # someone is already generating it on this worker, wait for them.
+            if future := _inflight.get(key):
+                if response := await asyncio.shield(future):
+                    return response.response()
+
+                return await endpoint(*args, **kwargs)
+
+            future = asyncio.get_running_loop().create_future()
+            _inflight[key] = future
+
+            try:
+                response, result = await _fill(
+                    key,
+                    ttl,
+                    tuple(tag.format(**kwargs) for tag in tags),
+                    lambda: endpoint(*args, **kwargs),
+                )
+            except BaseException:
+                future.set_result(None)
+                raise
+            finally:
+                _inflight.pop(key, None)
+
+            future.set_result(response)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+async def _fill(
+    key: str,
+    ttl: int,
+    tags: tuple[str, ...],
+    generate: Callable[[], Awaitable[Any]],
+) -> tuple[CachedResponse | None, Any]:
+    if raw := await services.redis.get(key):
+        response = CachedResponse.decode(raw, tags)
+        _l1.set(key, response)
+        return response, response.response()
+
+    # only one worker generates the response, the rest waits for it to show up.
+    locked = await services.redis.set(f"{key}:lock", 1, nx=True, ex=FILL_LOCK_TIMEOUT)
+
+    if not locked:
+        deadline = time.monotonic() + FILL_LOCK_TIMEOUT
+
+        while time.monotonic() < deadline:
+            await asyncio.sleep(FILL_POLL_INTERVAL)
+
+            if raw := await services.redis.get(key):
+                response = CachedResponse.decode(raw, tags)
+                _l1.set(key, response)
+                return response, response.response()
+
+    try:
+        # whatever it reads is cached for everyone, so it's read from the
+        # primary, a lagging replica could still have the invalidated data.
+        stick_to_primary()
+        result = await generate()
+
+        if not isinstance(result, Response) or result.status_code != 200:
+            return None, result
+
+        response = CachedResponse(bytes(result.body), result.media_type or "", tags)
+
+        async with services.redis.pipeline(transaction=False) as pipe:
+            pipe.set(key, response.encode(), ex=ttl)
+            for tag in tags:
+                pipe.sadd(tag_key(tag), key)
+                pipe.expire(tag_key(tag), MAX_CACHE_TTL)
+
+            await pipe.execute()
+
+        _l1.set(key, response)
+        return response, result
+    finally:
+        if locked:
+            await services.redis.delete(f"{key}:lock")
+
+
+@on_invalidation("cache_tags")
+def _forget_tags(tags: str) -> None:
+    purged = set(tags.split(","))
+
+    for key, (_, response) in list(_l1.entries.items()):
+        if purged.intersection(response.tags):
+            _l1.pop(key)
+
+
+async def purge_tags(*tags: str) -> None:
+    """Drops every cached response with any of the tags, on every worker."""
+    if not tags:
+        return
+
+    async with services.redis.pipeline(transaction=False) as pipe:
+        for tag in tags:
+            pipe.smembers(tag_key(tag))
+
+        keys = set().union(*await pipe.execute())
+
+    await services.redis.delete(*keys, *(tag_key(tag) for tag in tags))
+
+    _forget_tags(",".join(tags))
+    await publish_invalidation("cache_tags", ",".join(tags))
@@ -0,0 +1,97 @@
+import asyncio
+from dataclasses import dataclass
+from typing import Any
+
+import orjson
+from fastapi import Request, Response
+
+import services
+from app.utilities import etag_matches, make_etag, on_invalidation
+
+# the achievements and docs only changes a few times a year,
+# so they're kept in memory and refreshed every now and then.
+REFRESH_INTERVAL = 600
+CONTENT_CACHE_CONTROL = "public, max-age=60"
+
+
+@dataclass(slots=True)
+class Encoded:
+    body: bytes
+    etag: str
+
+    @classmethod
+    def encode(cls, data: Any) -> "Encoded":
+        body = orjson.dumps(data)
+        return cls(body=body, etag=make_etag(body))
+
+    def response(self, request: Request) -> Response:
+        headers = {"etag": self.etag, "cache-control": CONTENT_CACHE_CONTROL}
+
+        if etag_matches(request.headers.get("if-none-match"), self.etag):
+            return Response(status_code=304, headers=headers)
+
+        return Response(self.body, media_type="application/json", headers=headers)
+
+
+class StaticContent:
+    """The achievements and docs, with their responses already encoded."""
+
+    def __init__(self) -> None:
+        self.achievements: dict[int, dict[str, Any]] = {}
+        self.all_achievements = Encoded.encode([])
+        self.docs: dict[str, Encoded] = {}
+        self.all_docs = Encoded.encode([])
+
+        self.loaded = False
+        self._lock = asyncio.Lock()
+
+    async def refresh(self) -> None:
+        achievements = await services.database.fetch_all(
+            "SELECT id, name, description, icon FROM achievements"
+        )
+        docs = [
+            dict(doc) for doc in await services.database.fetch_all("SELECT * FROM docs")
+        ]
+
+        # swap everything at once, so requests never see half of a refresh.
+        self.achievements = {
+            achievement["id"]: dict(achievement) for achievement in achievements
+        }
+        self.all_achievements = Encoded.encode(list(self.achievements.values()))
+        self.docs = {doc["url"]: Encoded.encode(doc) for doc in docs}
+        self.all_docs = Encoded.encode(docs)
+        self.loaded = True
+
+        services.logger.info(
+            f"Loaded {len(self.achievements)} achievements and {len(self.docs)} docs."
+        )
+
+    async def ensure_loaded(self) -> None:
+        if self.loaded:
+            return
+
+        async with self._lock:
+            if not self.loaded:
+                await self.refresh()
+
+
+content = StaticContent()
+
+
+@on_invalidation("static_content")
+def _mark_stale(_: str) -> None:
+    # handlers can't wait on the database, so the next request reloads it.
+    content.loaded = False
+
+
+async def static_content_loop(delay: float = 0) -> None:
+    # the content might've been loaded while the worker warmed up.
+    await asyncio.sleep(delay)
+
+    while True:
+        try:
+            await content.refresh()
+        except Exception:
+            services.logger.exception("Failed to refresh the static content.")
+
+        await asyncio.sleep(REFRESH_INTERVAL)
@@ -1,17 +1,17 @@
 import services
 
+from fastapi import Request, Response
 from fastapi.responses import ORJSONResponse
 from app.api import router
+from app.content import content
 
 
 @router.get("/achievements")
-async def get_all_achievements() -> ORJSONResponse:
-    achievements = await services.database.fetch_all(
-        "SELECT id, name, description, icon FROM achievements"
-    )
+async def get_all_achievements(request: Request) -> Response:
+    await content.ensure_loaded()
 
-    if not achievements:
+    if not content.achievements:
         services.logger.critical("no achievements? something is seriously wrong")
         return ORJSONResponse({"error": "no achievements"})
 
-    return ORJSONResponse([dict(achievement) for achievement in achievements])
+    return content.all_achievements.response(request)
@@ -0,0 +1,26 @@
+from fastapi import Depends
+from fastapi.responses import ORJSONResponse
+from app.constants.privileges import Privileges
+from app.content import content
+from app.utilities import UserData, get_privileged_user, publish_invalidation
+
+from app.api import router
+
+
+@router.post("/admin/content/refresh")
+async def refresh_content(
+    current_user: UserData | None = Depends(get_privileged_user),
+) -> ORJSONResponse:
+    if current_user is None or not current_user.privileges & Privileges.ADMIN:
+        return ORJSONResponse({"response": "insufficient permission"}, status_code=401)
+
+    await content.refresh()
+    await publish_invalidation("static_content", "")
+
+    return ORJSONResponse(
+        {
+            "response": "ok",
+            "achievements": len(content.achievements),
+            "docs": len(content.docs),
+        }
+    )
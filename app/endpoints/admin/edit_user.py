@@ -3,8 +3,18 @@ import services
 from fastapi import Depends, Form
 from fastapi.responses import ORJSONResponse
 from app.api import router
+from app.cache import purge_tags
 from app.constants.privileges import Privileges
-from app.utilities import UserData, get_current_user, log
+from app.search import users as user_search
+from app.utilities import (
+    MODES,
+    UserData,
+    get_privileged_user,
+    invalidate_principal,
+    invalidate_profile,
+    load_user,
+    log,
+)
 
 
 @router.post("/edit/user/{user_id}")
@@ -12,7 +22,7 @@ async def edit_user_field(
     user_id: int,
     field: str = Form(),
     value: str | int = Form(),
-    current_user: UserData | None = Depends(get_current_user),
+    current_user: UserData | None = Depends(get_privileged_user),
 ) -> ORJSONResponse:
     # TODO: other fields requires different privileges
     if current_user is None or not current_user.privileges & Privileges.ADMIN:
@@ -27,6 +37,7 @@ async def edit_user_field(
     match field:
         case "username":
             assert type(value) == str
+            old_user = await load_user(user_id)
             query += "username = :username, safe_username = :safe_uname "
             params |= {"username": value, "safe_uname": value.lower().replace(" ", "_")}
 
@@ -54,6 +65,25 @@ async def edit_user_field(
     params["user_id"] = user_id
 
     await services.database.execute(query, params)
+    await invalidate_profile(user_id)
+
+    if field in ("username", "privileges"):
+        await invalidate_principal(user_id)
+
+    # the leaderboards shows the username, and restricted users shouldn't be on them.
+    await purge_tags(
+        f"user:{user_id}",
+        *(
+            f"leaderboard:{gamemode}:{mode}"
+            for gamemode, mode in MODES
+            if field in ("username", "privileges", "country")
+        ),
+    )
+
+    if field == "username" and old_user is not None:
+        await user_search.update_username(
+            user_id, old_user["safe_username"], params["safe_uname"]
+        )
 
     note = f"updated user {user_id}'s {field} to {value:.20}"
     await log(current_user.user_id, note)
@@ -0,0 +1,20 @@
+from fastapi import Depends
+from fastapi.responses import ORJSONResponse
+from app.constants.privileges import Privileges
+from app.jobs import get_job
+from app.utilities import UserData, get_privileged_user
+
+from app.api import router
+
+
+@router.get("/admin/jobs/{job_id}")
+async def job_progress(
+    job_id: str, current_user: UserData | None = Depends(get_privileged_user)
+) -> ORJSONResponse:
+    if current_user is None or not current_user.privileges & Privileges.BAT:
+        return ORJSONResponse({"response": "insufficient permission"}, status_code=401)
+
+    if not (job := await get_job(job_id)):
+        return ORJSONResponse({"error": "job not found"}, status_code=404)
+
+    return ORJSONResponse(job)
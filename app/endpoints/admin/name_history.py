@@ -5,13 +5,13 @@ from fastapi import Depends, Form
 from fastapi.responses import ORJSONResponse
 from app.api import router
 from app.constants.privileges import Privileges
-from app.utilities import UserData, get_current_user, log
+from app.utilities import UserData, get_privileged_user, invalidate_profile, log
 
 
 @router.get("/admin/names/{user_id}")
 async def changed_name_history(
     user_id: int,
-    current_user: UserData = Depends(get_current_user),
+    current_user: UserData = Depends(get_privileged_user),
     sorting: str = "descending",
 ) -> ORJSONResponse:
     if current_user is None or not current_user.privileges & Privileges.MODERATOR:
@@ -34,7 +34,7 @@ async def changed_name_history(
 
 @router.delete("/admin/names/{name_id}")
 async def delete_name_history(
-    name_id: int, current_user: UserData = Depends(get_current_user)
+    name_id: int, current_user: UserData = Depends(get_privileged_user)
 ) -> ORJSONResponse:
     if current_user is None or not current_user.privileges & Privileges.MODERATOR:
         return ORJSONResponse({"error": "insufficient permission"})
@@ -51,6 +51,7 @@ async def delete_name_history(
     await services.database.execute(
         "DELETE FROM name_history WHERE id = :name_id", {"name_id": name_id}
     )
+    await invalidate_profile(data["user_id"])
 
     readable_date = datetime.strftime(
         datetime.fromtimestamp(data["date"]), "%d/%m/%Y %H:%M:%S"
@@ -72,7 +73,7 @@ async def add_name_history(
     changed_from: str = Form(),
     changed_username: str = Form(),
     date: int = Form(),
-    current_user: UserData = Depends(get_current_user),
+    current_user: UserData = Depends(get_privileged_user),
 ) -> ORJSONResponse:
     if current_user is None or not current_user.privileges & Privileges.MODERATOR:
         return ORJSONResponse({"error": "insufficient permission"})
@@ -88,6 +89,7 @@ async def add_name_history(
             "date": date,
         },
     )
+    await invalidate_profile(user_id)
 
     readable_date = datetime.strftime(datetime.fromtimestamp(date), "%d/%m/%Y %H:%M:%S")
 
@@ -0,0 +1,38 @@
+from fastapi import Depends, Query
+from fastapi.responses import ORJSONResponse
+from app.constants.privileges import Privileges
+from app.metrics import SLOW_QUERY_MS, query_stats
+from app.utilities import UserData, get_privileged_user
+
+from app.api import router
+
+
+@router.get("/admin/queries")
+async def slow_queries(
+    sort: str = Query("total"),
+    limit: int = Query(20, ge=1, le=200),
+    current_user: UserData | None = Depends(get_privileged_user),
+) -> ORJSONResponse:
+    if current_user is None or not current_user.privileges & Privileges.ADMIN:
+        return ORJSONResponse({"response": "insufficient permission"}, status_code=401)
+
+    keys = {
+        "total": lambda stats: stats.total_time,
+        "max": lambda stats: stats.max_time,
+        "count": lambda stats: stats.count,
+        "slow": lambda stats: stats.slow,
+    }
+
+    if sort not in keys:
+        return ORJSONResponse({"error": "invalid sorting"})
+
+    # the stats are per worker.
+    top = sorted(query_stats.values(), key=keys[sort], reverse=True)[:limit]
+
+    return ORJSONResponse(
+        {
+            "slow_query_ms": SLOW_QUERY_MS,
+            "fingerprints": len(query_stats),
+            "queries": [stats.to_dict() for stats in top],
+        }
+    )
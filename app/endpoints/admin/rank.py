@@ -1,59 +1,214 @@
+from functools import partial
+from typing import Any
+
 from fastapi import Depends, Form
 from fastapi.responses import ORJSONResponse
 from app.constants.approved import Approved
+from app.cache import purge_tags
 from app.constants.privileges import Privileges
-from app.utilities import UserData, get_current_user, log
+from app.jobs import start_job
+from app.jobs.recalculate import recalculate
+from app.objects.beatmaps import Beatmap
+from app.replicas import stick_to_primary
+from app.search.beatmaps import set_statuses
+from app.utilities import UserData, get_privileged_user, log, log_many
+from pydantic import BaseModel
 import services
 
 from app.api import router
 
+# every status a beatmap can be given, ignoring the update value.
+RANKABLE_STATUSES = (-2, -1, 0, 2, 3, 4, 5)
+MAX_BULK_BEATMAPS = 500
+
+
+def status_note(
+    artist: str, title: str, version: str, old_status: Approved, new_status: Approved
+) -> str:
+    return (
+        f"has updated {artist} - {title} ({version})'s "
+        f"ranked status from {old_status.name.lower()} to {new_status.name.lower()}"
+    )
+
 
 @router.post("/admin/rank")
 async def users_friendlist(
     map_md5: str = Form(),
     new_status: int = Form(),
-    current_user: UserData | None = Depends(get_current_user),
+    current_user: UserData | None = Depends(get_privileged_user),
 ) -> ORJSONResponse:
     if current_user is None or not current_user.privileges & Privileges.BAT:
         return ORJSONResponse({"response": "insufficient permission"}, status_code=401)
 
+    # the current status decides what's done (and logged), a lagging replica
+    # could still have the old one, if the beatmap was just ranked.
+    stick_to_primary()
+
     # ensure the beatmap even exists.
-    if not (
-        beatmap := await services.database.fetch_one(
-            "SELECT approved, title, artist, version FROM beatmaps WHERE map_md5 = :map_md5",
-            {"map_md5": map_md5},
-        )
-    ):
+    if not (beatmap := await Beatmap.from_sql(map_md5=map_md5)):
         return ORJSONResponse({"error": "beatmap doesn't exist."}, status_code=404)
 
+    assert type(beatmap) == Beatmap
+
     # ensure the status is possible, ignoring the update value.
-    if new_status not in (-2, -1, 0, 2, 3, 4, 5):
+    if new_status not in RANKABLE_STATUSES:
         return ORJSONResponse({"error": "invalid status"}, status_code=400)
 
     ranked_status = Approved(new_status)
 
     # just ignore the request, if the status is the same.
-    if ranked_status == Approved(beatmap["approved"]):
+    if ranked_status == Approved(beatmap.approved):
         return ORJSONResponse({"response": "ignoring"})
 
-    # if the new status doesn't award pp, make sure
-    # we update all scores on the beatmap where the
-    # awards pp field is set to true.
-    if not ranked_status.awards_pp:
-        await services.database.execute(
-            "UPDATE scores SET awards_pp = 0 WHERE map_md5 = :map_md5",
-            {"map_md5": map_md5},
-        )
-
     await services.database.execute(
         "UPDATE beatmaps SET approved = :approved WHERE map_md5 = :map_md5",
         {"approved": ranked_status.value, "map_md5": map_md5},
     )
+    await set_statuses({map_md5: ranked_status.value})
+    await purge_tags(f"beatmap:{beatmap.map_id}")
+
+    # the scores only has to be updated, if the beatmap
+    # went from awarding pp to not awarding it, or back.
+    job_id = None
+    if ranked_status.awards_pp != Approved(beatmap.approved).awards_pp:
+        job_id = await start_job(
+            "recalculate",
+            partial(recalculate, map_md5s=[map_md5]),
+            lock="recalculate",
+            map_md5=map_md5,
+        )
 
     await log(
         user_id=current_user.user_id,
-        note=f"has updated {beatmap["artist"]} - {beatmap["title"]} ({beatmap["version"]})'s "
-        f"ranked status from {Approved(beatmap["approved"]).name.lower()} to {ranked_status.name.lower()}",
+        note=status_note(
+            beatmap.artist,
+            beatmap.title,
+            beatmap.version,
+            Approved(beatmap.approved),
+            ranked_status,
+        ),
+    )
+
+    return ORJSONResponse({"response": "ok", "job_id": job_id})
+
+
+class BulkRank(BaseModel):
+    # ranks every beatmap of the set with `status`,
+    set_id: int | None = None
+    status: int | None = None
+    # and/or the beatmaps with their own status (map_md5 -> status).
+    beatmaps: dict[str, int] = {}
+
+
+@router.post("/admin/rank/bulk")
+async def bulk_rank(
+    bulk: BulkRank,
+    current_user: UserData | None = Depends(get_privileged_user),
+) -> ORJSONResponse:
+    if current_user is None or not current_user.privileges & Privileges.BAT:
+        return ORJSONResponse({"response": "insufficient permission"}, status_code=401)
+
+    if bulk.set_id is None and not bulk.beatmaps:
+        return ORJSONResponse({"error": "no beatmaps given"}, status_code=400)
+
+    if bulk.set_id is not None and bulk.status is None:
+        return ORJSONResponse({"error": "set status not given"}, status_code=400)
+
+    if len(bulk.beatmaps) > MAX_BULK_BEATMAPS:
+        return ORJSONResponse({"error": "too many beatmaps"}, status_code=400)
+
+    if any(
+        status not in RANKABLE_STATUSES
+        for status in (*bulk.beatmaps.values(), bulk.status)
+        if status is not None
+    ):
+        return ORJSONResponse({"error": "invalid status"}, status_code=400)
+
+    # validate every beatmap with a single query.
+    conditions = []
+    params: dict[str, Any] = {}
+
+    if bulk.set_id is not None:
+        conditions.append("set_id = :set_id")
+        params["set_id"] = bulk.set_id
+
+    if bulk.beatmaps:
+        conditions.append("map_md5 IN :map_md5s")
+        params["map_md5s"] = list(bulk.beatmaps)
+
+    beatmaps = await services.database.fetch_all(
+        "SELECT map_md5, map_id, set_id, artist, title, version, approved FROM beatmaps "
+        f"WHERE {" OR ".join(conditions)}",
+        params,
     )
+    found = {beatmap["map_md5"]: beatmap for beatmap in beatmaps}
+
+    if missing := [map_md5 for map_md5 in bulk.beatmaps if map_md5 not in found]:
+        return ORJSONResponse(
+            {"error": "beatmaps doesn't exist.", "beatmaps": missing}, status_code=404
+        )
+
+    if bulk.set_id is not None and not any(
+        beatmap["set_id"] == bulk.set_id for beatmap in beatmaps
+    ):
+        return ORJSONResponse({"error": "beatmap set doesn't exist."}, status_code=404)
+
+    # map_md5 -> (old status, new status), leaving out the unchanged beatmaps.
+    changes: dict[str, tuple[Approved, Approved]] = {}
+
+    for map_md5, beatmap in found.items():
+        new_status = Approved(bulk.beatmaps.get(map_md5, bulk.status))
+        old_status = Approved(beatmap["approved"])
 
-    return ORJSONResponse({"response": "ok"})
+        if new_status != old_status:
+            changes[map_md5] = (old_status, new_status)
+
+    if not changes:
+        return ORJSONResponse({"response": "ignoring"})
+
+    by_status: dict[Approved, list[str]] = {}
+    for map_md5, (_, new_status) in changes.items():
+        by_status.setdefault(new_status, []).append(map_md5)
+
+    async with services.database.transaction():
+        for new_status, map_md5s in by_status.items():
+            await services.database.execute(
+                "UPDATE beatmaps SET approved = :approved WHERE map_md5 IN :map_md5s",
+                {"approved": new_status.value, "map_md5s": map_md5s},
+            )
+
+    await log_many(
+        current_user.user_id,
+        [
+            status_note(
+                found[map_md5]["artist"],
+                found[map_md5]["title"],
+                found[map_md5]["version"],
+                *change,
+            )
+            for map_md5, change in changes.items()
+        ],
+    )
+
+    await set_statuses(
+        {map_md5: new_status.value for map_md5, (_, new_status) in changes.items()}
+    )
+    await purge_tags(*(f"beatmap:{found[map_md5]["map_id"]}" for map_md5 in changes))
+
+    # a single recalculation for every beatmap, that started or stopped awarding pp.
+    job_id = None
+    if pp_changes := {
+        map_md5: new_status.awards_pp
+        for map_md5, (old_status, new_status) in changes.items()
+        if old_status.awards_pp != new_status.awards_pp
+    }:
+        job_id = await start_job(
+            "recalculate",
+            partial(recalculate, map_md5s=list(pp_changes)),
+            lock="recalculate",
+            beatmaps=len(pp_changes),
+        )
+
+    return ORJSONResponse(
+        {"response": "ok", "updated": list(changes), "job_id": job_id}
+    )
@@ -3,42 +3,125 @@ from urllib.parse import unquote
 
 from fastapi import Depends, Query
 from app.constants.privileges import Privileges
-from app.utilities import UserData, get_current_user
+from app.search import users as user_search
+from app.utilities import UserData, decode_cursor, get_privileged_user, next_cursor
 import services
 
 from fastapi.responses import ORJSONResponse
 from app.api import router
 
 
+async def _indexed_users(
+    user_ids: list[int], entries: int, offset: int
+) -> ORJSONResponse:
+    page_ids = user_ids[offset : offset + entries]
+    users = []
+
+    if page_ids:
+        users = await services.database.fetch_all(
+            "SELECT username, id, country, privileges, registered_time, privileges "
+            "FROM users WHERE id IN :user_ids",
+            {"user_ids": page_ids},
+        )
+
+    # keep the order of the search index.
+    users = sorted(users, key=lambda user: page_ids.index(user["id"]))
+
+    return ORJSONResponse(
+        {
+            "max_pages": math.ceil(len(user_ids) / entries),
+            "max_users": len(user_ids),
+            "users": [dict(user) for user in users],
+        }
+    )
+
+
 @router.get("/admin/users")
 async def admin_users(
     search: str = Query(""),
     country: str = Query(""),
     entries: int = Query(50, ge=1),
     page: int = Query(1, ge=1),
-    current_user: UserData | None = Depends(get_current_user),
+    cursor: str | None = Query(None),
+    current_user: UserData | None = Depends(get_privileged_user),
 ) -> ORJSONResponse:
     if current_user is None or not current_user.privileges & Privileges.MODERATOR:
         return ORJSONResponse({"error": "insufficient permission"})
 
     safe_search = unquote(search).lower().replace(" ", "_")
     offset = (page - 1) * entries
-    query = "SELECT username, id, country, privileges, registered_time, privileges FROM users WHERE safe_username LIKE :search "
-    count_query = "SELECT COUNT(*) FROM users WHERE safe_username LIKE :search "
-    params = {"search": f"%{safe_search}%"}
+    where = "WHERE 1 "
+    params = {}
+
+    if safe_search:
+        user_ids = await user_search.search(safe_search)
+
+        # the matches are paged in their ranked order, unless they're filtered further.
+        if user_ids is not None and not country and cursor is None:
+            return await _indexed_users(user_ids, entries, offset)
+
+        # the index hasn't been built yet.
+        if user_ids is None:
+            where += "AND safe_username LIKE :search "
+            params["search"] = f"%{safe_search}%"
+        elif not user_ids:
+            if cursor is not None:
+                return ORJSONResponse({"users": [], "next_cursor": None})
+
+            return ORJSONResponse({"max_pages": 0, "max_users": 0, "users": []})
+        else:
+            where += "AND id IN :user_ids "
+            params["user_ids"] = user_ids
 
     if country:
-        query += "AND country = :country "
-        count_query += "AND country = :country "
+        where += "AND country = :country "
         params["country"] = country
 
-    query += "LIMIT :limit OFFSET :offset"
-    params |= {"limit": entries, "offset": offset}
-    users = await services.database.fetch_all(query, params)
+    if cursor is not None:
+        query = (
+            "SELECT username, id, country, privileges, registered_time, privileges "
+            f"FROM users {where}"
+        )
+
+        if cursor:
+            if not (last := decode_cursor(cursor, size=1)):
+                return ORJSONResponse({"error": "invalid cursor"}, status_code=400)
+
+            query += "AND id > :cursor_id "
+            params["cursor_id"] = last[0]
 
-    params.pop("limit")
-    params.pop("offset")
-    max_users_from_search = await services.database.fetch_val(count_query, params)
+        query += "ORDER BY id ASC LIMIT :limit"
+        params["limit"] = entries
+        users = [
+            dict(user) for user in await services.database.fetch_all(query, params)
+        ]
+
+        return ORJSONResponse(
+            {"users": users, "next_cursor": next_cursor(users, entries, "id")}
+        )
+
+    # the total is counted in the same query, instead of running the search twice.
+    users = [
+        dict(user)
+        for user in await services.database.fetch_all(
+            "SELECT username, id, country, privileges, registered_time, privileges, "
+            f"COUNT(*) OVER () AS total FROM users {where}LIMIT :limit OFFSET :offset",
+            params | {"limit": entries, "offset": offset},
+        )
+    ]
+
+    if users:
+        max_users_from_search = users[0]["total"]
+    elif offset:
+        # past the last page, so the total has to be counted separately.
+        max_users_from_search = await services.database.fetch_val(
+            f"SELECT COUNT(*) FROM users {where}", params
+        )
+    else:
+        max_users_from_search = 0
+
+    for user in users:
+        user.pop("total")
 
     max_pages = math.ceil(max_users_from_search / entries)
 
@@ -46,6 +129,6 @@ async def admin_users(
         {
             "max_pages": max_pages,
             "max_users": max_users_from_search,
-            "users": [dict(user) for user in users],
+            "users": users,
         }
     )
@@ -1,24 +1,90 @@
 import hashlib
 import os
-import bcrypt
 import jwt
 import services
 
-from fastapi import Form
+from fastapi import Form, Request
 from datetime import datetime, timedelta
 
 from fastapi.responses import ORJSONResponse
 from app.api import router
 
 from app.constants.privileges import Privileges
+from app.utilities import check_password
+
+# login attempts allowed, within the window, before any more gets
+# rejected without even looking at the password.
+LOGIN_WINDOW = 900
+MAX_FAILED_LOGINS_PER_IP = 20
+MAX_FAILED_LOGINS_PER_USERNAME = 10
+# X-Real-IP is only trusted from the reverse proxies in here,
+# anyone else could just make up a new address for every attempt.
+TRUSTED_PROXIES = {
+    proxy.strip()
+    for proxy in (os.getenv("RAGNAROK_TRUSTED_PROXIES") or "").split(",")
+    if proxy.strip()
+}
+
+
+def client_ip(request: Request) -> str:
+    ip = request.client.host if request.client else "unknown"
+
+    if ip in TRUSTED_PROXIES:
+        return request.headers.get("X-Real-IP") or ip
+
+    return ip
+
+
+def failed_login_keys(request: Request, safe_username: str) -> tuple[str, str]:
+    return (
+        f"ragnarok:api:login:ip:{client_ip(request)}",
+        f"ragnarok:api:login:user:{safe_username}",
+    )
+
+
+async def take_login_attempt(keys: tuple[str, str]) -> list[int]:
+    """Counts the attempt before it's made, so concurrent attempts
+    can't all slip through. Returns the attempts made within the window."""
+    async with services.redis.pipeline() as pipe:
+        for key in keys:
+            # the window starts with the first attempt, later ones don't extend it.
+            pipe.set(key, 0, nx=True, ex=LOGIN_WINDOW)
+            pipe.incr(key)
+
+        return (await pipe.execute())[1::2]
+
+
+async def return_login_attempt(keys: tuple[str, str]) -> None:
+    """Only failed attempts are limited, so the others are given back."""
+    async with services.redis.pipeline() as pipe:
+        for key in keys:
+            # the window might've just ended, the key shouldn't outlive it then.
+            pipe.set(key, 0, nx=True, ex=LOGIN_WINDOW)
+            pipe.decr(key)
+
+        await pipe.execute()
 
 
 @router.post("/auth/token")
 async def create_token(
+    request: Request,
     username: str = Form(),
     password: bytes = Form(),
 ) -> ORJSONResponse:
     safe_username = username.lower().replace(" ", "_")
+
+    keys = failed_login_keys(request, safe_username)
+    ip_attempts, username_attempts = await take_login_attempt(keys)
+
+    if (
+        ip_attempts > MAX_FAILED_LOGINS_PER_IP
+        or username_attempts > MAX_FAILED_LOGINS_PER_USERNAME
+    ):
+        return ORJSONResponse(
+            {"error": "Too many login attempts, please try again later."},
+            status_code=429,
+        )
+
     user = await services.database.fetch_one(
         "SELECT id, username, passhash, privileges  FROM users WHERE safe_username = :safe_username",
         {"safe_username": safe_username},
@@ -30,12 +96,21 @@ async def create_token(
             status_code=401,
         )
 
-    if not bcrypt.checkpw(password, user["passhash"].encode()):
+    if (correct := await check_password(password, user["passhash"].encode())) is None:
+        await return_login_attempt(keys)
+        return ORJSONResponse(
+            {"error": "The server is busy, please try again later."},
+            status_code=503,
+        )
+
+    if not correct:
         return ORJSONResponse(
             {"error": "You have entered an incorrect username or password."},
             status_code=401,
         )
 
+    await return_login_attempt(keys)
+
     ctx = {
         "username": user["username"],
         "privileges": user["privileges"],
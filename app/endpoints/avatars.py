@@ -0,0 +1,35 @@
+from fastapi import Request, Response
+from fastapi.responses import ORJSONResponse
+
+from app import avatars
+from app.api import router
+from app.utilities import etag_matches
+
+# avatars rarely change, so browsers can keep them for a
+# while and revalidate them with the etag afterwards. a stale
+# one is only shown for a few minutes, while it's revalidated.
+AVATAR_CACHE_CONTROL = "public, max-age=3600, stale-while-revalidate=300"
+
+
+@router.get("/avatar/{user_id}")
+async def get_avatar(
+    request: Request, user_id: int, size: int = avatars.AVATAR_SIZES[0]
+) -> Response:
+    if size not in avatars.AVATAR_SIZES:
+        return ORJSONResponse({"error": "invalid size"}, status_code=400)
+
+    webp = "image/webp" in request.headers.get("accept", "")
+
+    if not (avatar := await avatars.get_avatar(user_id, size, webp)):
+        return ORJSONResponse({"error": "avatar not found"}, status_code=404)
+
+    headers = {
+        "etag": avatar.etag,
+        "cache-control": AVATAR_CACHE_CONTROL,
+        "vary": "Accept",
+    }
+
+    if etag_matches(request.headers.get("if-none-match"), avatar.etag):
+        return Response(status_code=304, headers=headers)
+
+    return Response(avatar.data, media_type=avatar.media_type, headers=headers)
@@ -1,9 +1,13 @@
 from fastapi import Depends
 from fastapi import Query
 from fastapi.responses import ORJSONResponse
+from app import friends
 from app.api import router
+from app.cache import cached
+from app.constants.mods import Mods
 from app.objects.beatmaps import Beatmap
-from app.utilities import ModeAndGamemode, UserData, get_current_user
+from app.search.beatmaps import MAX_RESULTS, index as beatmap_index
+from app.utilities import LazyUser, ModeAndGamemode, get_lazy_user
 import services
 
 
@@ -38,16 +42,67 @@ async def beatmap(map_id: int):
     return from_sql
 
 
+@router.get("/beatmap/search")
+async def search_beatmaps(
+    query: str = Query(""),
+    mode: int | None = Query(None, ge=0, le=3),
+    status: int | None = Query(None),
+    min_stars: float = Query(0, ge=0),
+    max_stars: float | None = Query(None, ge=0),
+    min_bpm: float = Query(0, ge=0),
+    max_bpm: float | None = Query(None, ge=0),
+    page: int = Query(1, ge=1, le=MAX_RESULTS // 50),
+) -> ORJSONResponse:
+    if not beatmap_index.built:
+        return ORJSONResponse(
+            {"error": "beatmap search isn't ready yet."}, status_code=503
+        )
+
+    results = beatmap_index.search(
+        query,
+        mode=mode,
+        approved=status,
+        min_stars=min_stars,
+        max_stars=max_stars,
+        min_bpm=min_bpm,
+        max_bpm=max_bpm,
+    )
+    offset = (page - 1) * 50
+
+    return ORJSONResponse(
+        {
+            "count": len(results),
+            "beatmaps": [
+                beatmap.to_dict() for beatmap in results[offset : offset + 50]
+            ],
+        }
+    )
+
+
 @router.get("/beatmap/scores/{map_id}")
+# only the overall leaderboard is the same for everyone.
+@cached(
+    ttl=30,
+    vary=("map_id", "typeof", "mods", "info.gamemode", "info.mode"),
+    tags=("beatmap:{map_id}",),
+    when=lambda params: params["typeof"] == "overall" and not params["personal"],
+)
 async def scores(
     map_id: int,
     typeof: str = Query("overall"),
+    personal: bool = Query(False),
+    mods: int | None = Query(None, ge=0),
     info: ModeAndGamemode = Depends(ModeAndGamemode.parse),
-    current_user: UserData | None = Depends(get_current_user),
+    lazy_user: LazyUser = Depends(get_lazy_user),
 ) -> ORJSONResponse:
     if typeof not in ("overall", "friends", "country", "local"):
         return ORJSONResponse({"error": "invalid leaderboard type"})
 
+    # the overall leaderboard doesn't need to know who's asking.
+    current_user = (
+        await lazy_user.resolve() if typeof != "overall" or personal else None
+    )
+
     # i ran into some problems when using joins or subqueries
     # to get the map_md5 with map_id as identifier.
     subquery = """
@@ -57,7 +112,7 @@ async def scores(
     WHERE map_id = :map_id
     """
     subparams = {"map_id": map_id}
-    map_md5 = await services.database.fetch_val(subquery, subparams)
+    map_md5 = await services.replica.fetch_val(subquery, subparams)
 
     if not map_md5:
         return ORJSONResponse({"error": "beatmap not found"})
@@ -86,12 +141,16 @@ async def scores(
     # AND `m`.`status` = 3
     # """
 
-    query = """
-    SELECT
+    columns = """
         `s`.`id`, `s`.`user_id`, `u`.`username`, `u`.`country`, `s`.`score`, `s`.`pp`,
         `s`.`count_300`, `s`.`count_100`, `s`.`count_50`, `s`.`count_geki`,
         `s`.`count_katu`, `s`.`count_miss`, `s`.`max_combo`, `s`.`perfect`,
         `s`.`rank`, `s`.`mods`, `s`.`submitted`, `s`.`accuracy`
+    """
+
+    # everything after the selected columns, so the ranked
+    # query below can select from the same rows.
+    query = """
     FROM `scores` `s`
     INNER JOIN `users` `u`
         ON `u`.`id` = `s`.`user_id`
@@ -119,10 +178,15 @@ async def scores(
         """
 
     if typeof == "friends" and current_user:
+        if not (friend_ids := await friends.get_friends(current_user.user_id)):
+            return ORJSONResponse(
+                {"scores": [], "personal_best": None} if personal else []
+            )
+
         query += """
-        AND `u`.`id` IN (SELECT `user_id2` FROM `friends` WHERE `user_id1` = :user_id)
+        AND `u`.`id` IN :friend_ids
         """
-        params["user_id"] = current_user.user_id
+        params["friend_ids"] = list(friend_ids)
 
     if typeof == "country" and current_user:
         query += """
@@ -130,6 +194,54 @@ async def scores(
         """
         params["user_id"] = current_user.user_id
 
-    query += f"ORDER BY `s`.`{info.gamemode.score_order}` DESC LIMIT 50"
-    data = await services.database.fetch_all(query, params)
-    return ORJSONResponse([dict(d) for d in data])
+    if mods is not None:
+        # exact mods only, relax scores always carry the relax mod,
+        # so the filter shouldn't require the user to send it.
+        # the (map_md5, mode, gamemode, status, mods) index keeps this a range seek.
+        query += """
+        AND `s`.`mods` IN :mods
+        """
+        params["mods"] = (mods, mods | Mods.RELAX)
+
+    # the oldest score wins ties, so positions are the same on every request.
+    order = f"`s`.`{info.gamemode.score_order}` DESC, `s`.`id` ASC"
+
+    if not personal:
+        data = await services.replica.fetch_all(
+            f"SELECT {columns} {query} ORDER BY {order} LIMIT 50", params
+        )
+        return ORJSONResponse([dict(d) for d in data])
+
+    if typeof == "local" or not current_user:
+        data = await services.replica.fetch_all(
+            f"SELECT {columns} {query} ORDER BY {order} LIMIT 50", params
+        )
+        return ORJSONResponse(
+            {"scores": [dict(d) for d in data], "personal_best": None}
+        )
+
+    # number every row of the leaderboard in the same pass, and only
+    # keep the top 50 plus the current users best, wherever it is.
+    ranked_query = f"""
+    SELECT * FROM (
+        SELECT ROW_NUMBER() OVER (ORDER BY {order}) AS `position`, {columns} {query}
+    ) `ranked`
+    WHERE `ranked`.`position` <= 50 OR `ranked`.`user_id` = :current_user_id
+    ORDER BY `ranked`.`position` ASC
+    """
+    params["current_user_id"] = current_user.user_id
+    data = await services.replica.fetch_all(ranked_query, params)
+
+    scores = []
+    personal_best = None
+
+    for _row in data:
+        row = dict(_row)
+
+        if row["user_id"] == current_user.user_id:
+            personal_best = dict(row)
+
+        if row.pop("position") <= 50:
+            scores.append(row)
+
+    return ORJSONResponse({"scores": scores, "personal_best": personal_best})
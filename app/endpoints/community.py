@@ -3,10 +3,16 @@ import services
 from fastapi import Depends, Query
 from fastapi.responses import ORJSONResponse
 from app.api import router
+from app.cache import cached
 from app.utilities import ModeAndGamemode
 
 
 @router.get("/community/leaderboard")
+@cached(
+    ttl=30,
+    vary=("sort", "page", "country", "info.gamemode", "info.mode"),
+    tags=("leaderboard:{info.gamemode}:{info.mode}",),
+)
 async def leaderboard(
     sort: str = Query("pp"),
     page: int = Query(1, ge=1),
@@ -37,7 +43,7 @@ async def leaderboard(
 
     user_id_range = _user_id_range[offset:limit]
 
-    _users = await services.database.fetch_all(
+    _users = await services.replica.fetch_all(
         f"SELECT u.id, u.username, u.country, u.latest_activity_time, s.{info.mode.to_db("pp")}, "
         f"s.{info.mode.to_db("ranked_score")}, s.{info.mode.to_db("total_score")}, s.{info.mode.to_db("level")}, "
         f"s.{info.mode.to_db("accuracy")}, s.{info.mode.to_db("playcount")}, s.{info.mode.to_db("total_hits")} "
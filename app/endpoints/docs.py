@@ -1,25 +1,24 @@
-import services
+from fastapi import Request, Response
 from fastapi.responses import ORJSONResponse
 from app.api import router
+from app.content import content
 
 
 @router.get("/docs")
-async def get_all_docs() -> ORJSONResponse:
-    docs = await services.database.fetch_all("SELECT * FROM docs")
+async def get_all_docs(request: Request) -> Response:
+    await content.ensure_loaded()
 
-    if not docs:
+    if not content.docs:
         return ORJSONResponse({"error": "what the sigma"})
 
-    return ORJSONResponse([dict(doc) for doc in docs])
+    return content.all_docs.response(request)
 
 
 @router.get("/docs/get/{url}")
-async def get_doc(url: str) -> ORJSONResponse:
-    doc = await services.database.fetch_one(
-        "SELECT * FROM docs WHERE url = :url", {"url": url}
-    )
+async def get_doc(request: Request, url: str) -> Response:
+    await content.ensure_loaded()
 
-    if not doc:
+    if not (doc := content.docs.get(url)):
         return ORJSONResponse({"error": "doc not found"}, status_code=404)
 
-    return ORJSONResponse(dict(doc))
+    return doc.response(request)
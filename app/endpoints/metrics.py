@@ -0,0 +1,131 @@
+import hmac
+import os
+
+from fastapi import Header, Response
+from fastapi.responses import ORJSONResponse, PlainTextResponse
+
+import services
+from app import avatars, cache
+from app.api import router
+from app.metrics import registry, startup_timings
+from app.utilities import log_buffer_stats, password_pool_stats
+
+# scrapers has to send it as a bearer token, the metrics
+# aren't served at all if it isn't set.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+
+@registry.gauge(
+    "ragnarok_db_pool_connections",
+    "Connections in the database pool, by state.",
+    ("state",),
+)
+def _database_pool() -> dict[tuple[str, ...], float]:
+    pool = services.database._backend._pool  # type: ignore
+    if pool is None:
+        return {}
+
+    return {
+        ("used",): pool.size - pool.freesize,
+        ("free",): pool.freesize,
+        ("max",): pool.maxsize,
+    }
+
+
+@registry.gauge(
+    "ragnarok_db_replica_lag_seconds",
+    "How far behind the primary each replica is, -1 if it can't tell.",
+    ("replica",),
+)
+def _replica_lag() -> dict[tuple[str, ...], float]:
+    return {
+        (replica.name,): -1 if replica.lag is None else replica.lag
+        for replica in services.replica.replicas
+    }
+
+
+@registry.gauge(
+    "ragnarok_db_replica_healthy",
+    "Whether the replica is in rotation.",
+    ("replica",),
+)
+def _replica_healthy() -> dict[tuple[str, ...], float]:
+    return {(replica.name,): replica.healthy for replica in services.replica.replicas}
+
+
+@registry.gauge(
+    "ragnarok_redis_pool_connections",
+    "Connections in the redis pool, by state.",
+    ("state",),
+)
+def _redis_pool() -> dict[tuple[str, ...], float]:
+    pool = services.redis.connection_pool
+
+    return {
+        ("used",): len(pool._in_use_connections),  # type: ignore
+        ("free",): len(pool._available_connections),  # type: ignore
+        ("max",): pool.max_connections,  # type: ignore
+    }
+
+
+@registry.gauge(
+    "ragnarok_password_pool",
+    "Password checks waiting for, or done by the password pool.",
+    ("stat",),
+)
+def _password_pool() -> dict[tuple[str, ...], float]:
+    return {
+        ("pending",): password_pool_stats.pending,
+        ("checks",): password_pool_stats.checks,
+        ("shed",): password_pool_stats.shed,
+        ("queue_seconds",): password_pool_stats.queue_time,
+        ("max_queue_seconds",): password_pool_stats.max_queue_time,
+    }
+
+
+@registry.gauge(
+    "ragnarok_audit_log_buffer",
+    "Audit log entries waiting to be written, and what has been written so far.",
+    ("stat",),
+)
+def _audit_log_buffer() -> dict[tuple[str, ...], float]:
+    return {
+        ("pending",): log_buffer_stats.pending,
+        ("written",): log_buffer_stats.written,
+        ("inline_flushes",): log_buffer_stats.inline_flushes,
+        ("flushes",): log_buffer_stats.flushes,
+        ("failed_flushes",): log_buffer_stats.failed_flushes,
+        ("flush_seconds",): log_buffer_stats.flush_time,
+    }
+
+
+@registry.gauge(
+    "ragnarok_in_process_cache",
+    "Entries (or bytes) held by the in-process caches.",
+    ("cache",),
+)
+def _in_process_caches() -> dict[tuple[str, ...], float]:
+    return {
+        ("avatar_bytes",): avatars.avatar_cache.size,
+        ("response_entries",): len(cache._l1.entries),
+    }
+
+
+@registry.gauge(
+    "ragnarok_startup_seconds",
+    "How long each phase of the workers startup took.",
+    ("phase",),
+)
+def _startup() -> dict[tuple[str, ...], float]:
+    return {(phase,): duration for phase, duration in startup_timings.items()}
+
+
+@router.get("/metrics")
+async def metrics(authorization: str | None = Header(None)) -> Response:
+    if not METRICS_TOKEN:
+        return ORJSONResponse({"error": "metrics are disabled"}, status_code=404)
+
+    if not hmac.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        return ORJSONResponse({"error": "unauthorized"}, status_code=401)
+
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
@@ -8,8 +8,6 @@ from fastapi.responses import ORJSONResponse
 from app.api import router
 from app.utilities import UserData, get_current_user, write_replay
 
-import rina_pp_pyb as rosu
-
 
 @router.get("/score/replay/{score_id}")
 async def download_replay(score_id: int) -> Response:
@@ -31,7 +29,7 @@ async def download_replay(score_id: int) -> Response:
 async def get_score(
     score_id: int, current_user: UserData | None = Depends(get_current_user)
 ):
-    _base = await services.database.fetch_one(
+    _base = await services.replica.fetch_one(
         "SELECT id, mods, user_id, count_300, count_100, count_50, count_miss, count_geki, count_katu, "
         "pp, user_id, accuracy, score, mode, gamemode, submitted, max_combo, perfect, rank, map_md5, mode "
         "FROM scores WHERE id = :score_id",
@@ -64,6 +62,9 @@ async def get_score(
     if not path_to_map.exists():
         await beatmap_info.save_to_directory()
 
+    # the pp calculator is only needed here, so it's imported on the first score.
+    import rina_pp_pyb as rosu
+
     rosu_map = rosu.Beatmap(path=path_to_map.as_posix())
 
     if base["mode"] != beatmap_info.mode:
@@ -97,7 +98,7 @@ async def get_score(
         and current_user.privileges & Privileges.SUPPORTER
         and base["user_id"] == current_user.user_id
     ):
-        viewers = await services.database.fetch_all(
+        viewers = await services.replica.fetch_all(
             "SELECT u.username, u.country, s.user_id, s.timestamp FROM replay_views s "
             "INNER JOIN users u ON u.id = s.user_id WHERE s.score_id = :score_id",
             {"score_id": score_id},
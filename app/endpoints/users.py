@@ -1,12 +1,30 @@
 from datetime import datetime, timedelta
+import time
 from urllib.parse import unquote
 from fastapi import Depends, Query
 from fastapi.responses import ORJSONResponse
-from pydantic import BaseModel
 from app.api import router
+from app.cache import cached
+from app.content import content
 from app.constants.privileges import Privileges
-from app.utilities import ModeAndGamemode, UserData, get_current_user
-
+from app.search import users as user_search
+from app.utilities import (
+    PROFILE_CACHE_TTL,
+    USER_CARD_CACHE_TTL,
+    Grades,
+    ModeAndGamemode,
+    UserData,
+    count_grades,
+    decode_cursor,
+    get_current_user,
+    grades_key,
+    keyset_condition,
+    next_cursor,
+    profile_cache_key,
+    user_card_cache_key,
+)
+
+import orjson
 import services
 
 
@@ -14,136 +32,188 @@ import services
 async def user_info(
     user_id: int,
 ) -> ORJSONResponse:
-    if not (
-        user_info := await services.database.fetch_one(
-            "SELECT username, id, registered_time, latest_activity_time, country, playstyles, "
-            "privileges, userpage_content, preferred_gamemode, preferred_mode, is_verified, "
-            "latest_activity_time FROM users WHERE id = :user_id",
-            {"user_id": user_id},
-        )
-    ):
-        return ORJSONResponse({"error": "user not found."})
+    # the cached profile and the session lives in redis, so
+    # both can be fetched in a single round trip.
+    async with services.redis.pipeline(transaction=False) as pipe:
+        pipe.get(profile_cache_key(user_id))
+        pipe.hgetall(f"ragnarok:session:{user_id}")
+        cached, session = await pipe.execute()
+
+    if cached:
+        data = orjson.loads(cached)
+    else:
+        # it's cached for everyone, so a lagging replica would keep serving an
+        # invalidated profile until it expires, the primary is up to date.
+        if not (
+            user_info := await services.database.fetch_one(
+                "SELECT u.username, u.id, u.registered_time, u.latest_activity_time, u.country, "
+                "u.playstyles, u.privileges, u.userpage_content, u.preferred_gamemode, "
+                "u.preferred_mode, u.is_verified, c.id AS clan_id, c.name AS clan_name, "
+                "c.tag AS clan_tag, c.icon AS clan_icon, ("
+                "SELECT JSON_ARRAYAGG(JSON_OBJECT('changed_from', h.changed_from, "
+                "'changed_username', h.changed_username, 'date', h.date)) "
+                "FROM name_history h WHERE h.user_id = u.id"
+                ") AS name_history FROM users u LEFT JOIN clans c ON c.id = u.clan_id "
+                "WHERE u.id = :user_id",
+                {"user_id": user_id},
+            )
+        ):
+            return ORJSONResponse({"error": "user not found."})
+
+        data = dict(user_info)
 
-    data = dict(user_info)
+        clan = {
+            key: data.pop(f"clan_{key}") for key in ("id", "name", "tag", "icon")
+        }
+        data["clan"] = clan if clan["id"] is not None else {}
 
-    if session := await services.redis.hgetall(f"ragnarok:session:{user_id}"):  # type: ignore
-        session.pop(b"token")
+        name_history = data.pop("name_history")
+        data["name_history"] = orjson.loads(name_history) if name_history else []
+
+        await services.redis.set(
+            profile_cache_key(user_id), orjson.dumps(data), ex=PROFILE_CACHE_TTL
+        )
+
+    if session:
+        session.pop(b"token", None)
         data["session"] = {
             key.decode(): value.decode() for key, value in session.items()
         }
 
-    clan_info = await services.database.fetch_one(
-        "SELECT u.clan_id as id, c.name, c.tag, c.icon FROM users u "
-        "INNER JOIN clans c ON c.id = u.clan_id "
-        "WHERE u.id = :user_id ",
-        {"user_id": user_id},
-    )
+    return ORJSONResponse(data)
 
-    data["clan"] = dict(clan_info) if clan_info else {}
 
-    name_history = await services.database.fetch_all(
-        "SELECT changed_from, changed_username, date FROM name_history WHERE user_id = :user_id",
-        {"user_id": user_id},
-    )
-    data["name_history"] = [dict(name) for name in name_history] if name_history else []
+# longer ranges are downsampled to this many points.
+MAX_HISTORY_POINTS = 90
 
-    return ORJSONResponse(data)
+
+# the most users that can be looked up in a single bulk request.
+MAX_BULK_USERS = 250
+
+
+@router.get("/users/bulk")
+async def bulk_user_info(
+    ids: str = Query(),
+    info: ModeAndGamemode = Depends(ModeAndGamemode.parse),
+) -> ORJSONResponse:
+    # ?ids=1,2,3
+    try:
+        user_ids = list(dict.fromkeys(int(user_id) for user_id in ids.split(",")))
+    except ValueError:
+        return ORJSONResponse({"error": "invalid user ids"}, status_code=400)
+
+    if len(user_ids) > MAX_BULK_USERS:
+        return ORJSONResponse(
+            {"error": f"can't look up more than {MAX_BULK_USERS} users at once"},
+            status_code=400,
+        )
+
+    redis_key = f"ragnarok:leaderboard:{info.gamemode.name.lower()}:{info.mode}"
+
+    # cached cards and ranks, in a single round trip.
+    async with services.redis.pipeline(transaction=False) as pipe:
+        pipe.mget([user_card_cache_key(user_id) for user_id in user_ids])
+        for user_id in user_ids:
+            pipe.zrevrank(redis_key, str(user_id))
+
+        cached_cards, *ranks = await pipe.execute()
+
+    cards = {
+        user_id: orjson.loads(card)
+        for user_id, card in zip(user_ids, cached_cards)
+        if card is not None
+    }
+
+    if missing := [user_id for user_id in user_ids if user_id not in cards]:
+        # the cards are cached, so they're read from the primary, like the profiles.
+        users = await services.database.fetch_all(
+            "SELECT u.id, u.username, u.country, c.tag AS clan_tag FROM users u "
+            "LEFT JOIN clans c ON c.id = u.clan_id WHERE u.id IN :user_ids",
+            {"user_ids": missing},
+        )
+
+        async with services.redis.pipeline(transaction=False) as pipe:
+            for user in users:
+                cards[user["id"]] = dict(user)
+                pipe.set(
+                    user_card_cache_key(user["id"]),
+                    orjson.dumps(cards[user["id"]]),
+                    ex=USER_CARD_CACHE_TTL,
+                )
+
+            await pipe.execute()
+
+    return ORJSONResponse(
+        [
+            cards[user_id] | {"rank": rank + 1 if rank is not None else 0}
+            for user_id, rank in zip(user_ids, ranks)
+            if user_id in cards
+        ]
+    )
 
 
 @router.get("/users/history/{user_id}")
 async def get_user_history(
     user_id: int,
     graph: str = Query(regex="pp|rank"),
+    days: int = Query(90, ge=1, le=3650),
     info: ModeAndGamemode = Depends(ModeAndGamemode.parse),
 ) -> ORJSONResponse:
-    graph_data = await services.database.fetch_all(
+    graph_data = await services.replica.fetch_all(
         f"SELECT {graph} AS value, timestamp FROM profile_history WHERE mode = :mode "
-        "AND gamemode = :gamemode AND user_id = :user_id ORDER BY timestamp DESC "
-        "LIMIT 90",
+        "AND gamemode = :gamemode AND user_id = :user_id AND timestamp >= :since "
+        "ORDER BY timestamp ASC",
         {
             "mode": info.mode,
             "gamemode": info.gamemode,
             "user_id": user_id,
+            "since": int(time.time()) - days * 86400,
         },
     )
 
     if not graph_data:
         return ORJSONResponse([])
 
-    data = [dict(d) for d in graph_data[::-1]]
-    last_type_update = data[-1]
+    data = [dict(d) for d in graph_data]
+
+    if len(data) > MAX_HISTORY_POINTS:
+        # keep the last point of each bucket, so the
+        # graph still ends on the latest snapshot.
+        bucket_size = len(data) / MAX_HISTORY_POINTS
+        data = [
+            data[int((bucket + 1) * bucket_size) - 1]
+            for bucket in range(MAX_HISTORY_POINTS)
+        ]
 
+    # the snapshots are taken once a day, show the live
+    # value on the latest point without writing it back.
     if graph == "pp":
-        should_update = await services.database.fetch_val(
+        current_pp = await services.replica.fetch_val(
             f"SELECT CAST({info.mode.to_db("pp", False)} AS INT) AS pp FROM {info.gamemode.to_db} "
-            f" WHERE id = :user_id AND {info.mode.to_db("pp", False)} != :last_pp ",
-            {
-                "user_id": user_id,
-                "last_pp": last_type_update["value"],
-            },
+            "WHERE id = :user_id",
+            {"user_id": user_id},
         )
 
-        if should_update:
-            await services.database.execute(
-                "UPDATE profile_history SET pp = :new_pp "
-                "WHERE gamemode = :gamemode AND mode = :mode "
-                "AND user_id = :user_id AND timestamp = :timestamp ",
-                {
-                    "new_pp": should_update,
-                    "gamemode": info.gamemode,
-                    "mode": info.mode,
-                    "user_id": user_id,
-                    "timestamp": last_type_update["timestamp"],
-                },
-            )
-
-            last_type_update["value"] = should_update
+        if current_pp is not None:
+            data[-1]["value"] = current_pp
 
     elif graph == "rank":
         _current_global_rank = await services.redis.zrevrank(
             f"ragnarok:leaderboard:{info.gamemode.name.lower()}:{info.mode}",
             str(user_id),
         )
-        current_global_rank = (
+        data[-1]["value"] = (
             _current_global_rank + 1 if _current_global_rank is not None else 0
         )
 
-        if current_global_rank != last_type_update["value"]:
-            await services.database.execute(
-                "UPDATE profile_history SET rank = :new_rank "
-                "WHERE gamemode = :gamemode AND mode = :mode "
-                "AND user_id = :user_id AND timestamp = :timestamp ",
-                {
-                    "new_rank": current_global_rank,
-                    "gamemode": info.gamemode,
-                    "mode": info.mode,
-                    "user_id": user_id,
-                    "timestamp": last_type_update["timestamp"],
-                },
-            )
-
-            last_type_update["value"] = current_global_rank
-
     return ORJSONResponse(data)
 
 
-class Grades(BaseModel):
-    XH: int = 0
-    X: int = 0
-    SH: int = 0
-    S: int = 0
-    A: int = 0
-    B: int = 0
-    C: int = 0
-    D: int = 0
-    F: int = 0
-
-
 @router.get("/users/get/{user_id}/stats")
 async def get_user_stats(
     user_id: int, info: ModeAndGamemode = Depends(ModeAndGamemode.parse)
 ) -> ORJSONResponse:
-    _data = await services.database.fetch_one(
+    _data = await services.replica.fetch_one(
         f"SELECT s.{info.mode.to_db("pp")}, s.{info.mode.to_db("accuracy")}, s.{info.mode.to_db("ranked_score")}, "
         f"s.{info.mode.to_db("total_score")}, s.{info.mode.to_db("playcount")}, s.{info.mode.to_db("playtime")}, "
         f"s.{info.mode.to_db("level")}, s.{info.mode.to_db("max_combo")}, s.{info.mode.to_db("replays_watched_by_others")}, "
@@ -159,23 +229,26 @@ async def get_user_stats(
     global_redis_key = f"ragnarok:leaderboard:{info.gamemode.name.lower()}:{info.mode}"
     country_redis_key = f"ragnarok:leaderboard:{info.gamemode.name.lower()}:{data["country"]}:{info.mode}"
 
-    _global_rank = await services.redis.zrevrank(global_redis_key, str(user_id))
-    global_rank = _global_rank + 1 if _global_rank is not None else 0
+    async with services.redis.pipeline(transaction=False) as pipe:
+        pipe.zrevrank(global_redis_key, str(user_id))
+        pipe.zrevrank(country_redis_key, str(user_id))
+        pipe.hgetall(grades_key(user_id, info.gamemode, info.mode))
+        _global_rank, _country_rank, grade_counter = await pipe.execute()
 
-    _country_rank = await services.redis.zrevrank(country_redis_key, str(user_id))
+    global_rank = _global_rank + 1 if _global_rank is not None else 0
     country_rank = _country_rank + 1 if _country_rank is not None else 0
 
     data["rank"] = {"global": global_rank, "country": country_rank}
 
-    rank_counter = await services.database.fetch_all(
-        "SELECT COUNT(rank) AS count, rank FROM scores WHERE gamemode = :gamemode "
-        "AND mode = :mode AND status = 3 AND user_id = :user_id GROUP BY rank",
-        {"gamemode": info.gamemode, "mode": info.mode, "user_id": user_id},
-    )
+    if grade_counter:
+        grades = Grades(
+            **{grade.decode(): int(count) for grade, count in grade_counter.items()}
+        )
+    else:
+        # counters hasn't been built for this user yet.
+        grades = await count_grades(user_id, info.gamemode, info.mode)
 
-    data["grades"] = Grades(
-        **{grade["rank"]: grade["count"] for grade in rank_counter}
-    ).model_dump()
+    data["grades"] = grades.model_dump()
 
     return ORJSONResponse(dict(data))
 
@@ -184,108 +257,192 @@ async def get_user_stats(
 async def get_user_achievements(
     user_id: int, info: ModeAndGamemode = Depends(ModeAndGamemode.parse)
 ) -> ORJSONResponse:
-    data = await services.database.fetch_all(
-        "SELECT ach.id, ach.name, ach.description, ach.icon FROM users_achievements u_ach "
-        "INNER JOIN achievements ach ON ach.id = u_ach.achievement_id "
-        "WHERE u_ach.user_id = :user_id AND u_ach.gamemode = :gamemode AND u_ach.mode = :mode",
+    await content.ensure_loaded()
+
+    unlocked = await services.replica.fetch_all(
+        "SELECT achievement_id FROM users_achievements "
+        "WHERE user_id = :user_id AND gamemode = :gamemode AND mode = :mode",
         {"user_id": user_id, "gamemode": info.gamemode, "mode": info.mode},
     )
 
-    return ORJSONResponse([dict(achievement) for achievement in data])
+    return ORJSONResponse(
+        [
+            content.achievements[row["achievement_id"]]
+            for row in unlocked
+            if row["achievement_id"] in content.achievements
+        ]
+    )
 
 
 @router.get("/users/get/{user_id}/activities")
 async def get_user_recent_activities(
     user_id: int,
     page: int = Query(1, ge=1),
+    cursor: str | None = Query(None),
     info: ModeAndGamemode = Depends(ModeAndGamemode.parse),
 ) -> ORJSONResponse:
-    offset = 10 * (page - 1)
-
     delimitation = datetime.now() - timedelta(days=7)
 
-    data = await services.database.fetch_all(
+    query = (
         "SELECT a.id, a.activity, b.map_id, b.set_id, b.title, b.artist, b.version, a.timestamp "
         "FROM recent_activities a INNER JOIN beatmaps b ON b.map_md5 = a.map_md5 WHERE a.user_id = :user_id "
-        "AND a.mode = :mode AND a.gamemode = :gamemode AND a.timestamp >= :delimitation ORDER BY a.timestamp DESC "
-        "LIMIT 10 OFFSET :offset ",
-        {
-            "delimitation": delimitation.timestamp(),
-            "user_id": user_id,
-            "mode": info.mode,
-            "gamemode": info.gamemode,
-            "offset": offset,
-        },
+        "AND a.mode = :mode AND a.gamemode = :gamemode AND a.timestamp >= :delimitation "
     )
+    params = {
+        "delimitation": delimitation.timestamp(),
+        "user_id": user_id,
+        "mode": info.mode,
+        "gamemode": info.gamemode,
+    }
+
+    if cursor is None:
+        query += "ORDER BY a.timestamp DESC LIMIT 10 OFFSET :offset "
+        params["offset"] = 10 * (page - 1)
+
+        data = await services.replica.fetch_all(query, params)
+        return ORJSONResponse([dict(activity) for activity in data])
+
+    if cursor:
+        if not (last := decode_cursor(cursor)):
+            return ORJSONResponse({"error": "invalid cursor"}, status_code=400)
+
+        query += f"AND {keyset_condition("a.timestamp", "a.id")} "
+        params |= {"cursor_key": last[0], "cursor_id": last[1]}
 
-    return ORJSONResponse([dict(activity) for activity in data])
+    query += "ORDER BY a.timestamp DESC, a.id DESC LIMIT 10"
+    activities = [
+        dict(activity) for activity in await services.replica.fetch_all(query, params)
+    ]
+
+    return ORJSONResponse(
+        {
+            "activities": activities,
+            "next_cursor": next_cursor(activities, 10, "timestamp", "id"),
+        }
+    )
 
 
 @router.get("/users/scores/{user_id}/best")
+@cached(
+    ttl=60,
+    vary=("user_id", "page", "cursor", "info.gamemode", "info.mode"),
+    tags=("user:{user_id}",),
+)
 async def get_users_best(
     user_id: int,
     page: int = Query(1, ge=1),
+    cursor: str | None = Query(None),
     info: ModeAndGamemode = Depends(ModeAndGamemode.parse),
 ) -> ORJSONResponse:
-    offset = 10 * (page - 1)
-    scores = await services.database.fetch_all(
+    query = (
         "SELECT s.id, b.title, b.artist, b.version, b.set_id, b.map_id, s.submitted, s.max_combo, "
         "s.mods, s.pp, s.accuracy, s.count_miss, s.count_50, s.count_100, s.count_300, s.rank, "
         "s.count_geki, s.count_katu, s.score FROM scores s INNER JOIN beatmaps b ON b.map_md5 = s.map_md5 "
         "WHERE s.status = 3 AND s.awards_pp = 1 AND s.gamemode = :gamemode AND s.mode = :mode "
-        "AND s.user_id = :user_id ORDER BY s.pp DESC LIMIT 10 OFFSET :offset",
-        {
-            "user_id": user_id,
-            "gamemode": info.gamemode,
-            "mode": info.mode,
-            "offset": offset,
-        },
+        "AND s.user_id = :user_id "
     )
+    params = {
+        "user_id": user_id,
+        "gamemode": info.gamemode,
+        "mode": info.mode,
+    }
+
+    if cursor is None:
+        query += "ORDER BY s.pp DESC LIMIT 10 OFFSET :offset"
+        params["offset"] = 10 * (page - 1)
+
+        scores = await services.replica.fetch_all(query, params)
+        return ORJSONResponse([dict(score) for score in scores])
 
-    return ORJSONResponse([dict(score) for score in scores])
+    if cursor:
+        if not (last := decode_cursor(cursor)):
+            return ORJSONResponse({"error": "invalid cursor"}, status_code=400)
+
+        query += f"AND {keyset_condition("s.pp", "s.id", source="scores")} "
+        params |= {"cursor_key": last[0], "cursor_id": last[1]}
+
+    query += "ORDER BY s.pp DESC, s.id DESC LIMIT 10"
+    scores = [dict(score) for score in await services.replica.fetch_all(query, params)]
+
+    return ORJSONResponse(
+        {"scores": scores, "next_cursor": next_cursor(scores, 10, "pp", "id")}
+    )
 
 
 @router.get("/users/scores/{user_id}/recent")
 async def get_users_recent(
     user_id: int,
     page: int = Query(1, ge=1),
+    cursor: str | None = Query(None),
     info: ModeAndGamemode = Depends(ModeAndGamemode.parse),
 ) -> ORJSONResponse:
-    offset = 10 * (page - 1)
-    scores = await services.database.fetch_all(
+    query = (
         "SELECT s.id, b.title, b.artist, b.version, b.set_id, b.map_id, s.submitted, s.max_combo, "
         "s.mods, s.pp, s.accuracy, s.count_miss, s.count_50, s.count_100, s.count_300, s.rank, "
         "s.count_geki, s.count_katu, s.score FROM scores s INNER JOIN beatmaps b ON b.map_md5 = s.map_md5 "
-        "WHERE s.gamemode = :gamemode AND s.mode = :mode AND s.user_id = :user_id ORDER BY s.submitted DESC "
-        "LIMIT 10 OFFSET :offset",
-        {
-            "user_id": user_id,
-            "gamemode": info.gamemode,
-            "mode": info.mode,
-            "offset": offset,
-        },
+        "WHERE s.gamemode = :gamemode AND s.mode = :mode AND s.user_id = :user_id "
     )
+    params = {
+        "user_id": user_id,
+        "gamemode": info.gamemode,
+        "mode": info.mode,
+    }
+
+    if cursor is None:
+        query += "ORDER BY s.submitted DESC LIMIT 10 OFFSET :offset"
+        params["offset"] = 10 * (page - 1)
+
+        scores = await services.replica.fetch_all(query, params)
+        return ORJSONResponse([dict(score) for score in scores])
 
-    return ORJSONResponse([dict(score) for score in scores])
+    if cursor:
+        if not (last := decode_cursor(cursor)):
+            return ORJSONResponse({"error": "invalid cursor"}, status_code=400)
+
+        query += f"AND {keyset_condition("s.submitted", "s.id")} "
+        params |= {"cursor_key": last[0], "cursor_id": last[1]}
+
+    query += "ORDER BY s.submitted DESC, s.id DESC LIMIT 10"
+    scores = [dict(score) for score in await services.replica.fetch_all(query, params)]
+
+    return ORJSONResponse(
+        {"scores": scores, "next_cursor": next_cursor(scores, 10, "submitted", "id")}
+    )
 
 
 @router.get("/users/search")
 async def search_users(query: str) -> ORJSONResponse:
     safe_query = unquote(query).lower().replace(" ", "_")
 
-    users = await services.database.fetch_all(
-        "SELECT username, id, country FROM users "
-        "WHERE safe_username LIKE :query AND privileges & 4 "
-        "LIMIT 10",
-        {"query": f"%{safe_query}%"},
+    user_ids = await user_search.search(safe_query, limit=50)
+
+    # the index hasn't been built yet.
+    if user_ids is None:
+        users = await services.replica.fetch_all(
+            "SELECT username, id, country FROM users "
+            "WHERE safe_username LIKE :query AND privileges & 4 "
+            "LIMIT 10",
+            {"query": f"%{safe_query}%"},
+        )
+
+        return ORJSONResponse([dict(user) for user in users])
+
+    if not user_ids:
+        return ORJSONResponse([])
+
+    users = await services.replica.fetch_all(
+        "SELECT username, id, country FROM users WHERE id IN :user_ids AND privileges & 4",
+        {"user_ids": user_ids},
     )
 
-    return ORJSONResponse([dict(user) for user in users])
+    # keep the order of the search index.
+    users = sorted(users, key=lambda user: user_ids.index(user["id"]))
+    return ORJSONResponse([dict(user) for user in users[:10]])
 
 
 @router.get("/users/exists")
 async def user_exists(username: str) -> ORJSONResponse:
-    user = await services.database.fetch_one(
+    user = await services.replica.fetch_one(
         "SELECT username, id FROM users WHERE safe_username = :query LIMIT 10",
         {"query": unquote(username).lower().replace(" ", "_")},
     )
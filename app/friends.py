@@ -0,0 +1,122 @@
+import services
+
+# the friends table is written to by the game server as well, so
+# the cached sets expires, to pick those changes up eventually.
+FRIENDS_CACHE_TTL = 3600
+
+# every loaded set contains the sentinel, so users without any friends
+# (or followers) don't have to be looked up every time, and sets created
+# by `add_friend` before being loaded are still loaded from sql.
+SENTINEL = b"-"
+
+
+def friends_key(user_id: int) -> str:
+    """The users the user has added as a friend."""
+    return f"ragnarok:api:friends:{user_id}"
+
+
+def followers_key(user_id: int) -> str:
+    """The users who has added the user as a friend."""
+    return f"ragnarok:api:followers:{user_id}"
+
+
+def _members(members: set[bytes]) -> set[int]:
+    return {int(member) for member in members if member != SENTINEL}
+
+
+async def load(user_ids: list[int], force: bool = False) -> None:
+    """Loads the friend and follower sets of the users, which aren't loaded yet."""
+    if force:
+        missing_friends = missing_followers = list(user_ids)
+    else:
+        async with services.redis.pipeline(transaction=False) as pipe:
+            for user_id in user_ids:
+                pipe.sismember(friends_key(user_id), SENTINEL)
+                pipe.sismember(followers_key(user_id), SENTINEL)
+
+            loaded = await pipe.execute()
+
+        missing_friends = [
+            user_id for idx, user_id in enumerate(user_ids) if not loaded[idx * 2]
+        ]
+        missing_followers = [
+            user_id for idx, user_id in enumerate(user_ids) if not loaded[idx * 2 + 1]
+        ]
+
+    sets: dict[str, set[int]] = {}
+
+    if missing_friends:
+        sets |= {friends_key(user_id): set() for user_id in missing_friends}
+
+        for row in await services.database.fetch_all(
+            "SELECT user_id1, user_id2 FROM friends WHERE user_id1 IN :user_ids",
+            {"user_ids": missing_friends},
+        ):
+            sets[friends_key(row["user_id1"])].add(row["user_id2"])
+
+    if missing_followers:
+        sets |= {followers_key(user_id): set() for user_id in missing_followers}
+
+        for row in await services.database.fetch_all(
+            "SELECT user_id1, user_id2 FROM friends WHERE user_id2 IN :user_ids",
+            {"user_ids": missing_followers},
+        ):
+            sets[followers_key(row["user_id2"])].add(row["user_id1"])
+
+    if not sets:
+        return
+
+    async with services.redis.pipeline() as pipe:
+        for key, members in sets.items():
+            pipe.delete(key)
+            pipe.sadd(key, SENTINEL, *members)
+            pipe.expire(key, FRIENDS_CACHE_TTL)
+
+        await pipe.execute()
+
+
+async def get_friends(user_id: int) -> set[int]:
+    await load([user_id])
+
+    return _members(await services.redis.smembers(friends_key(user_id)))  # type: ignore
+
+
+async def get_mutuals(user_id: int) -> set[int]:
+    """The friends of the user, who has added the user back."""
+    await load([user_id])
+
+    return _members(
+        await services.redis.sinter(friends_key(user_id), followers_key(user_id))  # type: ignore
+    )
+
+
+async def friendship_status(user_id: int, target_id: int) -> int:
+    """-1 if the user hasn't added the target, 0 if they have
+    and 1 if the target has added the user back as well."""
+    await load([user_id])
+
+    async with services.redis.pipeline(transaction=False) as pipe:
+        pipe.sismember(friends_key(user_id), target_id)
+        pipe.sismember(followers_key(user_id), target_id)
+        friend, follower = await pipe.execute()
+
+    if not friend:
+        return -1
+
+    return 1 if follower else 0
+
+
+async def add_friend(user_id: int, friend_id: int) -> None:
+    async with services.redis.pipeline() as pipe:
+        pipe.sadd(friends_key(user_id), friend_id)
+        pipe.expire(friends_key(user_id), FRIENDS_CACHE_TTL)
+        pipe.sadd(followers_key(friend_id), user_id)
+        pipe.expire(followers_key(friend_id), FRIENDS_CACHE_TTL)
+        await pipe.execute()
+
+
+async def remove_friend(user_id: int, friend_id: int) -> None:
+    async with services.redis.pipeline() as pipe:
+        pipe.srem(friends_key(user_id), friend_id)
+        pipe.srem(followers_key(friend_id), user_id)
+        await pipe.execute()
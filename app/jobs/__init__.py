@@ -0,0 +1,127 @@
+import asyncio
+import time
+import uuid
+from typing import Any, Awaitable, Callable
+
+import services
+
+# finished jobs are kept around for a day, so their result can still be looked at.
+JOB_TTL = 86400
+# unfinished jobs reports in this often, the ones that haven't in
+# `JOB_STALE_AFTER` seconds died with their worker.
+JOB_HEARTBEAT_INTERVAL = 10
+JOB_STALE_AFTER = 60
+# jobs sharing a lock runs one at a time, the lock expires if its worker dies.
+JOB_LOCK_TIMEOUT = 60
+JOB_LOCK_POLL_INTERVAL = 1
+
+# keep a reference to the running jobs, so they don't get garbage collected.
+_running_jobs: set[asyncio.Task] = set()
+
+
+def job_key(job_id: str) -> str:
+    return f"ragnarok:api:jobs:{job_id}"
+
+
+def job_lock_key(lock: str) -> str:
+    return f"ragnarok:api:jobs:lock:{lock}"
+
+
+async def update_job(job_id: str, **fields: Any) -> None:
+    async with services.redis.pipeline(transaction=False) as pipe:
+        pipe.hset(job_key(job_id), mapping=fields)
+        pipe.expire(job_key(job_id), JOB_TTL)
+        await pipe.execute()
+
+
+async def get_job(job_id: str) -> dict[str, str] | None:
+    job = await services.redis.hgetall(job_key(job_id))  # type: ignore
+
+    if not job:
+        return
+
+    job = {key.decode(): value.decode() for key, value in job.items()}
+
+    if (
+        job["status"] in ("queued", "running")
+        and int(job.get("heartbeat", job["created"])) < time.time() - JOB_STALE_AFTER
+    ):
+        job |= {"status": "failed", "error": "the worker running it stopped"}
+        await update_job(job_id, status=job["status"], error=job["error"])
+
+    return job
+
+
+async def _heartbeat(job_id: str, lock: str | None) -> None:
+    while True:
+        await asyncio.sleep(JOB_HEARTBEAT_INTERVAL)
+        await update_job(job_id, heartbeat=int(time.time()))
+
+        if lock and await services.redis.get(job_lock_key(lock)) == job_id.encode():
+            await services.redis.expire(job_lock_key(lock), JOB_LOCK_TIMEOUT)
+
+
+async def _run_job(
+    job_id: str, job: Callable[[str], Awaitable[None]], lock: str | None
+) -> None:
+    heartbeat = asyncio.create_task(_heartbeat(job_id, lock))
+
+    try:
+        if lock:
+            while not await services.redis.set(
+                job_lock_key(lock), job_id, nx=True, ex=JOB_LOCK_TIMEOUT
+            ):
+                await asyncio.sleep(JOB_LOCK_POLL_INTERVAL)
+
+        await update_job(job_id, status="running", started=int(time.time()))
+        await job(job_id)
+    except asyncio.CancelledError:
+        await update_job(
+            job_id,
+            status="failed",
+            error="interrupted by a shutdown",
+            finished=int(time.time()),
+        )
+        raise
+    except Exception as exc:
+        services.logger.exception(f"Job {job_id} failed.")
+        await update_job(
+            job_id, status="failed", error=repr(exc), finished=int(time.time())
+        )
+    else:
+        await update_job(job_id, status="done", finished=int(time.time()))
+    finally:
+        heartbeat.cancel()
+
+        if lock and await services.redis.get(job_lock_key(lock)) == job_id.encode():
+            await services.redis.delete(job_lock_key(lock))
+
+
+async def start_job(
+    kind: str,
+    job: Callable[[str], Awaitable[None]],
+    lock: str | None = None,
+    **fields: Any,
+) -> str:
+    """Runs `job` in the background, with its id, which is also returned.
+    The job reports its progress with `update_job`. Jobs with the same
+    `lock` waits for each other, and runs one at a time."""
+    job_id = uuid.uuid4().hex
+    now = int(time.time())
+    await update_job(
+        job_id, kind=kind, status="queued", created=now, heartbeat=now, **fields
+    )
+
+    task = asyncio.create_task(_run_job(job_id, job, lock))
+    _running_jobs.add(task)
+    task.add_done_callback(_running_jobs.discard)
+
+    return job_id
+
+
+async def stop_jobs() -> None:
+    """Cancels the jobs of this worker, marking them as failed."""
+    for task in _running_jobs:
+        task.cancel()
+
+    await asyncio.gather(*_running_jobs, return_exceptions=True)
@@ -0,0 +1,36 @@
+import asyncio
+import logging
+
+import services
+from app import friends
+
+
+async def rebuild_friends(chunk_size: int = 1000) -> None:
+    """Reloads the cached friend and follower sets of every user from sql."""
+    last_id = 0
+
+    while user_ids := await services.database.fetch_all(
+        "SELECT id FROM users WHERE id > :last_id ORDER BY id ASC LIMIT :limit",
+        {"last_id": last_id, "limit": chunk_size},
+    ):
+        chunk = [row["id"] for row in user_ids]
+        await friends.load(chunk, force=True)
+
+        last_id = chunk[-1]
+        services.logger.info(f"Rebuilt friend sets for users up to {last_id}.")
+
+
+async def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+
+    await services.database.connect()
+    await services.redis.initialize()
+
+    try:
+        await rebuild_friends()
+    finally:
+        await services.database.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
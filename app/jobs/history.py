@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import time
+
+import services
+from app.utilities import MODES
+
+SNAPSHOT_INTERVAL = 86400
+# how often workers checks if todays snapshot has been taken yet,
+# so a failed (or killed) snapshot gets retried the same day.
+SNAPSHOT_RETRY_INTERVAL = 300
+SNAPSHOT_LOCK_TIMEOUT = 3600
+
+
+async def snapshot_history(timestamp: int | None = None, chunk_size: int = 500) -> None:
+    """Writes a pp and rank point to `profile_history`, for every user on the leaderboards."""
+    timestamp = timestamp or int(time.time())
+
+    for gamemode, mode in MODES:
+        user_ids = await services.redis.zrevrange(
+            f"ragnarok:leaderboard:{gamemode.name.lower()}:{mode}", 0, -1
+        )
+
+        for offset in range(0, len(user_ids), chunk_size):
+            chunk = [int(user_id) for user_id in user_ids[offset : offset + chunk_size]]
+
+            rows = await services.database.fetch_all(
+                f"SELECT id, CAST({mode.to_db("pp", False)} AS INT) AS pp "
+                f"FROM {gamemode.to_db} WHERE id IN :user_ids",
+                {"user_ids": chunk},
+            )
+            pp = {row["id"]: row["pp"] for row in rows}
+
+            values = []
+            params = {"mode": mode, "gamemode": gamemode, "timestamp": timestamp}
+
+            for idx, user_id in enumerate(chunk):
+                if user_id not in pp:
+                    continue
+
+                values.append(
+                    f"(:user_id{idx}, :mode, :gamemode, :pp{idx}, :rank{idx}, :timestamp)"
+                )
+                params |= {
+                    f"user_id{idx}": user_id,
+                    f"pp{idx}": pp[user_id],
+                    f"rank{idx}": offset + idx + 1,
+                }
+
+            if not values:
+                continue
+
+            await services.database.execute(
+                "INSERT INTO profile_history (user_id, mode, gamemode, pp, rank, timestamp) "
+                f"VALUES {", ".join(values)}",
+                params,
+            )
+
+        services.logger.info(
+            f"Saved {len(user_ids)} history points for {gamemode.name.lower()} {mode.name.lower()}."
+        )
+
+
+async def take_daily_snapshot(day: int) -> bool:
+    """Takes the snapshot of `day`, unless it's done or another worker is on it.
+
+    Returns whether the snapshot of the day is done."""
+    key = f"ragnarok:api:history_snapshot:{day}"
+
+    if await services.redis.exists(key):
+        return True
+
+    # every worker runs the loop, only the one holding the lock takes the snapshot.
+    if not await services.redis.set(
+        f"{key}:lock", 1, nx=True, ex=SNAPSHOT_LOCK_TIMEOUT
+    ):
+        return False
+
+    timestamp = day * SNAPSHOT_INTERVAL
+
+    try:
+        # an earlier attempt of the day might've written some of it already.
+        if await services.redis.set(
+            f"{key}:started", 1, ex=SNAPSHOT_INTERVAL * 2, get=True
+        ):
+            await services.database.execute(
+                "DELETE FROM profile_history WHERE timestamp = :timestamp",
+                {"timestamp": timestamp},
+            )
+
+        await snapshot_history(timestamp)
+    except Exception:
+        services.logger.exception("Failed to take the profile history snapshot.")
+        return False
+    finally:
+        await services.redis.delete(f"{key}:lock")
+
+    # only marked as done once it is, so failures are retried.
+    await services.redis.set(key, 1, ex=SNAPSHOT_INTERVAL * 2)
+    return True
+
+
+async def history_snapshot_loop() -> None:
+    """Takes a history snapshot once a day, on one worker."""
+    while True:
+        now = time.time()
+        day = int(now // SNAPSHOT_INTERVAL)
+
+        try:
+            done = await take_daily_snapshot(day)
+        except Exception:
+            services.logger.exception("Failed to check the profile history snapshot.")
+            done = False
+
+        next_day = (day + 1) * SNAPSHOT_INTERVAL - now
+        await asyncio.sleep(
+            next_day if done else min(SNAPSHOT_RETRY_INTERVAL, next_day)
+        )
+
+
+async def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+
+    await services.database.connect()
+    await services.redis.initialize()
+
+    try:
+        await snapshot_history()
+    finally:
+        await services.database.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
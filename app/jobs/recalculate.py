@@ -0,0 +1,212 @@
+import asyncio
+import logging
+import sys
+
+import services
+from app.constants.approved import Approved
+from app.cache import purge_tags
+from app.jobs import update_job
+from app.utilities import Gamemode, Mode, profile_cache_key, user_card_cache_key
+
+# only the top 100 scores counts towards the total pp,
+# each one weighted 5% less than the one before it.
+TOP_SCORES = 100
+PP_WEIGHT = 0.95
+
+# how many batches of users are recalculated at the same time,
+# keep this below the size of the database pool.
+PARALLEL_BATCHES = 4
+
+
+def weighted_pp(pps: list[float]) -> float:
+    """The total pp of the scores, which has to be sorted highest first."""
+    return sum(pp * PP_WEIGHT**idx for idx, pp in enumerate(pps[:TOP_SCORES]))
+
+
+async def update_scores(
+    job_id: str, changes: dict[str, bool], chunk_size: int
+) -> set[tuple[int, Gamemode, Mode]]:
+    """Updates `awards_pp` of the scores on the changed beatmaps in chunks,
+    and returns the users (and modes) whose best scores were affected."""
+    affected: set[tuple[int, Gamemode, Mode]] = set()
+    updated = 0
+
+    for map_md5, awards_pp in changes.items():
+        last_id = 0
+
+        while scores := await services.database.fetch_all(
+            "SELECT id, user_id, gamemode, mode, status FROM scores "
+            "WHERE map_md5 = :map_md5 AND awards_pp != :awards_pp AND id > :last_id "
+            "ORDER BY id ASC LIMIT :limit",
+            {
+                "map_md5": map_md5,
+                "awards_pp": awards_pp,
+                "last_id": last_id,
+                "limit": chunk_size,
+            },
+        ):
+            await services.database.execute(
+                "UPDATE scores SET awards_pp = :awards_pp WHERE id IN :score_ids",
+                {
+                    "awards_pp": awards_pp,
+                    "score_ids": [score["id"] for score in scores],
+                },
+            )
+
+            for score in scores:
+                if score["status"] == 3:
+                    affected.add(
+                        (
+                            score["user_id"],
+                            Gamemode(score["gamemode"]),
+                            Mode(score["mode"]),
+                        )
+                    )
+
+            last_id = scores[-1]["id"]
+            updated += len(scores)
+            await update_job(job_id, scores_updated=updated)
+
+    return affected
+
+
+async def recalculate_users(
+    gamemode: Gamemode, mode: Mode, user_ids: list[int]
+) -> None:
+    """Recalculates the total pp of the users and updates the stats table and leaderboards."""
+    rows = await services.database.fetch_all(
+        "SELECT user_id, pp FROM ("
+        "SELECT user_id, pp, ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY pp DESC) AS position "
+        "FROM scores WHERE user_id IN :user_ids AND gamemode = :gamemode AND mode = :mode "
+        "AND status = 3 AND awards_pp = 1"
+        ") ranked WHERE position <= :top ORDER BY user_id, position",
+        {
+            "user_ids": user_ids,
+            "gamemode": gamemode,
+            "mode": mode,
+            "top": TOP_SCORES,
+        },
+    )
+
+    pps: dict[int, list[float]] = {user_id: [] for user_id in user_ids}
+    for row in rows:
+        pps[row["user_id"]].append(row["pp"])
+
+    totals = {user_id: weighted_pp(user_pps) for user_id, user_pps in pps.items()}
+
+    column = mode.to_db("pp", False)
+    params: dict = {"user_ids": user_ids}
+    cases = []
+
+    for idx, (user_id, total) in enumerate(totals.items()):
+        cases.append(f"WHEN :user_id{idx} THEN :pp{idx}")
+        params |= {f"user_id{idx}": user_id, f"pp{idx}": total}
+
+    await services.database.execute(
+        f"UPDATE {gamemode.to_db} SET {column} = CASE id {" ".join(cases)} END "
+        "WHERE id IN :user_ids",
+        params,
+    )
+
+    countries = {
+        row["id"]: row["country"]
+        for row in await services.database.fetch_all(
+            "SELECT id, country FROM users WHERE id IN :user_ids",
+            {"user_ids": user_ids},
+        )
+    }
+
+    leaderboard = f"ragnarok:leaderboard:{gamemode.name.lower()}"
+
+    # only update the users already on the leaderboards,
+    # restricted users shouldn't show up on them again.
+    async with services.redis.pipeline(transaction=False) as pipe:
+        for user_id, total in totals.items():
+            pipe.zadd(f"{leaderboard}:{mode}", {str(user_id): total}, xx=True)
+
+            if country := countries.get(user_id):
+                pipe.zadd(
+                    f"{leaderboard}:{country}:{mode}", {str(user_id): total}, xx=True
+                )
+
+            pipe.delete(profile_cache_key(user_id), user_card_cache_key(user_id))
+
+        await pipe.execute()
+
+    await purge_tags(*(f"user:{user_id}" for user_id in user_ids))
+
+
+async def current_changes(map_md5s: list[str]) -> dict[str, bool]:
+    """Whether the beatmaps awards pp (map_md5 -> awards pp), by their current status."""
+    beatmaps = await services.database.fetch_all(
+        "SELECT map_md5, approved FROM beatmaps WHERE map_md5 IN :map_md5s",
+        {"map_md5s": map_md5s},
+    )
+
+    return {
+        beatmap["map_md5"]: Approved(beatmap["approved"]).awards_pp
+        for beatmap in beatmaps
+    }
+
+
+async def recalculate(
+    job_id: str, map_md5s: list[str], chunk_size: int = 1000, batch_size: int = 100
+) -> None:
+    """Applies the `awards_pp` of the beatmaps current status to their scores,
+    and recalculates the total pp of every user with a best score on them.
+
+    The status is read when the job runs, not when it was started, so jobs
+    for the same beatmap ends up in its latest status, whatever order they
+    ran in. They're started with the "recalculate" lock, to not overlap."""
+    changes = await current_changes(map_md5s)
+    affected = await update_scores(job_id, changes, chunk_size)
+
+    batches: list[tuple[Gamemode, Mode, list[int]]] = []
+    users: dict[tuple[Gamemode, Mode], list[int]] = {}
+
+    for user_id, gamemode, mode in affected:
+        users.setdefault((gamemode, mode), []).append(user_id)
+
+    for (gamemode, mode), user_ids in users.items():
+        user_ids.sort()
+        for offset in range(0, len(user_ids), batch_size):
+            batches.append((gamemode, mode, user_ids[offset : offset + batch_size]))
+
+    await update_job(job_id, users=len(affected), users_recalculated=0)
+
+    recalculated = 0
+    semaphore = asyncio.Semaphore(PARALLEL_BATCHES)
+
+    async def run_batch(gamemode: Gamemode, mode: Mode, user_ids: list[int]) -> None:
+        nonlocal recalculated
+
+        async with semaphore:
+            await recalculate_users(gamemode, mode, user_ids)
+
+        recalculated += len(user_ids)
+        await update_job(job_id, users_recalculated=recalculated)
+
+    await asyncio.gather(*(run_batch(*batch) for batch in batches))
+    await purge_tags(*(f"leaderboard:{gamemode}:{mode}" for gamemode, mode in users))
+
+    services.logger.info(
+        f"Recalculated {len(affected)} users after {len(changes)} beatmaps changed status."
+    )
+
+
+async def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+
+    await services.database.connect()
+    await services.redis.initialize()
+
+    # python -m app.jobs.recalculate <map_md5> [<map_md5> ...]
+    # reapplies the current status of the beatmaps.
+    try:
+        await recalculate("manual", sys.argv[1:])
+    finally:
+        await services.database.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,501 @@
+import asyncio
+import bisect
+import contextvars
+import logging
+import os
+import re
+import time
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, Callable, Iterator, TypeVar
+
+from databases import Database
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+logger = logging.getLogger("uvicorn.error")
+
+# prometheus text format, without depending on the prometheus client.
+# metrics are plain dicts keyed by their label values, so recording
+# is a dict lookup and a bisect.
+
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], **extra: str) -> str:
+    pairs = [*zip(names, values), *extra.items()]
+    if not pairs:
+        return ""
+
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+
+        for labels, value in self.values.items():
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [count per bucket (+inf last), sum]
+        self.values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        if (entry := self.values.get(labels)) is None:
+            entry = self.values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+
+        counts, total = entry
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+
+        for labels, (counts, total) in self.values.items():
+            cumulative = 0
+
+            for bucket, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                yield f"{self.name}_bucket{_labels(self.labels, labels, le=str(bucket))} {cumulative}"
+
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {total[0]}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {cumulative}"
+
+
+class Gauge:
+    """Gauge, whose values are read from `collect` when rendered."""
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        collect: Callable[[], dict[tuple[str, ...], float]],
+        labels: tuple[str, ...] = (),
+    ) -> None:
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.collect = collect
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+
+        try:
+            values = self.collect()
+        except Exception:
+            return
+
+        for labels, value in values.items():
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+M = TypeVar("M", "Counter", "Histogram", "Gauge")
+
+
+class Registry:
+    def __init__(self) -> None:
+        self.metrics: list[Counter | Histogram | Gauge] = []
+
+    def register(self, metric: M) -> M:
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Callable[
+        [Callable[[], dict[tuple[str, ...], float]]],
+        Callable[[], dict[tuple[str, ...], float]],
+    ]:
+        """Registers the decorated function as the collector of a gauge."""
+
+        def wrapper(
+            collect: Callable[[], dict[tuple[str, ...], float]],
+        ) -> Callable[[], dict[tuple[str, ...], float]]:
+            self.register(Gauge(name, help, collect, labels))
+            return collect
+
+        return wrapper
+
+    def render(self) -> str:
+        return (
+            "\n".join(line for metric in self.metrics for line in metric.render())
+            + "\n"
+        )
+
+
+registry = Registry()
+
+http_request_duration = registry.register(
+    Histogram(
+        "ragnarok_http_request_duration_seconds",
+        "Time spent handling requests, by route template.",
+        ("method", "route"),
+    )
+)
+http_requests = registry.register(
+    Counter(
+        "ragnarok_http_requests_total",
+        "Handled requests, by route template and status code.",
+        ("method", "route", "status"),
+    )
+)
+db_query_duration = registry.register(
+    Histogram(
+        "ragnarok_db_query_duration_seconds",
+        "Time spent on database queries, by query name.",
+        ("query",),
+    )
+)
+db_query_errors = registry.register(
+    Counter(
+        "ragnarok_db_query_errors_total",
+        "Database queries that raised, by query name.",
+        ("query",),
+    )
+)
+redis_command_duration = registry.register(
+    Histogram(
+        "ragnarok_redis_command_duration_seconds",
+        "Time spent on redis commands, pipelines are a single PIPELINE command.",
+        ("command",),
+    )
+)
+osu_api_duration = registry.register(
+    Histogram(
+        "ragnarok_osu_api_request_duration_seconds",
+        "Time spent on requests to the osu api, by endpoint.",
+        ("endpoint",),
+    )
+)
+osu_api_errors = registry.register(
+    Counter(
+        "ragnarok_osu_api_errors_total",
+        "Failed requests to the osu api, by endpoint.",
+        ("endpoint",),
+    )
+)
+
+
+@contextmanager
+def osu_api_request(endpoint: str) -> Iterator[None]:
+    """Times a request to the osu api, any exception counts as an error."""
+    started = time.perf_counter()
+
+    try:
+        yield
+    except Exception:
+        osu_api_errors.inc(endpoint)
+        raise
+    finally:
+        osu_api_duration.observe(time.perf_counter() - started, endpoint)
+
+
+# how long each phase of the workers startup took, in seconds.
+startup_timings: dict[str, float] = {}
+
+
+@contextmanager
+def startup_phase(name: str) -> Iterator[None]:
+    started = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        startup_timings[name] = time.perf_counter() - started
+
+
+QUERY_PATTERN = re.compile(
+    r"^\W*(?:(select|delete)\b.*?\bfrom|(insert|replace)\b.*?\binto|(update))\s+`?(\w+)",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+@lru_cache(maxsize=4096)
+def query_name(query: str) -> str:
+    """Short name of the query, like "select users", to keep the labels bounded."""
+    if match := QUERY_PATTERN.match(query):
+        *verbs, table = match.groups()
+        verb = next(verb for verb in verbs if verb)
+        return f"{verb.lower()} {table.lower()}"
+
+    return query.split(None, 1)[0].lower() if query.strip() else "unknown"
+
+
+# queries slower than this (in milliseconds) are logged, with their plan.
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "250"))
+# the plan of a fingerprint is captured at most once in this many seconds.
+EXPLAIN_INTERVAL = 300
+# queries built with f-strings can make new fingerprints, don't let them grow forever.
+MAX_FINGERPRINTS = 2000
+
+FINGERPRINT_PATTERNS = (
+    (re.compile(r"\s+"), " "),
+    (re.compile(r"'(?:[^'\\]|\\.)*'"), "?"),
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),
+    (re.compile(r":\w+"), "?"),
+    # multi row inserts and generated case expressions.
+    (re.compile(r"(\(\?(?:, \?)*\))(?:, \(\?(?:, \?)*\))+"), r"\1, ..."),
+    (re.compile(r"(WHEN \? THEN \?)(?: WHEN \? THEN \?)+", re.IGNORECASE), r"\1 ..."),
+)
+
+
+@lru_cache(maxsize=4096)
+def fingerprint_query(query: str) -> str:
+    """The query without its values, so every execution of it is grouped together."""
+    for pattern, replacement in FINGERPRINT_PATTERNS:
+        query = pattern.sub(replacement, query)
+
+    return query.strip()
+
+
+class QueryStats:
+    def __init__(self, fingerprint: str) -> None:
+        self.fingerprint = fingerprint
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.slow = 0
+        # count per latency bucket (+inf last)
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+        self.plan: list[dict[str, Any]] | None = None
+        self.plan_duration = 0.0
+        self.explained_at = 0.0
+
+    def observe(self, duration: float) -> None:
+        self.count += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+        self.buckets[bisect.bisect_left(LATENCY_BUCKETS, duration)] += 1
+
+    def percentile(self, percentile: float) -> float:
+        """Upper bound of the bucket, the percentile falls in."""
+        target = percentile * self.count
+        seen = 0
+
+        for bound, count in zip(LATENCY_BUCKETS, self.buckets):
+            seen += count
+            if seen >= target:
+                return bound
+
+        return self.max_time
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "fingerprint": self.fingerprint,
+            "count": self.count,
+            "slow": self.slow,
+            "total_ms": self.total_time * 1000,
+            "mean_ms": self.total_time / self.count * 1000 if self.count else 0,
+            "max_ms": self.max_time * 1000,
+            "p50_ms": self.percentile(0.5) * 1000,
+            "p95_ms": self.percentile(0.95) * 1000,
+            "p99_ms": self.percentile(0.99) * 1000,
+            "plan": self.plan,
+            "plan_duration_ms": self.plan_duration * 1000,
+        }
+
+
+query_stats: dict[str, QueryStats] = {}
+
+# keep a reference to the running explains, so they don't get garbage collected.
+_explains: set[asyncio.Task] = set()
+
+
+class InstrumentedDatabase(Database):
+    """`Database`, which records the duration of every query,
+    and captures the plan of queries slower than `SLOW_QUERY_MS`."""
+
+    async def _timed(self, query: Any, values: Any, call: Any) -> Any:
+        name = query_name(query) if isinstance(query, str) else "clause"
+        started = time.perf_counter()
+
+        try:
+            return await call
+        except Exception:
+            db_query_errors.inc(name)
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            db_query_duration.observe(duration, name)
+
+            if isinstance(query, str):
+                self._record(query, values, name, duration)
+
+    def _record(self, query: str, values: Any, name: str, duration: float) -> None:
+        fingerprint = fingerprint_query(query)
+
+        if (stats := query_stats.get(fingerprint)) is None:
+            if len(query_stats) >= MAX_FINGERPRINTS:
+                return
+
+            stats = query_stats[fingerprint] = QueryStats(fingerprint)
+
+        stats.observe(duration)
+
+        if duration * 1000 < SLOW_QUERY_MS:
+            return
+
+        stats.slow += 1
+        now = time.monotonic()
+
+        if (
+            now - stats.explained_at < EXPLAIN_INTERVAL
+            or name.split()[0]
+            not in ("select", "update", "delete", "insert", "replace")
+            or not isinstance(values, dict | None)
+        ):
+            return
+
+        stats.explained_at = now
+        # in an empty context, so it doesn't share the connection of a running transaction.
+        task = asyncio.create_task(
+            self._explain(stats, query, values, duration), context=contextvars.Context()
+        )
+        _explains.add(task)
+        task.add_done_callback(_explains.discard)
+
+    async def _explain(
+        self, stats: QueryStats, query: str, values: dict | None, duration: float
+    ) -> None:
+        try:
+            # not instrumented, the explain shouldn't show up in the stats itself.
+            plan = await Database.fetch_all(self, f"EXPLAIN {query}", values)
+        except Exception:
+            logger.exception(f"Failed to explain the slow query: {stats.fingerprint}")
+            return
+
+        stats.plan = [dict(row) for row in plan]
+        stats.plan_duration = duration
+
+        logger.warning(
+            f"Slow query ({duration * 1000:.0f}ms): {stats.fingerprint}\n"
+            + "\n".join(str(row) for row in stats.plan)
+        )
+
+    async def fetch_all(self, query: Any, values: dict | None = None) -> Any:
+        return await self._timed(query, values, super().fetch_all(query, values))
+
+    async def fetch_one(self, query: Any, values: dict | None = None) -> Any:
+        return await self._timed(query, values, super().fetch_one(query, values))
+
+    async def fetch_val(
+        self, query: Any, values: dict | None = None, column: Any = 0
+    ) -> Any:
+        return await self._timed(
+            query, values, super().fetch_val(query, values, column)
+        )
+
+    async def execute(self, query: Any, values: dict | None = None) -> Any:
+        return await self._timed(query, values, super().execute(query, values))
+
+    async def execute_many(self, query: Any, values: list) -> None:
+        return await self._timed(query, values, super().execute_many(query, values))
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error: bool = True) -> list[Any]:
+        started = time.perf_counter()
+
+        try:
+            return await super().execute(raise_on_error)
+        finally:
+            redis_command_duration.observe(time.perf_counter() - started, "PIPELINE")
+
+
+class InstrumentedRedis(Redis):
+    """`Redis`, which records the duration of every command."""
+
+    async def execute_command(self, *args: Any, **options: Any) -> Any:
+        started = time.perf_counter()
+
+        try:
+            return await super().execute_command(*args, **options)
+        finally:
+            command = args[0] if isinstance(args[0], str) else args[0].decode()
+            redis_command_duration.observe(
+                time.perf_counter() - started, command.upper()
+            )
+
+    def pipeline(
+        self, transaction: bool = True, shard_hint: Any = None
+    ) -> InstrumentedPipeline:
+        return InstrumentedPipeline(
+            self.connection_pool, self.response_callbacks, transaction, shard_hint
+        )
+
+
+class MetricsMiddleware:
+    """Records the latency and status of every request, by the matched route's
+    template (`/api/users/get/{user_id}`), so the labels stay bounded."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status
+
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # the router puts the matched route in the scope.
+            route = getattr(scope.get("route"), "path", "unmatched")
+
+            http_request_duration.observe(
+                time.perf_counter() - started, scope["method"], route
+            )
+            http_requests.inc(scope["method"], route, str(status))
@@ -1,10 +1,29 @@
 import asyncio
+from functools import partial
 from typing import Any, Union
 
-import aiohttp
 from pydantic import BaseModel, Field
+from app import metrics
+from app.search.beatmaps import index as beatmap_index
+from app.utilities import get_loader
 import services
 
+BEATMAP_COLUMNS = (
+    "set_id, map_id, map_md5, title, title_unicode, version, artist, "
+    "artist_unicode, creator, creator_id, stars, od, ar, hp, cs, mode, bpm, "
+    "max_combo, approved, submit_date, approved_date, latest_update, length AS hit_length, "
+    "drain, plays, passes, favorites, rating, full_set_present"
+)
+
+
+async def _load_beatmaps(column: str, values: list[Any]) -> dict[Any, Any]:
+    beatmaps = await services.replica.fetch_all(
+        f"SELECT {BEATMAP_COLUMNS} FROM beatmaps WHERE {column} IN :values",
+        {"values": values},
+    )
+
+    return {beatmap[column]: beatmap for beatmap in beatmaps}
+
 
 class Beatmap(BaseModel):
     set_id: int
@@ -50,23 +69,29 @@ class Beatmap(BaseModel):
         """Saves a beatmap's .osu file to ragnarok."""
         path = services.RAGNAROK_OSU_PATH / f"{self.map_id}.osu"
         if not path.exists():
-            async with aiohttp.ClientSession() as sess:
-                async with sess.get(
-                    f"https://osu.ppy.sh/web/osu-getosufile.php?q={self.map_id}",
-                    headers={"user-agent": "osu!"},
-                ) as req:
-                    if not (resp := await req.text()):
-                        services.logger.critical(
-                            f"Couldn't fetch the .osu file of {self.map_id}. Maybe because api rate limit?"
-                        )
-                        return
-
-                    with path.open("w+") as osu:
-                        osu.write(resp)
-
-                    services.logger.info(
-                        f"Saved {self.map_id}.osu to {services.RAGNAROK_OSU_PATH!r}"
-                    )
+            import aiohttp
+
+            with metrics.osu_api_request("getosufile"):
+                async with aiohttp.ClientSession() as sess:
+                    async with sess.get(
+                        f"{services.osu_api_url}/web/osu-getosufile.php?q={self.map_id}",
+                        headers={"user-agent": "osu!"},
+                    ) as req:
+                        resp = await req.text()
+
+            if not resp:
+                metrics.osu_api_errors.inc("getosufile")
+                services.logger.critical(
+                    f"Couldn't fetch the .osu file of {self.map_id}. Maybe because api rate limit?"
+                )
+                return
+
+            with path.open("w+") as osu:
+                osu.write(resp)
+
+            services.logger.info(
+                f"Saved {self.map_id}.osu to {services.RAGNAROK_OSU_PATH!r}"
+            )
 
     async def save(self) -> None:
         ragnarok_approved = {4: 5, 3: 4, 2: 3, 1: 2}
@@ -88,6 +113,7 @@ class Beatmap(BaseModel):
             ":drain, :plays, :passes, :favorites, :rating, :approved, :full_set_present)",
             model_dump,
         )
+        await beatmap_index.add_beatmap(self)
 
         asyncio.create_task(self.save_to_directory())
 
@@ -98,6 +124,14 @@ class Beatmap(BaseModel):
         # `full_set_present` value
         f_map = _maps[0]
 
+        if f_map.full_set_present:
+            return _maps
+
+        # a lagging replica might be missing maps the primary already has,
+        # which would be saved a second time otherwise.
+        _maps = await Beatmap.from_sql(set_id=f_map.set_id, primary=True) or _maps  # type: ignore
+        f_map = _maps[0]
+
         if f_map.full_set_present:
             return _maps
 
@@ -165,41 +199,45 @@ class Beatmap(BaseModel):
             ("s", set_id) if set_id else ("b", map_id) if map_id else ("h", map_md5)
         )
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(
-                f"https://osu.ppy.sh/api/get_beatmaps?{params[0]}={params[1]}&k={services.osu_key}"
-            ) as req:
-                if req.status != 200:
-                    services.logger.warn(
-                        f"beatmap (set_id: {set_id}, map_id: {map_id}) could not be found in the osu api."
-                    )
-                    return
+        import aiohttp
 
-                resp = await req.json()
+        with metrics.osu_api_request("get_beatmaps"):
+            async with aiohttp.ClientSession() as session:
+                async with session.get(
+                    f"{services.osu_api_url}/api/get_beatmaps?{params[0]}={params[1]}&k={services.osu_key}"
+                ) as req:
+                    resp = await req.json() if req.status == 200 else None
 
-                if set_id:
-                    maps: list[Beatmap] = []
-                    for map in resp:
-                        child_map = Beatmap.from_api_mapping(map, present_set=True)
-                        maps.append(child_map)
+        if resp is None:
+            metrics.osu_api_errors.inc("get_beatmaps")
+            services.logger.warn(
+                f"beatmap (set_id: {set_id}, map_id: {map_id}) could not be found in the osu api."
+            )
+            return
 
-                        if not disable_auto_save:
-                            # as the whole set is being saved, the full_set_present field, should be true.
-                            await child_map.save()
+        if set_id:
+            maps: list[Beatmap] = []
+            for map in resp:
+                child_map = Beatmap.from_api_mapping(map, present_set=True)
+                maps.append(child_map)
 
-                    maps.sort(key=lambda map: map.stars)
+                if not disable_auto_save:
+                    # as the whole set is being saved, the full_set_present field, should be true.
+                    await child_map.save()
 
-                    return maps
+            maps.sort(key=lambda map: map.stars)
 
-                if not resp:
-                    return
+            return maps
 
-                map = Beatmap.from_api_mapping(resp[0])
+        if not resp:
+            return
 
-                if not disable_auto_save:
-                    await map.save()
+        map = Beatmap.from_api_mapping(resp[0])
+
+        if not disable_auto_save:
+            await map.save()
 
-                return map
+        return map
 
     @classmethod
     async def from_sql(
@@ -207,30 +245,41 @@ class Beatmap(BaseModel):
         set_id: int | None = None,
         map_id: int | None = None,
         map_md5: str | None = None,
+        primary: bool = False,
     ) -> Union[list["Beatmap"], "Beatmap", None]:
-        params = (
-            ("set_id", set_id)
-            if set_id
-            else ("map_id", map_id) if map_id else ("map_md5", map_md5)
-        )
-        fetching_method = (
-            services.database.fetch_all if set_id else services.database.fetch_one
-        )
+        # beatmaps missing on a replica are looked up on the primary as well, as
+        # the callers fetches (and saves) missing beatmaps from the osu api.
+        if not set_id:
+            # single beatmaps goes through the request's loader, so
+            # lookups in the same request are batched together.
+            column, value = ("map_id", map_id) if map_id else ("map_md5", map_md5)
+            loader = get_loader(f"beatmaps:{column}", partial(_load_beatmaps, column))
 
-        data = await fetching_method(
-            "SELECT set_id, map_id, map_md5, title, title_unicode, version, artist, "
-            "artist_unicode, creator, creator_id, stars, od, ar, hp, cs, mode, bpm, "
-            "max_combo, approved, submit_date, approved_date, latest_update, length AS hit_length, "
-            "drain, plays, passes, favorites, rating, full_set_present FROM beatmaps "
-            f"WHERE {params[0]} = :param ORDER BY stars ASC",
-            {"param": params[1]},
+            if primary or not (beatmap := await loader.load(value)):
+                beatmap = await services.database.fetch_one(
+                    f"SELECT {BEATMAP_COLUMNS} FROM beatmaps WHERE {column} = :value",
+                    {"value": value},
+                )
+
+            if not beatmap:
+                return
+
+            return cls(**dict(beatmap))
+
+        query = (
+            f"SELECT {BEATMAP_COLUMNS} FROM beatmaps "
+            "WHERE set_id = :param ORDER BY stars ASC"
         )
+        data = None
+
+        if not primary:
+            data = await services.replica.fetch_all(query, {"param": set_id})
 
         if not data:
-            return
+            data = await services.database.fetch_all(query, {"param": set_id})
 
-        if not set_id:
-            return cls(**dict(data))  # type: ignore
+        if not data:
+            return
 
         return [cls(**dict(map)) for map in data]
 
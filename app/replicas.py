@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import os
+from contextvars import ContextVar
+from typing import Any
+
+from databases import Database
+from pymysql.err import ProgrammingError
+
+from app.metrics import InstrumentedDatabase
+
+logger = logging.getLogger("uvicorn.error")
+
+# replicas further behind the primary than this (in seconds) are taken
+# out of rotation, until they've caught up again.
+MAX_REPLICA_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "2"))
+REPLICA_CHECK_INTERVAL = 2
+# a replica that doesn't answer in time is as good as a lagging one.
+REPLICA_CHECK_TIMEOUT = 5
+# servers in DB_REPLICA_URLS that aren't replicating on purpose (as host:port,
+# separated by commas), e.g. read-only copies kept up to date some other way.
+# any other server that isn't replicating is kept out of rotation.
+STANDALONE_REPLICAS = {
+    name.strip()
+    for name in (os.getenv("DB_STANDALONE_REPLICAS") or "").split(",")
+    if name.strip()
+}
+
+# set once the request (or task) has written something, so
+# everything it reads afterwards includes its own writes.
+_sticky: ContextVar[bool] = ContextVar("stick_to_primary", default=False)
+
+
+def stick_to_primary() -> None:
+    """Makes the rest of the current request read from the primary."""
+    _sticky.set(True)
+
+
+class PrimaryDatabase(InstrumentedDatabase):
+    """The primary, writing through it sticks the request to the primary."""
+
+    async def execute(self, query: Any, values: dict | None = None) -> Any:
+        stick_to_primary()
+        return await super().execute(query, values)
+
+    async def execute_many(self, query: Any, values: list) -> None:
+        stick_to_primary()
+        return await super().execute_many(query, values)
+
+    def transaction(self, *args: Any, **kwargs: Any) -> Any:
+        stick_to_primary()
+        return super().transaction(*args, **kwargs)
+
+
+class Replica:
+    def __init__(self, database: Database) -> None:
+        self.database = database
+        # the password is part of the url, so only the host is ever shown.
+        self.name = f"{database.url.hostname}:{database.url.port or 3306}"
+        self.standalone = self.name in STANDALONE_REPLICAS
+        # mariadb and older mysql versions only knows "SHOW SLAVE STATUS".
+        self.status_query = "SHOW REPLICA STATUS"
+
+        self.lag: float | None = None
+        self.error: Exception | None = None
+        self.healthy = False
+
+    @property
+    def status(self) -> str:
+        if self.error is not None:
+            return repr(self.error)
+
+        return "not replicating" if self.lag is None else f"lag: {self.lag}s"
+
+    async def replication_lag(self) -> float | None:
+        """Seconds the replica is behind, None if it isn't replicating."""
+        try:
+            status = await self.database.fetch_one(self.status_query)
+        except ProgrammingError:
+            if self.status_query == "SHOW SLAVE STATUS":
+                raise
+
+            self.status_query = "SHOW SLAVE STATUS"
+            status = await self.database.fetch_one(self.status_query)
+
+        # not a replica at all, which is only fine if it was meant to be.
+        if status is None:
+            return 0 if self.standalone else None
+
+        status = dict(status)
+        lag = status.get("Seconds_Behind_Source", status.get("Seconds_Behind_Master"))
+
+        return None if lag is None else float(lag)
+
+    async def check(self) -> None:
+        self.error = None
+
+        try:
+            async with asyncio.timeout(REPLICA_CHECK_TIMEOUT):
+                if not self.database.is_connected:
+                    await self.database.connect()
+
+                self.lag = await self.replication_lag()
+        except Exception as exc:
+            self.error = exc
+            self.lag = None
+
+        healthy = self.lag is not None and self.lag <= MAX_REPLICA_LAG
+
+        # only changes are logged, a broken replica would flood the logs otherwise.
+        if healthy and not self.healthy:
+            logger.info(f"Replica {self.name} is in rotation ({self.status}).")
+        elif not healthy and self.healthy:
+            logger.warning(f"Replica {self.name} is out of rotation ({self.status}).")
+
+        self.healthy = healthy
+
+
+class ReplicaRouter:
+    """Sends reads to a replica that has caught up with the primary. They go to the
+    primary instead, if none has or the request has written something already."""
+
+    def __init__(self, primary: Database, replicas: list[Database]) -> None:
+        self.primary = primary
+        self.replicas = [Replica(replica) for replica in replicas]
+        self._next = 0
+
+    @property
+    def database(self) -> Database:
+        if _sticky.get():
+            return self.primary
+
+        if not (healthy := [replica for replica in self.replicas if replica.healthy]):
+            return self.primary
+
+        self._next += 1
+        return healthy[self._next % len(healthy)].database
+
+    async def fetch_all(self, query: Any, values: dict | None = None) -> Any:
+        return await self.database.fetch_all(query, values)
+
+    async def fetch_one(self, query: Any, values: dict | None = None) -> Any:
+        return await self.database.fetch_one(query, values)
+
+    async def fetch_val(
+        self, query: Any, values: dict | None = None, column: Any = 0
+    ) -> Any:
+        return await self.database.fetch_val(query, values, column)
+
+    async def connect(self) -> None:
+        # replicas are only used once they've been checked,
+        # a broken one shouldn't keep the worker from starting.
+        await asyncio.gather(*(replica.check() for replica in self.replicas))
+
+    async def disconnect(self) -> None:
+        for replica in self.replicas:
+            if replica.database.is_connected:
+                await replica.database.disconnect()
+
+    async def lag_loop(self) -> None:
+        while True:
+            await asyncio.sleep(REPLICA_CHECK_INTERVAL)
+            await asyncio.gather(*(replica.check() for replica in self.replicas))
@@ -0,0 +1,363 @@
+import asyncio
+import bisect
+import re
+from dataclasses import asdict, dataclass
+from typing import TYPE_CHECKING, Any
+
+import orjson
+
+import services
+from app.utilities import on_invalidation, publish_invalidation
+
+if TYPE_CHECKING:
+    from app.objects.beatmaps import Beatmap
+
+# scripts written without spaces, their runs are split into character
+# bigrams, so words inside them can still be searched for.
+CJK = "\u3005-\u3007\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+TOKEN_PATTERN = re.compile(rf"[{CJK}]+|(?:(?![{CJK}])\w)+")
+CJK_PATTERN = re.compile(rf"[{CJK}]+")
+
+# searches stops once they've found this many beatmaps.
+MAX_RESULTS = 1000
+# a single latin letter would match (and union) most of the index as a prefix.
+MIN_PREFIX_LENGTH = 2
+# the plays (and anything else that changed) are only picked up by a rebuild.
+REBUILD_INTERVAL = 86400
+BUILD_RETRY_INTERVAL = 60
+
+
+@dataclass(slots=True)
+class IndexedBeatmap:
+    set_id: int
+    map_id: int
+    map_md5: str
+    title: str
+    title_unicode: str
+    artist: str
+    artist_unicode: str
+    version: str
+    creator: str
+    mode: int
+    approved: int
+    stars: float
+    bpm: float
+    plays: int
+
+    @property
+    def text(self) -> str:
+        return " ".join(
+            (
+                self.title,
+                self.title_unicode,
+                self.artist,
+                self.artist_unicode,
+                self.version,
+                self.creator,
+            )
+        )
+
+    def to_dict(self) -> dict[str, Any]:
+        return {
+            "set_id": self.set_id,
+            "map_id": self.map_id,
+            "map_md5": self.map_md5,
+            "title": self.title,
+            "title_unicode": self.title_unicode,
+            "artist": self.artist,
+            "artist_unicode": self.artist_unicode,
+            "version": self.version,
+            "creator": self.creator,
+            "mode": self.mode,
+            "approved": self.approved,
+            "stars": self.stars,
+            "bpm": self.bpm,
+            "plays": self.plays,
+        }
+
+
+def terms(text: str) -> list[str]:
+    """The search terms of `text`, in order."""
+    found = []
+
+    for run in TOKEN_PATTERN.findall(text.casefold()):
+        if CJK_PATTERN.fullmatch(run) and len(run) > 1:
+            found += [run[i : i + 2] for i in range(len(run) - 1)]
+        else:
+            found.append(run)
+
+    return found
+
+
+def tokenize(text: str) -> set[str]:
+    tokens = set(terms(text))
+
+    # single characters are indexed too, for searching by one of them.
+    for run in CJK_PATTERN.findall(text.casefold()):
+        tokens.update(run)
+
+    return tokens
+
+
+class BeatmapIndex:
+    """In-memory inverted index over the beatmaps table, to search
+    by title, artist (both unicode and romanised), version and creator."""
+
+    def __init__(self) -> None:
+        self.maps: dict[int, IndexedBeatmap] = {}
+        self.md5s: dict[str, int] = {}
+        self.postings: dict[str, set[int]] = {}
+        # sorted list of every token, used for prefix matching the last search term.
+        self.tokens: list[str] = []
+        # (-plays, map_id) of every beatmap, in the order searches returns them.
+        self.ranking: list[tuple[int, int]] = []
+        self.built = False
+        # beatmaps added while a build is running, they're added to the new index after.
+        self._pending: list[IndexedBeatmap] | None = None
+
+    def add(self, beatmap: IndexedBeatmap, sort: bool = True) -> None:
+        if beatmap.map_id in self.maps:
+            self.remove(beatmap.map_id)
+
+        self.maps[beatmap.map_id] = beatmap
+        self.md5s[beatmap.map_md5] = beatmap.map_id
+
+        if self._pending is not None:
+            self._pending.append(beatmap)
+
+        if sort:
+            bisect.insort(self.ranking, (-beatmap.plays, beatmap.map_id))
+        else:
+            self.ranking.append((-beatmap.plays, beatmap.map_id))
+
+        for token in tokenize(beatmap.text):
+            if token not in self.postings:
+                self.postings[token] = set()
+
+                # bulk builds sorts everything once they're done.
+                if sort:
+                    bisect.insort(self.tokens, token)
+
+            self.postings[token].add(beatmap.map_id)
+
+    def remove(self, map_id: int) -> None:
+        if not (beatmap := self.maps.pop(map_id, None)):
+            return
+
+        self.md5s.pop(beatmap.map_md5, None)
+
+        idx = bisect.bisect_left(self.ranking, (-beatmap.plays, map_id))
+        if idx < len(self.ranking) and self.ranking[idx][1] == map_id:
+            self.ranking.pop(idx)
+
+        for token in tokenize(beatmap.text):
+            posting = self.postings.get(token)
+            if posting is None:
+                continue
+
+            posting.discard(map_id)
+            if not posting:
+                del self.postings[token]
+
+                idx = bisect.bisect_left(self.tokens, token)
+                if idx < len(self.tokens) and self.tokens[idx] == token:
+                    self.tokens.pop(idx)
+
+    async def add_beatmap(self, beatmap: "Beatmap") -> None:
+        """Adds the beatmap to the index of every worker."""
+        indexed = IndexedBeatmap(
+            set_id=beatmap.set_id,
+            map_id=beatmap.map_id,
+            map_md5=beatmap.map_md5,
+            title=beatmap.title,
+            title_unicode=beatmap.title_unicode,
+            artist=beatmap.artist,
+            artist_unicode=beatmap.artist_unicode,
+            version=beatmap.version,
+            creator=beatmap.creator,
+            mode=beatmap.mode,
+            approved=beatmap.approved,
+            stars=beatmap.stars,
+            bpm=beatmap.bpm,
+            plays=beatmap.plays,
+        )
+
+        self.add(indexed)
+        await publish_invalidation(
+            "beatmap_added", orjson.dumps(asdict(indexed)).decode()
+        )
+
+    def set_approved(self, map_md5: str, approved: int) -> None:
+        if (map_id := self.md5s.get(map_md5)) is not None:
+            self.maps[map_id].approved = approved
+
+    def _prefixed(self, prefix: str) -> set[int]:
+        matches: set[int] = set()
+
+        idx = bisect.bisect_left(self.tokens, prefix)
+        while idx < len(self.tokens) and self.tokens[idx].startswith(prefix):
+            matches |= self.postings[self.tokens[idx]]
+            idx += 1
+
+        return matches
+
+    def _matches(
+        self,
+        beatmap: IndexedBeatmap,
+        mode: int | None,
+        approved: int | None,
+        min_stars: float,
+        max_stars: float | None,
+        min_bpm: float,
+        max_bpm: float | None,
+    ) -> bool:
+        if mode is not None and beatmap.mode != mode:
+            return False
+
+        if approved is not None and beatmap.approved != approved:
+            return False
+
+        if beatmap.stars < min_stars or beatmap.bpm < min_bpm:
+            return False
+
+        return not (
+            (max_stars is not None and beatmap.stars > max_stars)
+            or (max_bpm is not None and beatmap.bpm > max_bpm)
+        )
+
+    def search(
+        self,
+        query: str,
+        mode: int | None = None,
+        approved: int | None = None,
+        min_stars: float = 0,
+        max_stars: float | None = None,
+        min_bpm: float = 0,
+        max_bpm: float | None = None,
+    ) -> list[IndexedBeatmap]:
+        """Returns the beatmaps matching all the terms of `query` and the filters,
+        most played first, up to `MAX_RESULTS` of them. The last term also matches
+        as a prefix, so results show up while typing."""
+        candidates: set[int] | None = None
+
+        if query_terms := terms(query):
+            *full_terms, last_term = query_terms
+            last = (
+                self._prefixed(last_term)
+                if len(last_term) >= MIN_PREFIX_LENGTH or CJK_PATTERN.match(last_term)
+                else self.postings.get(last_term, set())
+            )
+
+            # start with the rarest term, so the intersections stays small.
+            postings = sorted(
+                (self.postings.get(term, set()) for term in full_terms), key=len
+            )
+            candidates = set(postings[0]) if postings else last
+
+            for posting in postings[1:]:
+                candidates &= posting
+
+            if postings:
+                candidates &= last
+
+        filters = (mode, approved, min_stars, max_stars, min_bpm, max_bpm)
+        results: list[IndexedBeatmap] = []
+
+        # few enough candidates are cheaper to sort, than walking the whole ranking.
+        if candidates is not None and len(candidates) * 8 < len(self.ranking):
+            for map_id in candidates:
+                if self._matches(beatmap := self.maps[map_id], *filters):
+                    results.append(beatmap)
+
+            results.sort(key=lambda beatmap: (-beatmap.plays, beatmap.map_id))
+            return results[:MAX_RESULTS]
+
+        for _, map_id in self.ranking:
+            if candidates is not None and map_id not in candidates:
+                continue
+
+            if self._matches(beatmap := self.maps[map_id], *filters):
+                results.append(beatmap)
+
+                if len(results) == MAX_RESULTS:
+                    break
+
+        return results
+
+    async def build(self, chunk_size: int = 5000) -> None:
+        """Builds a new index, streaming the beatmaps table in chunks.
+        It replaces the current one once it's done, searches keeps using
+        the current one until then."""
+        building = BeatmapIndex()
+        self._pending = []
+
+        try:
+            last_id = 0
+
+            while beatmaps := await services.database.fetch_all(
+                "SELECT set_id, map_id, map_md5, title, title_unicode, artist, artist_unicode, "
+                "version, creator, mode, approved, stars, bpm, plays FROM beatmaps "
+                "WHERE map_id > :last_id ORDER BY map_id ASC LIMIT :limit",
+                {"last_id": last_id, "limit": chunk_size},
+            ):
+                for beatmap in beatmaps:
+                    building.add(IndexedBeatmap(**dict(beatmap)), sort=False)
+
+                last_id = beatmaps[-1]["map_id"]
+
+            building.tokens = sorted(building.postings)
+            building.ranking.sort()
+
+            for beatmap in self._pending:
+                building.add(beatmap)
+
+            self.maps = building.maps
+            self.md5s = building.md5s
+            self.postings = building.postings
+            self.tokens = building.tokens
+            self.ranking = building.ranking
+            self.built = True
+        finally:
+            self._pending = None
+
+        services.logger.info(f"Indexed {len(self.maps)} beatmaps for searching.")
+
+
+index = BeatmapIndex()
+
+
+async def beatmap_index_loop() -> None:
+    """Builds the index, retrying until it works, then rebuilds it
+    every `REBUILD_INTERVAL` seconds."""
+    while True:
+        if index.built:
+            await asyncio.sleep(REBUILD_INTERVAL)
+
+        try:
+            await index.build()
+        except Exception:
+            services.logger.exception("Failed to build the beatmap index, retrying.")
+            await asyncio.sleep(BUILD_RETRY_INTERVAL)
+
+
+@on_invalidation("beatmap_added")
+def _add_beatmap(beatmap: str) -> None:
+    index.add(IndexedBeatmap(**orjson.loads(beatmap)))
+
+
+@on_invalidation("beatmap_status")
+def _set_statuses(statuses: str) -> None:
+    for status in statuses.split(","):
+        map_md5, _, approved = status.partition("=")
+        index.set_approved(map_md5, int(approved))
+
+
+async def set_statuses(statuses: dict[str, int]) -> None:
+    """Updates the status of the beatmaps (map_md5 -> approved) in the index of every worker."""
+    for map_md5, approved in statuses.items():
+        index.set_approved(map_md5, approved)
+
+    await publish_invalidation(
+        "beatmap_status",
+        ",".join(f"{map_md5}={approved}" for map_md5, approved in statuses.items()),
+    )
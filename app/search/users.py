@@ -0,0 +1,187 @@
+import asyncio
+import time
+
+import services
+
+# full usernames, for prefix matches.
+NAMES_KEY = "ragnarok:api:search:usernames"
+# every other suffix of the usernames, for substring matches.
+SUFFIXES_KEY = "ragnarok:api:search:suffixes"
+# the highest user id in the index.
+LAST_ID_KEY = "ragnarok:api:search:last_id"
+LOCK_KEY = "ragnarok:api:search:lock"
+# the most entries looked at per sorted set, for a single search. queries
+# matching more than this (like a single letter) only finds some of the users.
+MAX_MATCHES = 1000
+# usernames changed anywhere but the admin panel (or straight in the
+# database) are only picked up by a full rebuild.
+FULL_REBUILD_INTERVAL = 86400
+
+# all members of the sorted sets has the same score, so they're
+# ordered lexicographically and can be range queried with ZRANGEBYLEX.
+#
+# names:    <safe_username>\x00<user_id>
+# suffixes: <suffix>\x00<safe_username>\x00<user_id>
+
+
+def safe_name(username: str) -> str:
+    return username.lower().replace(" ", "_")
+
+
+def _entries(user_id: int, safe_username: str) -> tuple[str, list[str]]:
+    name = f"{safe_username}\x00{user_id}"
+    suffixes = [
+        f"{safe_username[i:]}\x00{safe_username}\x00{user_id}"
+        for i in range(1, len(safe_username))
+    ]
+
+    return name, suffixes
+
+
+async def add_user(user_id: int, safe_username: str) -> None:
+    name, suffixes = _entries(user_id, safe_username)
+
+    async with services.redis.pipeline(transaction=False) as pipe:
+        pipe.zadd(NAMES_KEY, {name: 0})
+        if suffixes:
+            pipe.zadd(SUFFIXES_KEY, {suffix: 0 for suffix in suffixes})
+        await pipe.execute()
+
+
+async def update_username(
+    user_id: int, old_safe_username: str, safe_username: str
+) -> None:
+    old_name, old_suffixes = _entries(user_id, old_safe_username)
+    name, suffixes = _entries(user_id, safe_username)
+
+    async with services.redis.pipeline() as pipe:
+        pipe.zrem(NAMES_KEY, old_name)
+        if old_suffixes:
+            pipe.zrem(SUFFIXES_KEY, *old_suffixes)
+
+        pipe.zadd(NAMES_KEY, {name: 0})
+        if suffixes:
+            pipe.zadd(SUFFIXES_KEY, {suffix: 0 for suffix in suffixes})
+
+        await pipe.execute()
+
+
+async def search(query: str, limit: int | None = None) -> list[int] | None:
+    """Returns the ids of the users, whose safe username contains `query`.
+
+    Exact matches come first, then prefix matches and then every other
+    match, shortest names first. The matches are always ranked as a whole,
+    so the result can be sliced into pages. Returns None if the index
+    hasn't been built, so the caller can fall back to sql."""
+    prefix = safe_name(query).encode()
+    if not prefix or b"\x00" in prefix:
+        return []
+
+    async with services.redis.pipeline(transaction=False) as pipe:
+        pipe.exists(NAMES_KEY)
+        for key in (NAMES_KEY, SUFFIXES_KEY):
+            pipe.zrangebylex(
+                key,
+                b"[" + prefix,
+                b"[" + prefix + b"\xff",
+                start=0,
+                num=MAX_MATCHES,
+            )
+        built, names, suffixes = await pipe.execute()
+
+    if not built:
+        return None
+
+    ranked: dict[int, tuple[int, int, bytes]] = {}
+
+    for member in names:
+        name, user_id = member.rsplit(b"\x00", 1)
+        rank = (0 if name == prefix else 1, len(name), name)
+        ranked[int(user_id)] = min(ranked.get(int(user_id), rank), rank)
+
+    for member in suffixes:
+        _, name, user_id = member.split(b"\x00")
+        rank = (2, len(name), name)
+        ranked[int(user_id)] = min(ranked.get(int(user_id), rank), rank)
+
+    # the name breaks ties, so the order (and every page) is the same each time.
+    user_ids = sorted(ranked, key=lambda user_id: (ranked[user_id], user_id))
+    return user_ids[:limit] if limit is not None else user_ids
+
+
+async def build_index(full: bool = False, chunk_size: int = 5000) -> None:
+    """Indexes every user, or only the users who aren't indexed yet.
+
+    A full build is written to temporary keys, which replaces the
+    live index once it's done."""
+    # only a single worker should build the index at a time.
+    if not await services.redis.set(LOCK_KEY, 1, nx=True, ex=600):
+        return
+
+    try:
+        last_id = 0 if full else int(await services.redis.get(LAST_ID_KEY) or 0)
+        names_key, suffixes_key = (
+            (f"{NAMES_KEY}:build", f"{SUFFIXES_KEY}:build")
+            if full
+            else (NAMES_KEY, SUFFIXES_KEY)
+        )
+
+        if full:
+            await services.redis.delete(names_key, suffixes_key)
+
+        indexed = 0
+        while users := await services.database.fetch_all(
+            "SELECT id, safe_username FROM users WHERE id > :last_id "
+            "ORDER BY id ASC LIMIT :limit",
+            {"last_id": last_id, "limit": chunk_size},
+        ):
+            async with services.redis.pipeline(transaction=False) as pipe:
+                for user in users:
+                    name, suffixes = _entries(user["id"], user["safe_username"])
+                    pipe.zadd(names_key, {name: 0})
+                    if suffixes:
+                        pipe.zadd(suffixes_key, {suffix: 0 for suffix in suffixes})
+
+                await pipe.execute()
+
+            last_id = users[-1]["id"]
+            indexed += len(users)
+
+        async with services.redis.pipeline() as pipe:
+            if full and indexed:
+                pipe.rename(names_key, NAMES_KEY)
+                pipe.rename(suffixes_key, SUFFIXES_KEY)
+
+            pipe.set(LAST_ID_KEY, last_id)
+            await pipe.execute()
+
+        if indexed:
+            services.logger.info(f"Indexed {indexed} usernames for searching.")
+    finally:
+        await services.redis.delete(LOCK_KEY)
+
+
+async def search_index_loop(
+    interval: int = 300, rebuild_interval: int = FULL_REBUILD_INTERVAL
+) -> None:
+    """Builds the index if it doesn't exist, and picks up newly registered users.
+
+    Only renames made through the admin panel updates the index, so it's
+    rebuilt from scratch every `rebuild_interval` seconds, to pick up the rest."""
+    full = not await services.redis.exists(NAMES_KEY)
+    last_full_build = time.monotonic()
+
+    while True:
+        if time.monotonic() - last_full_build >= rebuild_interval:
+            full = True
+
+        try:
+            await build_index(full=full)
+
+            if full:
+                last_full_build = time.monotonic()
+            full = False
+        except Exception:
+            services.logger.exception("Failed to build the username search index.")
+
+        await asyncio.sleep(interval)
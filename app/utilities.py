@@ -1,15 +1,22 @@
-from hashlib import md5
+import asyncio
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from hashlib import blake2b, md5
 import os
 from pathlib import Path
 import struct
+import time
 
 import services
-from typing import Any
+from typing import Any, Awaitable, Callable, Generic, TypeVar
 from fastapi import HTTPException, Header, Query
 from enum import IntEnum
 
 import jwt
+import orjson
 from pydantic import BaseModel
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 from app.constants.privileges import Privileges
 
@@ -39,6 +46,15 @@ class Mode(IntEnum):
         return f"{field}_{mode}" + (f" AS {field}" if with_alias else "")
 
 
+# every valid gamemode and mode pair, relax doesn't have mania.
+MODES = [
+    (gamemode, mode)
+    for gamemode in Gamemode
+    for mode in Mode
+    if not (gamemode == Gamemode.RELAX and mode == Mode.MANIA)
+]
+
+
 class ModeAndGamemode:
     def __init__(self) -> None:
         self.gamemode: Gamemode = Gamemode.VANILLA
@@ -85,13 +101,306 @@ def parse_including_query(include: list[str] = Query([])) -> list[str]:
     return all_inc
 
 
+def decode_cursor(cursor: str, size: int = 2) -> list[int | float] | None:
+    """Decodes a pagination cursor made by `next_cursor`, returns None if it's invalid."""
+    try:
+        values = orjson.loads(
+            base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        )
+    except (ValueError, orjson.JSONDecodeError):
+        return
+
+    if (
+        not isinstance(values, list)
+        or len(values) != size
+        or not all(type(value) in (int, float) for value in values)
+    ):
+        return
+
+    return values
+
+
+def next_cursor(rows: list[dict[str, Any]], limit: int, *keys: str) -> str | None:
+    """Creates an opaque cursor for the page after `rows`, holding the
+    sort `keys` (usually the sort key and id) of the last row. None if
+    there's no more rows."""
+    if len(rows) < limit:
+        return
+
+    values = [rows[-1][key] for key in keys]
+    return base64.urlsafe_b64encode(orjson.dumps(values)).decode().rstrip("=")
+
+
+def keyset_condition(
+    sort_column: str, id_column: str, source: str | None = None
+) -> str:
+    """Condition for rows after the cursor, when ordering by `sort_column` and `id_column` descending.
+
+    Uses the `cursor_key` and `cursor_id` parameters. Floats (like pp) don't
+    survive the trip through the cursor exactly, for those `source` is the table
+    the cursor row is read back from, so the key is compared as it's stored."""
+    key = ":cursor_key"
+
+    if source is not None:
+        # the cursor's own value is only used if the row is gone since.
+        key = (
+            f"COALESCE((SELECT {sort_column.rpartition(".")[2]} FROM {source} "
+            "WHERE id = :cursor_id), :cursor_key)"
+        )
+
+    return (
+        f"({sort_column} < {key} OR "
+        f"({sort_column} = {key} AND {id_column} < :cursor_id))"
+    )
+
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+class Loader(Generic[K, V]):
+    """Collects every `load` made within the same event loop tick, and
+    fetches them with a single `batch` call (usually `WHERE id IN (...)`).
+    Results are remembered for as long as the loader lives."""
+
+    def __init__(self, batch: Callable[[list[K]], Awaitable[dict[K, V]]]) -> None:
+        self.batch = batch
+        self.results: dict[K, asyncio.Future[V | None]] = {}
+        self.queue: list[K] = []
+        self.task: asyncio.Task | None = None
+
+    def load(self, key: K) -> Awaitable[V | None]:
+        if (result := self.results.get(key)) is not None:
+            return result
+
+        result = asyncio.get_running_loop().create_future()
+        self.results[key] = result
+        self.queue.append(key)
+
+        # the dispatch runs after every other task, that's ready
+        # in this tick, has had the chance to queue their keys.
+        if len(self.queue) == 1:
+            self.task = asyncio.create_task(self.dispatch())
+
+        return result
+
+    def forget(self, key: K) -> None:
+        self.results.pop(key, None)
+
+    async def dispatch(self) -> None:
+        keys, self.queue = self.queue, []
+
+        try:
+            values = await self.batch(keys)
+        except Exception as exc:
+            for key in keys:
+                self.results.pop(key).set_exception(exc)
+            return
+
+        for key in keys:
+            self.results[key].set_result(values.get(key))
+
+
+# loaders of the current request, so results are shared within, but not across requests.
+_request_loaders: ContextVar[dict[str, Loader] | None] = ContextVar(
+    "request_loaders", default=None
+)
+
+
+class LoaderMiddleware:
+    """Gives every request its own set of loaders."""
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        token = _request_loaders.set({})
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_loaders.reset(token)
+
+
+def get_loader(
+    name: str, batch: Callable[[list[K]], Awaitable[dict[K, V]]]
+) -> Loader[K, V]:
+    """Returns the requests loader called `name`, creating it with `batch` if needed.
+    Outside of requests, a new loader is returned every time."""
+    if (loaders := _request_loaders.get()) is None:
+        return Loader(batch)
+
+    if name not in loaders:
+        loaders[name] = Loader(batch)
+
+    return loaders[name]
+
+
+async def _load_users(user_ids: list[int]) -> dict[int, Any]:
+    # the principals are loaded through this, so a lagging replica
+    # could hand out privileges the user no longer has.
+    users = await services.database.fetch_all(
+        "SELECT id, username, safe_username, privileges, country FROM users "
+        "WHERE id IN :user_ids",
+        {"user_ids": user_ids},
+    )
+
+    return {user["id"]: user for user in users}
+
+
+def load_user(user_id: int) -> Awaitable[Any]:
+    """Loads a users id, username, safe_username, privileges and country."""
+    return get_loader("users", _load_users).load(user_id)
+
+
+class TTLCache(Generic[K, V]):
+    """Small in-process cache, where entries expire after `ttl` seconds.
+    The oldest entries are dropped, once it holds `maxsize` entries."""
+
+    def __init__(self, ttl: float, maxsize: int = 10_000) -> None:
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.entries: dict[K, tuple[float, V]] = {}
+
+    def get(self, key: K) -> V | None:
+        if (entry := self.entries.get(key)) is None:
+            return
+
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self.entries[key]
+            return
+
+        return value
+
+    def set(self, key: K, value: V) -> None:
+        self.entries.pop(key, None)
+
+        while len(self.entries) >= self.maxsize:
+            del self.entries[next(iter(self.entries))]
+
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+
+    def pop(self, key: K) -> None:
+        self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+
+def make_etag(data: bytes) -> str:
+    """Strong etag of the response body."""
+    return f'"{blake2b(data, digest_size=16).hexdigest()}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    if not if_none_match:
+        return False
+
+    return if_none_match.strip() == "*" or etag in (
+        tag.strip() for tag in if_none_match.split(",")
+    )
+
+
+# every worker listens on this channel, so in-process caches
+# can be invalidated across workers. messages are "<kind>:<key>".
+INVALIDATION_CHANNEL = "ragnarok:api:invalidate"
+_invalidation_handlers: dict[str, Callable[[str], None]] = {}
+
+
+def on_invalidation(
+    kind: str,
+) -> Callable[[Callable[[str], None]], Callable[[str], None]]:
+    """Registers a handler for invalidation messages of `kind`."""
+
+    def wrapper(handler: Callable[[str], None]) -> Callable[[str], None]:
+        _invalidation_handlers[kind] = handler
+        return handler
+
+    return wrapper
+
+
+async def publish_invalidation(kind: str, key: Any) -> None:
+    await services.redis.publish(INVALIDATION_CHANNEL, f"{kind}:{key}")
+
+
+async def invalidation_listener() -> None:
+    while True:
+        try:
+            async with services.redis.pubsub() as pubsub:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+
+                async for message in pubsub.listen():
+                    if message["type"] != "message":
+                        continue
+
+                    kind, _, key = message["data"].decode().partition(":")
+                    if handler := _invalidation_handlers.get(kind):
+                        handler(key)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            services.logger.exception("Lost the invalidation subscription, retrying.")
+            await asyncio.sleep(1)
+
+
 class UserData(BaseModel):
     user_id: int
     username: str
     privileges: Privileges
 
 
-async def get_current_user(authorization: str | None = Header(None)) -> UserData | None:
+# the user id, username and privileges of authenticated users are cached
+# both in-process and in redis, as they're needed on almost every request.
+# privileges can be changed by the server (or in the database) without
+# invalidating them, so they're only kept for a few seconds.
+PRINCIPAL_CACHE_TTL = 5
+_principals: TTLCache[int, UserData] = TTLCache(ttl=5)
+
+
+def principal_cache_key(user_id: int) -> str:
+    return f"ragnarok:api:principal:{user_id}"
+
+
+@on_invalidation("principal")
+def _forget_principal(user_id: str) -> None:
+    _principals.pop(int(user_id))
+
+
+async def invalidate_principal(user_id: int) -> None:
+    """Drops the cached principal of `user_id` on every worker."""
+    _principals.pop(user_id)
+    await services.redis.delete(principal_cache_key(user_id))
+    await publish_invalidation("principal", user_id)
+
+
+async def get_principal(user_id: int, fresh: bool = False) -> UserData | None:
+    """The cached principal of `user_id`, or read from the database if `fresh`."""
+    if not fresh and (user := _principals.get(user_id)):
+        return user
+
+    if not fresh and (cached := await services.redis.get(principal_cache_key(user_id))):
+        user = UserData.model_validate_json(cached)
+    else:
+        if not (data := await load_user(user_id)):
+            return
+
+        user = UserData(
+            user_id=user_id,
+            username=data["username"],
+            privileges=Privileges(data["privileges"]),
+        )
+        await services.redis.set(
+            principal_cache_key(user_id),
+            user.model_dump_json(),
+            ex=PRINCIPAL_CACHE_TTL,
+        )
+
+    _principals.set(user_id, user)
+    return user
+
+
+def _user_id_from_authorization(authorization: str | None) -> int | None:
     if not authorization:
         return
 
@@ -110,27 +419,301 @@ async def get_current_user(authorization: str | None = Header(None)) -> UserData
     user_id = payload.get("sub")
     assert user_id is not None
 
-    data = await services.database.fetch_one(
-        "SELECT username, privileges FROM users WHERE id = :user_id LIMIT 1",
-        {"user_id": user_id},
-    )
+    return int(user_id)
+
+
+async def get_current_user(authorization: str | None = Header(None)) -> UserData | None:
+    if (user_id := _user_id_from_authorization(authorization)) is None:
+        return
+
+    if not (user := await get_principal(user_id)):
+        raise HTTPException(401, {"error": "could not validate jwt token"})
+
+    return user
+
+
+async def get_privileged_user(
+    authorization: str | None = Header(None),
+) -> UserData | None:
+    """Like `get_current_user`, but the privileges are always read from the
+    database, for the routes they grant access to."""
+    if (user_id := _user_id_from_authorization(authorization)) is None:
+        return
 
-    if not data:
+    if not (user := await get_principal(user_id, fresh=True)):
         raise HTTPException(401, {"error": "could not validate jwt token"})
 
-    return UserData(
-        user_id=user_id,
-        username=data["username"],
-        privileges=Privileges(data["privileges"]),
+    return user
+
+
+class LazyUser:
+    """The current user, only resolved if the endpoint actually needs it."""
+
+    def __init__(self, authorization: str | None) -> None:
+        self.authorization = authorization
+        self.resolved = False
+        self.user: UserData | None = None
+
+    async def resolve(self) -> UserData | None:
+        if not self.resolved:
+            self.user = await get_current_user(self.authorization)
+            self.resolved = True
+
+        return self.user
+
+
+def get_lazy_user(authorization: str | None = Header(None)) -> LazyUser:
+    return LazyUser(authorization)
+
+
+# bcrypt is slow on purpose, so password checks runs in their own
+# small thread pool, instead of blocking the event loop.
+PASSWORD_WORKERS = int(os.getenv("RAGNAROK_PASSWORD_WORKERS", "4"))
+# password checks allowed to wait for the pool, any more are shed.
+MAX_PENDING_PASSWORD_CHECKS = 64
+
+_password_pool = ThreadPoolExecutor(
+    max_workers=PASSWORD_WORKERS, thread_name_prefix="password"
+)
+
+
+class PasswordPoolStats:
+    pending: int = 0
+    checks: int = 0
+    shed: int = 0
+    queue_time: float = 0.0
+    max_queue_time: float = 0.0
+
+
+password_pool_stats = PasswordPoolStats()
+
+
+async def check_password(password: bytes, passhash: bytes) -> bool | None:
+    """Checks the password against the bcrypt hash, in the password pool.
+
+    Returns None, if the pool is too busy to take the check."""
+    if password_pool_stats.pending >= MAX_PENDING_PASSWORD_CHECKS:
+        password_pool_stats.shed += 1
+        return
+
+    queued_at = time.perf_counter()
+
+    def check() -> bool:
+        queue_time = time.perf_counter() - queued_at
+        password_pool_stats.queue_time += queue_time
+        password_pool_stats.max_queue_time = max(
+            password_pool_stats.max_queue_time, queue_time
+        )
+
+        # imported here, so workers doesn't pay for it until someone logs in.
+        import bcrypt
+
+        return bcrypt.checkpw(password, passhash)
+
+    password_pool_stats.pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_password_pool, check)
+    finally:
+        password_pool_stats.pending -= 1
+        password_pool_stats.checks += 1
+
+
+class Grades(BaseModel):
+    XH: int = 0
+    X: int = 0
+    SH: int = 0
+    S: int = 0
+    A: int = 0
+    B: int = 0
+    C: int = 0
+    D: int = 0
+    F: int = 0
+
+
+# the grade counts are only a cache, scores are submitted (and their status
+# changed) by the server, so nothing in here could keep counters up to date.
+GRADES_CACHE_TTL = 300
+
+
+def grades_key(user_id: int, gamemode: Gamemode, mode: Mode) -> str:
+    """Redis hash caching the amount of each grade, on the users best scores.
+
+    The hash always contains every grade (even if it's 0), and expires
+    after `GRADES_CACHE_TTL` seconds, it's counted again on the next request."""
+    return f"ragnarok:grades:{gamemode.name.lower()}:{mode}:{user_id}"
+
+
+async def count_grades(user_id: int, gamemode: Gamemode, mode: Mode) -> Grades:
+    """Counts the users grades from their scores, and caches the counter."""
+    rank_counter = await services.database.fetch_all(
+        "SELECT COUNT(rank) AS count, rank FROM scores WHERE gamemode = :gamemode "
+        "AND mode = :mode AND status = 3 AND user_id = :user_id GROUP BY rank",
+        {"gamemode": gamemode, "mode": mode, "user_id": user_id},
     )
 
+    grades = Grades(**{grade["rank"]: grade["count"] for grade in rank_counter})
 
-async def log(user_id: int, note: str) -> None:
-    await services.database.execute(
-        "INSERT INTO logs (user_id, note) VALUES (:user_id, :note)",
-        {"user_id": user_id, "note": note},
+    async with services.redis.pipeline(transaction=False) as pipe:
+        pipe.hset(grades_key(user_id, gamemode, mode), mapping=grades.model_dump())
+        pipe.expire(grades_key(user_id, gamemode, mode), GRADES_CACHE_TTL)
+        await pipe.execute()
+
+    return grades
+
+
+# indexes some of the endpoints rely on to avoid full table scans,
+# the leftmost columns of an index has to match (in any order).
+REQUIRED_INDEXES: list[tuple[str, tuple[str, ...]]] = [
+    # mods filtered beatmap leaderboards
+    ("scores", ("map_md5", "mode", "gamemode", "status", "mods")),
+    # keyset paginated best and recent scores
+    ("scores", ("user_id", "gamemode", "mode", "status", "pp")),
+    ("scores", ("user_id", "gamemode", "mode", "submitted")),
+]
+
+
+async def check_indexes() -> None:
+    """Warns about every index in `REQUIRED_INDEXES` that doesn't exist."""
+    rows = await services.database.fetch_all(
+        "SELECT TABLE_NAME AS table_name, INDEX_NAME AS index_name, COLUMN_NAME AS column_name "
+        "FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() "
+        "ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX"
     )
 
+    indexes: dict[tuple[str, str], list[str]] = {}
+    for row in rows:
+        indexes.setdefault((row["table_name"], row["index_name"]), []).append(
+            row["column_name"]
+        )
+
+    for table, columns in REQUIRED_INDEXES:
+        if any(
+            table_name == table and set(index[: len(columns)]) == set(columns)
+            for (table_name, _), index in indexes.items()
+        ):
+            continue
+
+        services.logger.warning(
+            f"missing index on {table} ({", ".join(columns)}), "
+            "queries depending on it will be slow."
+        )
+
+
+# profiles are the second most visited route, so the sql part of
+# them are kept around for a little while in redis.
+PROFILE_CACHE_TTL = 30
+
+
+def profile_cache_key(user_id: int) -> str:
+    return f"ragnarok:api:profile:{user_id}"
+
+
+# compact user cards, used by the bulk user lookup.
+USER_CARD_CACHE_TTL = 60
+
+
+def user_card_cache_key(user_id: int) -> str:
+    return f"ragnarok:api:card:{user_id}"
+
+
+async def invalidate_profile(user_id: int) -> None:
+    await services.redis.delete(
+        profile_cache_key(user_id), user_card_cache_key(user_id)
+    )
+
+
+# audit log entries are buffered and written in batches by `log_flush_loop`,
+# so admin actions don't have to wait for the insert.
+LOG_FLUSH_SIZE = 100
+LOG_FLUSH_INTERVAL = 5
+# entries allowed to wait for a flush, past this the callers
+# have to wait for the entries to be written themselves.
+MAX_PENDING_LOGS = 10_000
+
+_log_buffer: list[tuple[int, str]] = []
+_log_flush_requested = asyncio.Event()
+
+
+class LogBufferStats:
+    # entries waiting to be written, if this keeps growing
+    # the database can't keep up with the audit log.
+    pending: int = 0
+    written: int = 0
+    # flushes the callers had to wait for, since the buffer was full.
+    inline_flushes: int = 0
+    flushes: int = 0
+    failed_flushes: int = 0
+    flush_time: float = 0.0
+
+
+log_buffer_stats = LogBufferStats()
+
+
+async def log_many(user_id: int, notes: list[str]) -> None:
+    """Queues an audit log entry for every note of `user_id`. They're
+    written right away instead, if too many are waiting already."""
+    _log_buffer.extend((user_id, note) for note in notes)
+    log_buffer_stats.pending = len(_log_buffer)
+
+    if len(_log_buffer) >= MAX_PENDING_LOGS:
+        # the flush loop can't keep up, nothing is dropped, the entries
+        # are kept (and retried) if the database is down as well.
+        log_buffer_stats.inline_flushes += 1
+        await flush_logs()
+    elif len(_log_buffer) >= LOG_FLUSH_SIZE:
+        _log_flush_requested.set()
+
+
+async def log(user_id: int, note: str) -> None:
+    await log_many(user_id, [note])
+
+
+async def flush_logs() -> None:
+    """Writes every buffered log entry, `LOG_FLUSH_SIZE` rows per insert."""
+    while _log_buffer:
+        entries = _log_buffer[:LOG_FLUSH_SIZE]
+        del _log_buffer[:LOG_FLUSH_SIZE]
+
+        values = []
+        params: dict[str, Any] = {}
+
+        for idx, (user_id, note) in enumerate(entries):
+            values.append(f"(:user_id{idx}, :note{idx})")
+            params |= {f"user_id{idx}": user_id, f"note{idx}": note}
+
+        started = time.perf_counter()
+        try:
+            await services.database.execute(
+                f"INSERT INTO logs (user_id, note) VALUES {", ".join(values)}", params
+            )
+        except BaseException:
+            # put them back in front, to be retried on the next flush.
+            _log_buffer[:0] = entries
+            log_buffer_stats.failed_flushes += 1
+            raise
+        finally:
+            log_buffer_stats.pending = len(_log_buffer)
+
+        log_buffer_stats.written += len(entries)
+        log_buffer_stats.flushes += 1
+        log_buffer_stats.flush_time += time.perf_counter() - started
+
+
+async def log_flush_loop() -> None:
+    while True:
+        try:
+            await asyncio.wait_for(_log_flush_requested.wait(), LOG_FLUSH_INTERVAL)
+        except TimeoutError:
+            pass
+
+        _log_flush_requested.clear()
+
+        try:
+            await flush_logs()
+        except Exception:
+            services.logger.exception("Failed to write the audit log, retrying.")
+            await asyncio.sleep(LOG_FLUSH_INTERVAL)
+
 
 async def write_replay(score_id: int) -> bytearray | None:
     RAGNAROK_REPLAYS_PATH = Path(os.environ["RAGNAROK_REPLAYS_PATH"])
@@ -170,7 +753,7 @@ async def write_replay(score_id: int) -> bytearray | None:
 
     raw = path.read_bytes()
 
-    play = await services.database.fetch_one(
+    play = await services.replica.fetch_one(
         "SELECT s.id, s.user_id, s.map_md5, s.score, s.pp, s.count_300, "
         "s.count_50, s.count_geki, s.count_katu, s.count_miss, s.count_100, "
         "s.max_combo, s.accuracy, s.perfect, s.rank, s.mods, s.mode, "
@@ -182,10 +765,7 @@ async def write_replay(score_id: int) -> bytearray | None:
         print("aSSASD")
         return
 
-    user_info = await services.database.fetch_one(
-        "SELECT username, id, privileges, passhash FROM users WHERE id = :id",
-        {"id": play["user_id"]},
-    )
+    user_info = await load_user(play["user_id"])
 
     if not user_info:
         print("pdskaposakd")
@@ -0,0 +1,70 @@
+import argparse
+import sys
+from pathlib import Path
+from typing import Any
+
+import orjson
+
+# python -m bench.compare bench/results/<before>.json bench/results/<after>.json
+# exits with 1 if any endpoint got slower (or handles less) than the threshold allows.
+COMPARED = ("p50_ms", "p95_ms", "p99_ms", "throughput")
+# the tail is what regressions shows up in, the median is just informative.
+GATED = ("p95_ms", "p99_ms", "throughput")
+
+
+def change(before: float, after: float) -> float:
+    return (after - before) / before * 100 if before else 0
+
+
+def compare(
+    before: dict[str, Any], after: dict[str, Any], threshold: float
+) -> list[str]:
+    regressions = []
+
+    print(f"{before["commit"][:12]} -> {after["commit"][:12]}\n")
+    print(f"{"endpoint":<16}" + "".join(f"{stat:>22}" for stat in COMPARED))
+
+    endpoints = {**after["endpoints"], "total": after["total"]}
+    for name, summary in endpoints.items():
+        old = before["total"] if name == "total" else before["endpoints"].get(name)
+        if old is None:
+            continue
+
+        cells = []
+        for stat in COMPARED:
+            delta = change(old[stat], summary[stat])
+            # less throughput is worse, unlike the latencies.
+            worse = -delta if stat == "throughput" else delta
+
+            if stat in GATED and worse > threshold:
+                regressions.append(f"{name} {stat} {delta:+.1f}%")
+
+            cells.append(f"{old[stat]:.1f} -> {summary[stat]:.1f} ({delta:+.0f}%)")
+
+        print(f"{name:<16}" + "".join(f"{cell:>22}" for cell in cells))
+
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compares two benchmark results.")
+    parser.add_argument("before", type=Path)
+    parser.add_argument("after", type=Path)
+    parser.add_argument(
+        "--threshold", type=float, default=10, help="allowed regression, in percent"
+    )
+    args = parser.parse_args()
+
+    before = orjson.loads(args.before.read_bytes())
+    after = orjson.loads(args.after.read_bytes())
+
+    if before["config"] != after["config"]:
+        print("warning: the results were made with different configs.\n")
+
+    if regressions := compare(before, after, args.threshold):
+        print("\nregressions:\n" + "\n".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import hashlib
+import random
+from typing import Any
+
+# everything is derived from the ids, so the seed and the
+# fake osu api agrees on the beatmaps without sharing any state.
+BEATMAPS_PER_SET = 4
+HIT_OBJECTS = 300
+
+ARTISTS = ("xi", "Camellia", "DragonForce", "Feryquitous", "Kurokotei", "nekodex")
+TITLES = ("Blue Zenith", "Freedom Dive", "Ascension", "Galaxy Collapse", "Mayday")
+VERSIONS = ("Easy", "Normal", "Hard", "Insane", "Extra", "Expert")
+COUNTRIES = ("TH", "US", "DE", "JP", "KR", "PL", "BR", "GB", "FR", "CA")
+
+
+def map_md5(map_id: int) -> str:
+    return hashlib.md5(f"bench:{map_id}".encode()).hexdigest()
+
+
+def set_id(map_id: int) -> int:
+    return map_id // BEATMAPS_PER_SET
+
+
+def set_map_ids(set_id: int) -> range:
+    return range(set_id * BEATMAPS_PER_SET, (set_id + 1) * BEATMAPS_PER_SET)
+
+
+def api_beatmap(map_id: int) -> dict[str, Any]:
+    """The beatmap, as the osu api (v1) would return it from `get_beatmaps`."""
+    rng = random.Random(map_id)
+    stars = round(rng.uniform(1, 8), 2)
+
+    return {
+        "beatmapset_id": str(set_id(map_id)),
+        "beatmap_id": str(map_id),
+        "file_md5": map_md5(map_id),
+        "title": rng.choice(TITLES),
+        "title_unicode": None,
+        "version": f"{rng.choice(VERSIONS)} {map_id}",
+        "artist": rng.choice(ARTISTS),
+        "artist_unicode": None,
+        "creator": f"mapper{map_id % 97}",
+        "creator_id": str(map_id % 97 + 1),
+        "difficultyrating": str(stars),
+        "diff_overall": str(round(rng.uniform(4, 10), 1)),
+        "diff_approach": str(round(rng.uniform(5, 10), 1)),
+        "diff_drain": str(round(rng.uniform(3, 8), 1)),
+        "diff_size": str(round(rng.uniform(2, 6), 1)),
+        "bpm": str(rng.choice((140, 170, 180, 200, 222))),
+        "mode": "0",
+        "max_combo": str(HIT_OBJECTS),
+        "approved": "1",
+        "submit_date": "2020-01-01 00:00:00",
+        "approved_date": "2020-02-01 00:00:00",
+        "last_update": "2020-01-15 00:00:00",
+        "total_length": str(rng.randint(60, 300)),
+        "hit_length": str(rng.randint(50, 280)),
+        "rating": str(round(rng.uniform(6, 10), 2)),
+    }
+
+
+def osu_file(map_id: int) -> str:
+    """A small, but valid .osu file, so the pp calculation has something to work with."""
+    beatmap = api_beatmap(map_id)
+    rng = random.Random(map_id)
+
+    lines = [
+        "osu file format v14",
+        "",
+        "[General]",
+        "Mode: 0",
+        "",
+        "[Metadata]",
+        f"Title:{beatmap["title"]}",
+        f"Artist:{beatmap["artist"]}",
+        f"Creator:{beatmap["creator"]}",
+        f"Version:{beatmap["version"]}",
+        f"BeatmapID:{map_id}",
+        f"BeatmapSetID:{beatmap["beatmapset_id"]}",
+        "",
+        "[Difficulty]",
+        f"HPDrainRate:{beatmap["diff_drain"]}",
+        f"CircleSize:{beatmap["diff_size"]}",
+        f"OverallDifficulty:{beatmap["diff_overall"]}",
+        f"ApproachRate:{beatmap["diff_approach"]}",
+        "SliderMultiplier:1.4",
+        "SliderTickRate:1",
+        "",
+        "[TimingPoints]",
+        f"0,{60_000 / float(beatmap["bpm"])},4,2,0,100,1,0",
+        "",
+        "[HitObjects]",
+    ]
+
+    time = 1000
+    for _ in range(HIT_OBJECTS):
+        time += rng.choice((150, 200, 300))
+        lines.append(f"{rng.randint(0, 512)},{rng.randint(0, 384)},{time},1,0,0:0:0:0:")
+
+    return "\n".join(lines) + "\n"
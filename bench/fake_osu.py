@@ -0,0 +1,43 @@
+import asyncio
+import os
+
+from fastapi import FastAPI, Query, Response
+from fastapi.responses import ORJSONResponse, PlainTextResponse
+
+from bench import data
+
+# stands in for osu.ppy.sh, with canned responses for every beatmap id.
+# a bit of latency makes it behave a little more like the real thing.
+LATENCY = float(os.getenv("FAKE_OSU_LATENCY_MS", "50")) / 1000
+
+app = FastAPI()
+
+
+@app.get("/api/get_beatmaps")
+async def get_beatmaps(
+    s: int | None = Query(None),
+    b: int | None = Query(None),
+    h: str | None = Query(None),
+    k: str | None = Query(None),
+) -> Response:
+    await asyncio.sleep(LATENCY)
+
+    if not k:
+        return ORJSONResponse({"error": "Please provide a valid API key."}, 401)
+
+    if s is not None:
+        map_ids = list(data.set_map_ids(s))
+    elif b is not None:
+        map_ids = [b]
+    else:
+        # md5s can't be turned back into ids, which is fine as
+        # everything the benchmarks looks up by md5 is seeded.
+        map_ids = []
+
+    return ORJSONResponse([data.api_beatmap(map_id) for map_id in map_ids])
+
+
+@app.get("/web/osu-getosufile.php")
+async def get_osu_file(q: int = Query()) -> Response:
+    await asyncio.sleep(LATENCY)
+    return PlainTextResponse(data.osu_file(q))
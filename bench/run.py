@@ -0,0 +1,318 @@
+import argparse
+import asyncio
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Callable, Iterator
+
+import httpx
+import orjson
+
+from bench.seed import MANIFEST
+
+# python -m bench.run --concurrency 32 --duration 30
+# starts the fake osu api and the app (against the seeded database and redis),
+# drives a mix of the hot endpoints and saves the latencies to bench/results.
+# seed the database with `python -m bench.seed` first.
+DEFAULT_MIX = {
+    "leaderboard": 30,
+    "beatmap_scores": 30,
+    "user": 25,
+    "score": 10,
+    "replay": 5,
+}
+PERCENTILES = (50, 95, 99)
+READY_TIMEOUT = 30
+
+Manifest = dict[str, Any]
+
+
+def hot(rng: random.Random, ids: list[int]) -> int:
+    # skewed like the seed, the first ids gets most of the traffic.
+    return ids[min(int(rng.paretovariate(1.2)) - 1, len(ids) - 1)]
+
+
+def leaderboard(rng: random.Random, manifest: Manifest) -> str:
+    mode = rng.choices(range(4), (70, 10, 10, 10))[0]
+    gamemode = int(rng.random() < 0.3 and mode != 3)
+    page = min(int(rng.paretovariate(1.5)), 20)
+    path = f"/api/community/leaderboard?mode={mode}&gamemode={gamemode}&page={page}"
+
+    if rng.random() < 0.2:
+        path += f"&country={rng.choice(manifest["countries"])}"
+
+    return path
+
+
+def beatmap_scores(rng: random.Random, manifest: Manifest) -> str:
+    return f"/api/beatmap/scores/{hot(rng, manifest["map_ids"])}"
+
+
+def user(rng: random.Random, manifest: Manifest) -> str:
+    return f"/api/users/get/{hot(rng, manifest["user_ids"])}"
+
+
+def score(rng: random.Random, manifest: Manifest) -> str:
+    return f"/api/score/{rng.choice(manifest["score_ids"])}"
+
+
+def replay(rng: random.Random, manifest: Manifest) -> str:
+    return f"/api/score/replay/{rng.choice(manifest["replay_score_ids"])}"
+
+
+REQUESTS: dict[str, Callable[[random.Random, Manifest], str]] = {
+    "leaderboard": leaderboard,
+    "beatmap_scores": beatmap_scores,
+    "user": user,
+    "score": score,
+    "replay": replay,
+}
+
+
+@dataclass
+class Samples:
+    latencies: list[float] = field(default_factory=list)
+    errors: int = 0
+
+    def summary(self, duration: float) -> dict[str, Any]:
+        latencies = sorted(self.latencies)
+        summary: dict[str, Any] = {
+            "requests": len(latencies),
+            "errors": self.errors,
+            "throughput": len(latencies) / duration,
+        }
+
+        for percentile in PERCENTILES:
+            summary[f"p{percentile}_ms"] = (
+                latencies[
+                    min(int(len(latencies) * percentile / 100), len(latencies) - 1)
+                ]
+                * 1000
+                if latencies
+                else 0
+            )
+
+        summary["max_ms"] = latencies[-1] * 1000 if latencies else 0
+        summary["mean_ms"] = sum(latencies) / len(latencies) * 1000 if latencies else 0
+
+        return summary
+
+
+def parse_mix(mix: str) -> dict[str, int]:
+    weights = {}
+
+    for part in mix.split(","):
+        name, _, weight = part.partition("=")
+        if name not in REQUESTS:
+            raise argparse.ArgumentTypeError(f"unknown request {name!r}")
+
+        weights[name] = int(weight)
+
+    return weights
+
+
+async def drive(
+    client: httpx.AsyncClient,
+    manifest: Manifest,
+    mix: dict[str, int],
+    concurrency: int,
+    duration: float,
+    seed: int,
+) -> tuple[dict[str, Samples], float]:
+    samples = {name: Samples() for name in mix}
+    names = list(mix)
+    weights = list(mix.values())
+    deadline = time.perf_counter() + duration
+
+    async def worker(idx: int) -> None:
+        rng = random.Random(seed * 1000 + idx)
+
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            path = REQUESTS[name](rng, manifest)
+            started = time.perf_counter()
+
+            try:
+                response = await client.get(path)
+                failed = response.status_code >= 400
+            except httpx.HTTPError:
+                failed = True
+
+            samples[name].latencies.append(time.perf_counter() - started)
+            samples[name].errors += failed
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(idx) for idx in range(concurrency)))
+
+    return samples, time.perf_counter() - started
+
+
+@contextmanager
+def serve(
+    app: str, port: int, env: dict[str, str], workers: int = 1
+) -> Iterator[subprocess.Popen]:
+    process = subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            app,
+            "--port",
+            str(port),
+            "--workers",
+            str(workers),
+            "--log-level",
+            "warning",
+        ],
+        env=env,
+    )
+
+    try:
+        yield process
+    finally:
+        process.terminate()
+        process.wait()
+
+
+async def wait_ready(url: str) -> None:
+    deadline = time.monotonic() + READY_TIMEOUT
+
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            try:
+                await client.get(url)
+                return
+            except httpx.TransportError:
+                await asyncio.sleep(0.2)
+
+    raise TimeoutError(f"{url} didn't come up within {READY_TIMEOUT} seconds.")
+
+
+def git_revision() -> tuple[str, bool]:
+    def git(*args: str) -> str:
+        return subprocess.run(
+            ("git", *args), capture_output=True, text=True
+        ).stdout.strip()
+
+    return git("rev-parse", "HEAD") or "unknown", bool(git("status", "--porcelain"))
+
+
+async def benchmark(args: argparse.Namespace, target: str) -> dict[str, Any]:
+    manifest = orjson.loads((args.data / MANIFEST).read_bytes())
+
+    async with httpx.AsyncClient(
+        base_url=target,
+        timeout=args.timeout,
+        limits=httpx.Limits(max_connections=args.concurrency),
+    ) as client:
+        if args.warmup:
+            await drive(
+                client, manifest, args.mix, args.concurrency, args.warmup, args.seed
+            )
+
+        samples, duration = await drive(
+            client, manifest, args.mix, args.concurrency, args.duration, args.seed
+        )
+
+    total = Samples()
+    for endpoint in samples.values():
+        total.latencies += endpoint.latencies
+        total.errors += endpoint.errors
+
+    commit, dirty = git_revision()
+
+    return {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": int(time.time()),
+        "config": {
+            "concurrency": args.concurrency,
+            "duration": args.duration,
+            "warmup": args.warmup,
+            "workers": args.workers,
+            "mix": args.mix,
+            "seed": args.seed,
+        },
+        "total": total.summary(duration),
+        "endpoints": {
+            name: endpoint.summary(duration) for name, endpoint in samples.items()
+        },
+    }
+
+
+def print_results(results: dict[str, Any]) -> None:
+    print(
+        f"{"endpoint":<16}{"requests":>10}{"errors":>8}{"req/s":>10}"
+        f"{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}"
+    )
+
+    rows = {**results["endpoints"], "total": results["total"]}
+    for name, summary in rows.items():
+        print(
+            f"{name:<16}{summary["requests"]:>10}{summary["errors"]:>8}"
+            f"{summary["throughput"]:>10.1f}{summary["p50_ms"]:>10.1f}"
+            f"{summary["p95_ms"]:>10.1f}{summary["p99_ms"]:>10.1f}"
+        )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmarks the hot endpoints.")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--warmup", type=float, default=5)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=DEFAULT_MIX,
+        help="weights of the requests, e.g. leaderboard=50,user=50",
+    )
+    parser.add_argument("--data", type=Path, default=Path("bench/.data"))
+    parser.add_argument("--output", type=Path, default=None)
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--osu-port", type=int, default=8765)
+    parser.add_argument(
+        "--target", default=None, help="benchmark an already running app instead"
+    )
+    args = parser.parse_args()
+
+    if args.target:
+        results = await benchmark(args, args.target)
+    else:
+        # a new beatmap folder every run, so the .osu files are fetched
+        # from the fake osu api, like they would after a deploy.
+        with tempfile.TemporaryDirectory() as beatmaps:
+            env = os.environ | {
+                "OSU_API_URL": f"http://127.0.0.1:{args.osu_port}",
+                "RAGNAROK_BEATMAP_PATH": beatmaps,
+                "RAGNAROK_REPLAYS_PATH": str(args.data.resolve() / "replays"),
+            }
+            target = f"http://127.0.0.1:{args.port}"
+
+            with (
+                serve("bench.fake_osu:app", args.osu_port, env),
+                serve("main:app", args.port, env, args.workers),
+            ):
+                await wait_ready(f"http://127.0.0.1:{args.osu_port}/openapi.json")
+                await wait_ready(f"{target}/openapi.json")
+
+                results = await benchmark(args, target)
+
+    print_results(results)
+
+    output = args.output or Path("bench/results") / f"{results["commit"][:12]}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_bytes(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+    print(f"\nsaved to {output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,349 @@
+import argparse
+import asyncio
+import logging
+import random
+import time
+from pathlib import Path
+from typing import Any
+
+import orjson
+
+import services
+from app.jobs.recalculate import weighted_pp
+from app.utilities import MODES, Gamemode, Mode
+from bench import data
+
+# python -m bench.seed --users 2000 --beatmaps 4000 --scores 200000
+# fills a database (and redis) dedicated to the benchmarks with fake users,
+# beatmaps and scores. the tables it seeds (and the leaderboards and caches in
+# redis) are emptied first, so it refuses to run against a database without
+# "bench" in its name, or redis' default database (set REDIS_DB), unless --force
+# is given.
+SEEDED_TABLES = ("users", "stats", "stats_rx", "beatmaps", "scores")
+INSERT_CHUNK = 1000
+
+MODE_WEIGHTS = (70, 10, 10, 10)
+RELAX_CHANCE = 0.3
+COMMON_MODS = (0, 0, 0, 8, 16, 64, 72, 24, 128)
+MANIFEST = "manifest.json"
+
+logger = logging.getLogger(__name__)
+
+
+async def insert(table: str, rows: list[dict[str, Any]]) -> None:
+    if not rows:
+        return
+
+    columns = list(rows[0])
+
+    for offset in range(0, len(rows), INSERT_CHUNK):
+        chunk = rows[offset : offset + INSERT_CHUNK]
+        params: dict[str, Any] = {}
+        values = []
+
+        for idx, row in enumerate(chunk):
+            values.append(
+                "(" + ", ".join(f":{column}{idx}" for column in columns) + ")"
+            )
+            params |= {f"{column}{idx}": row[column] for column in columns}
+
+        await services.database.execute(
+            f"INSERT INTO {table} ({", ".join(columns)}) VALUES {", ".join(values)}",
+            params,
+        )
+
+
+def make_beatmaps(count: int) -> list[dict[str, Any]]:
+    beatmaps = []
+
+    # map ids starts at the first full set.
+    for map_id in range(data.BEATMAPS_PER_SET, count + data.BEATMAPS_PER_SET):
+        beatmap = data.api_beatmap(map_id)
+        beatmaps.append(
+            {
+                "server": "bancho",
+                "set_id": int(beatmap["beatmapset_id"]),
+                "map_id": map_id,
+                "map_md5": beatmap["file_md5"],
+                "title": beatmap["title"],
+                "title_unicode": beatmap["title"],
+                "version": beatmap["version"],
+                "artist": beatmap["artist"],
+                "artist_unicode": beatmap["artist"],
+                "creator": beatmap["creator"],
+                "creator_id": int(beatmap["creator_id"]),
+                "stars": float(beatmap["difficultyrating"]),
+                "od": float(beatmap["diff_overall"]),
+                "ar": float(beatmap["diff_approach"]),
+                "hp": float(beatmap["diff_drain"]),
+                "cs": float(beatmap["diff_size"]),
+                "mode": 0,
+                "bpm": float(beatmap["bpm"]),
+                "max_combo": int(beatmap["max_combo"]),
+                "submit_date": beatmap["submit_date"],
+                "approved_date": beatmap["approved_date"],
+                "latest_update": beatmap["last_update"],
+                "length": float(beatmap["total_length"]),
+                "drain": int(beatmap["hit_length"]),
+                "plays": 0,
+                "passes": 0,
+                "favorites": 0,
+                "rating": float(beatmap["rating"]),
+                # the status ragnarok uses, not the one of the osu api.
+                "approved": 2,
+                "full_set_present": True,
+            }
+        )
+
+    return beatmaps
+
+
+def make_users(count: int, rng: random.Random) -> list[dict[str, Any]]:
+    now = int(time.time())
+
+    return [
+        {
+            "id": user_id,
+            "username": f"bench {user_id}",
+            "safe_username": f"bench_{user_id}",
+            "email": f"bench{user_id}@example.com",
+            # not a valid hash, nobody logs in as the benchmark users.
+            "passhash": "-",
+            "country": rng.choice(data.COUNTRIES),
+            "privileges": 6,
+            "registered_time": now - rng.randint(86_400, 86_400 * 1000),
+            "latest_activity_time": now - rng.randint(0, 86_400 * 30),
+        }
+        # 1 is usually the bot.
+        for user_id in range(2, count + 2)
+    ]
+
+
+def make_scores(
+    count: int,
+    users: list[dict[str, Any]],
+    beatmaps: list[dict[str, Any]],
+    rng: random.Random,
+) -> list[dict[str, Any]]:
+    scores = []
+    best: set[tuple[int, str, int, int]] = set()
+    now = int(time.time())
+
+    # a few players and beatmaps gets most of the plays, like on the real server.
+    user_weights = [1 / (idx + 10) for idx in range(len(users))]
+    beatmap_weights = [1 / (idx + 10) for idx in range(len(beatmaps))]
+    picked_users = rng.choices(users, user_weights, k=count)
+    picked_beatmaps = rng.choices(beatmaps, beatmap_weights, k=count)
+
+    for score_id, (user, beatmap) in enumerate(
+        zip(picked_users, picked_beatmaps), start=1
+    ):
+        mode = rng.choices(range(4), MODE_WEIGHTS)[0]
+        gamemode = int(rng.random() < RELAX_CHANCE and mode != Mode.MANIA)
+        accuracy = round(rng.uniform(85, 100), 2)
+        misses = rng.choice((0, 0, 0, 1, 2, 5))
+
+        key = (user["id"], beatmap["map_md5"], mode, gamemode)
+        status = 2 if key in best else 3
+        best.add(key)
+
+        scores.append(
+            {
+                "id": score_id,
+                "user_id": user["id"],
+                "map_md5": beatmap["map_md5"],
+                "score": rng.randint(100_000, 50_000_000),
+                "pp": round(beatmap["stars"] ** 2.6 * accuracy / 100, 3),
+                "count_300": data.HIT_OBJECTS - misses - 10,
+                "count_100": 8,
+                "count_50": 2,
+                "count_geki": rng.randint(0, 50),
+                "count_katu": rng.randint(0, 20),
+                "count_miss": misses,
+                "max_combo": data.HIT_OBJECTS - misses * 20,
+                "accuracy": accuracy,
+                "perfect": misses == 0,
+                "rank": "S" if accuracy > 95 and not misses else "A",
+                "mods": rng.choice(COMMON_MODS),
+                "mode": mode,
+                "gamemode": gamemode,
+                "status": status,
+                "awards_pp": True,
+                "submitted": now - rng.randint(0, 86_400 * 365),
+            }
+        )
+
+    return scores
+
+
+def make_stats(
+    users: list[dict[str, Any]], scores: list[dict[str, Any]]
+) -> dict[Gamemode, list[dict[str, Any]]]:
+    pps: dict[tuple[int, Gamemode, Mode], list[float]] = {}
+    plays: dict[tuple[int, Gamemode, Mode], list[dict[str, Any]]] = {}
+
+    for score in scores:
+        key = (score["user_id"], Gamemode(score["gamemode"]), Mode(score["mode"]))
+        plays.setdefault(key, []).append(score)
+
+        if score["status"] == 3:
+            pps.setdefault(key, []).append(score["pp"])
+
+    stats: dict[Gamemode, list[dict[str, Any]]] = {
+        gamemode: [] for gamemode in Gamemode
+    }
+
+    for gamemode in Gamemode:
+        for user in users:
+            row: dict[str, Any] = {"id": user["id"]}
+
+            for mode in Mode:
+                key = (user["id"], gamemode, mode)
+                user_plays = plays.get(key, [])
+                best = sorted(pps.get(key, []), reverse=True)
+
+                row |= {
+                    mode.to_db("pp", False): weighted_pp(best),
+                    mode.to_db("ranked_score", False): sum(
+                        play["score"] for play in user_plays if play["status"] == 3
+                    ),
+                    mode.to_db("total_score", False): sum(
+                        play["score"] for play in user_plays
+                    ),
+                    mode.to_db("level", False): min(len(user_plays) // 10 + 1, 100),
+                    mode.to_db("accuracy", False): (
+                        sum(play["accuracy"] for play in user_plays) / len(user_plays)
+                        if user_plays
+                        else 0
+                    ),
+                    mode.to_db("playcount", False): len(user_plays),
+                    mode.to_db("total_hits", False): len(user_plays) * data.HIT_OBJECTS,
+                    mode.to_db("max_combo", False): max(
+                        (play["max_combo"] for play in user_plays), default=0
+                    ),
+                }
+
+            stats[gamemode].append(row)
+
+    return stats
+
+
+async def seed_leaderboards(
+    users: list[dict[str, Any]], stats: dict[Gamemode, list[dict[str, Any]]]
+) -> None:
+    countries = {user["id"]: user["country"] for user in users}
+
+    async for key in services.redis.scan_iter("ragnarok:leaderboard:*"):
+        await services.redis.delete(key)
+
+    async for key in services.redis.scan_iter("ragnarok:api:*"):
+        await services.redis.delete(key)
+
+    async with services.redis.pipeline(transaction=False) as pipe:
+        for gamemode, mode in MODES:
+            leaderboard = f"ragnarok:leaderboard:{gamemode.name.lower()}"
+            column = mode.to_db("pp", False)
+
+            for row in stats[gamemode]:
+                if not row[column]:
+                    continue
+
+                pipe.zadd(f"{leaderboard}:{mode}", {str(row["id"]): row[column]})
+                pipe.zadd(
+                    f"{leaderboard}:{countries[row["id"]]}:{mode}",
+                    {str(row["id"]): row[column]},
+                )
+
+        await pipe.execute()
+
+
+def write_replays(
+    directory: Path, scores: list[dict[str, Any]], count: int, rng: random.Random
+) -> list[int]:
+    directory.mkdir(parents=True, exist_ok=True)
+    score_ids = [score["id"] for score in rng.sample(scores, min(count, len(scores)))]
+
+    for score_id in score_ids:
+        # the replay frames are never decoded, they just has to be there.
+        (directory / f"{score_id}.osr").write_bytes(rng.randbytes(20_000))
+
+    return score_ids
+
+
+async def seed(args: argparse.Namespace) -> None:
+    rng = random.Random(args.seed)
+
+    beatmaps = make_beatmaps(args.beatmaps)
+    users = make_users(args.users, rng)
+    scores = make_scores(args.scores, users, beatmaps, rng)
+    stats = make_stats(users, scores)
+
+    for table in SEEDED_TABLES:
+        await services.database.execute(f"TRUNCATE TABLE {table}")
+
+    await insert("beatmaps", beatmaps)
+    await insert("users", users)
+    await insert("stats", stats[Gamemode.VANILLA])
+    await insert("stats_rx", stats[Gamemode.RELAX])
+    await insert("scores", scores)
+    await seed_leaderboards(users, stats)
+
+    replays = write_replays(args.data / "replays", scores, args.replays, rng)
+
+    # what the benchmark needs to know, to build requests that hits something.
+    manifest = {
+        "seed": args.seed,
+        "user_ids": [user["id"] for user in users],
+        "map_ids": [beatmap["map_id"] for beatmap in beatmaps],
+        "score_ids": [score["id"] for score in scores if score["status"] == 3],
+        "replay_score_ids": replays,
+        "countries": list(data.COUNTRIES),
+    }
+    (args.data / MANIFEST).write_bytes(orjson.dumps(manifest))
+
+    logger.info(
+        f"Seeded {len(users)} users, {len(beatmaps)} beatmaps, {len(scores)} scores "
+        f"and {len(replays)} replays."
+    )
+
+
+async def main() -> None:
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Seeds the benchmark database.")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--beatmaps", type=int, default=4000)
+    parser.add_argument("--scores", type=int, default=200_000)
+    parser.add_argument("--replays", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--data", type=Path, default=Path("bench/.data"))
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+
+    # what's actually connected to, DB_URL takes precedence over DB_DATABASE.
+    if "bench" not in (services.database.url.database or "") and not args.force:
+        parser.error(
+            f"{SEEDED_TABLES} are emptied before seeding, use a database with "
+            '"bench" in its name (or --force).'
+        )
+
+    if (
+        not services.redis.connection_pool.connection_kwargs.get("db")
+        and not args.force
+    ):
+        parser.error(
+            "the leaderboards and caches in redis are emptied before seeding, "
+            "use a redis database of its own with REDIS_DB (or --force)."
+        )
+
+    await services.database.connect()
+    await services.redis.initialize()
+
+    try:
+        await seed(args)
+    finally:
+        await services.database.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
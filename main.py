@@ -1,12 +1,56 @@
+import time
+
+# before everything else, so the import time covers the whole app.
+_import_started = time.perf_counter()
+
+import asyncio
 from fastapi import FastAPI
 from app import api
+from app.avatars import MAX_AVATAR_BYTES, UploadLimitMiddleware, avatar_index_loop
+from app.content import REFRESH_INTERVAL, content, static_content_loop
+from app.jobs import stop_jobs
+from app.jobs.history import history_snapshot_loop
+from app.metrics import MetricsMiddleware, startup_phase, startup_timings
+from app.search.beatmaps import beatmap_index_loop, index as beatmap_index
+from app.search.users import search_index_loop
+from app.utilities import (
+    LoaderMiddleware,
+    check_indexes,
+    flush_logs,
+    invalidation_listener,
+    log_flush_loop,
+)
 import os
 import services
+from typing import Awaitable
 
 from fastapi.middleware.cors import CORSMiddleware
 
 
+# keep a reference to the background tasks, so they don't get garbage collected.
+background_tasks: set[asyncio.Task] = set()
+
+# connections opened before the worker is ready, instead of by the first requests.
+WARM_DB_CONNECTIONS = int(os.getenv("RAGNAROK_WARM_DB_CONNECTIONS", "4"))
+WARM_REDIS_CONNECTIONS = int(os.getenv("RAGNAROK_WARM_REDIS_CONNECTIONS", "4"))
+# loading these before the worker is ready makes the startup slower,
+# but the first searches and content requests doesn't have to wait for them.
+WARM_BEATMAP_INDEX = os.getenv("RAGNAROK_WARM_BEATMAP_INDEX") == "1"
+WARM_STATIC_CONTENT = os.getenv("RAGNAROK_WARM_STATIC_CONTENT") == "1"
+
+
+async def warm_up(name: str, load: Awaitable[None]) -> None:
+    try:
+        with startup_phase(name):
+            await load
+    except Exception:
+        # the background tasks loads whatever couldn't be warmed up.
+        services.logger.exception(f"Failed to warm up the {name}.")
+
+
 async def startup() -> None:
+    started = time.perf_counter()
+
     # Make sure the enviormentmeoiintal variables exists
     for env in (
         "DB_NAME",
@@ -23,14 +67,86 @@ async def startup() -> None:
             services.logger.critical(f'env variable "{env}" has not been set.')
             exit(1)
 
-    await services.database.connect()
+    with startup_phase("database"):
+        await services.database.connect()
+        await asyncio.gather(
+            *(
+                services.database.fetch_val("SELECT 1")
+                for _ in range(WARM_DB_CONNECTIONS)
+            )
+        )
     services.logger.info("Connected to the database.")
 
-    await services.redis.initialize()
+    if services.replica.replicas:
+        with startup_phase("replicas"):
+            await services.replica.connect()
+
+        for replica in services.replica.replicas:
+            if not replica.healthy:
+                services.logger.warning(
+                    f"Replica {replica.name} is out of rotation ({replica.status})."
+                )
+        background_tasks.add(asyncio.create_task(services.replica.lag_loop()))
+
+    with startup_phase("redis"):
+        await services.redis.initialize()
+        await asyncio.gather(
+            *(services.redis.ping() for _ in range(WARM_REDIS_CONNECTIONS))
+        )
     services.logger.info("Connected to Redis.")
 
+    warm_ups = []
+    if WARM_BEATMAP_INDEX:
+        warm_ups.append(warm_up("beatmap index", beatmap_index.build()))
+    if WARM_STATIC_CONTENT:
+        warm_ups.append(warm_up("static content", content.refresh()))
+
+    await asyncio.gather(*warm_ups)
+
+    # it only warns, so it doesn't have to hold up the startup.
+    background_tasks.add(asyncio.create_task(check_indexes()))
+    background_tasks.add(asyncio.create_task(invalidation_listener()))
+    background_tasks.add(asyncio.create_task(log_flush_loop()))
+    background_tasks.add(asyncio.create_task(history_snapshot_loop()))
+    background_tasks.add(asyncio.create_task(search_index_loop()))
+    background_tasks.add(asyncio.create_task(avatar_index_loop()))
+    background_tasks.add(
+        asyncio.create_task(
+            static_content_loop(delay=REFRESH_INTERVAL if content.loaded else 0)
+        )
+    )
+
+    background_tasks.add(asyncio.create_task(beatmap_index_loop()))
+
+    startup_timings["startup"] = time.perf_counter() - started
+    services.logger.info(
+        f"Ready in {startup_timings["startup"] * 1000:.0f}ms, imported in "
+        f"{startup_timings["import"] * 1000:.0f}ms ("
+        + ", ".join(
+            f"{name}: {duration * 1000:.0f}ms"
+            for name, duration in startup_timings.items()
+            if name not in ("import", "startup")
+        )
+        + ")."
+    )
+
 
 async def shutdown() -> None:
+    for task in background_tasks:
+        task.cancel()
+
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+
+    # they're marked as failed, instead of looking like they're still running.
+    await stop_jobs()
+
+    # write whatever is left of the audit log, before the database goes away.
+    try:
+        await flush_logs()
+    except Exception:
+        services.logger.exception("Failed to write the audit log on shutdown.")
+
+    await services.replica.disconnect()
     await services.database.disconnect()
 
 
@@ -44,4 +160,14 @@ app.add_middleware(
     allow_headers=["Authorization"],
 )
 
+app.add_middleware(LoaderMiddleware)
+app.add_middleware(
+    UploadLimitMiddleware, paths=("/api/settings/avatar",), limit=MAX_AVATAR_BYTES
+)
+
+# outermost, so the latency includes every other middleware.
+app.add_middleware(MetricsMiddleware)
+
 app.include_router(api.router)
+
+startup_timings["import"] = time.perf_counter() - _import_started